@@ -0,0 +1,108 @@
+# Fleets of rovers on socket pairs, and the field rovers at the other end,
+# shared by the benchmarks
+import socket
+import os
+import logging
+import selectors
+import tempfile
+import datetime
+import threading
+from time import time, sleep
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from daimyo_utils import Rover  # noqa: E402
+
+
+def scratch_dir():
+    '''Change to a new temporary directory, with datalogs/<date> in it
+    (Rover writes datalogs/ relative to the working directory)'''
+    workdir = tempfile.mkdtemp(prefix='daimyo_bench_')
+    os.chdir(workdir)
+    os.makedirs('datalogs/'+datetime.datetime.now().strftime('%Y_%m_%d'))
+    return workdir
+
+
+def make_fleet(number, engine=None, threaded=None, **kwargs):
+    '''Rovers on socket pairs, threaded unless an 'engine' is given or
+    'threaded' is False. Other keyword arguments go to Rover(). Returns
+    (rovers, peer sockets).'''
+    handler = logging.NullHandler()
+    if threaded is None:
+        threaded = engine is None
+    rovers = []
+    peers = []
+    for ii in range(number):
+        sock1, sock2 = socket.socketpair()
+        rover = Rover(sock1, ('bench', ii), handler, handler,
+                      logging.WARNING, threaded=threaded, **kwargs)
+        if engine is not None:
+            engine.add_rover(rover)
+        rovers.append(rover)
+        peers.append(sock2)
+    return rovers, peers
+
+
+def close_fleet(rovers, peers, engine=None):
+    if engine is not None:
+        engine.stop()
+    for rover in rovers:
+        rover.die()
+        if rover.threaded:
+            rover.thread.join()
+    for peer in peers:
+        peer.close()
+
+
+def drain(peer):
+    '''Read and drop what the rover sends to 'peer', in a daemon thread'''
+    def run():
+        while True:
+            try:
+                if not peer.recv(65536):
+                    break
+            except OSError:
+                break
+    threading.Thread(target=run, daemon=True).start()
+
+
+def ack(index, data):
+    '''One <ACK,> per command received'''
+    return b'<ACK,>'*data.count(b'<')
+
+
+def field(peers, heart, stop, reply=ack):
+    '''The field rovers: each peer sends a MYPOS every 'heart' ms, spread
+    over the period, and answers what it receives with reply(index,
+    data)'''
+    selector = selectors.DefaultSelector()
+    for ii, peer in enumerate(peers):
+        selector.register(peer, selectors.EVENT_READ, ii)
+    number = len(peers)
+    start = time()
+    sent = 0
+    while not stop.is_set():
+        due = int((time() - start)/(1e-3*heart)*number)
+        while sent < due:
+            peers[sent % number].send(('<MYPOS,%.3f,%.3f,%.3f>' % (
+                0.001*sent, -0.001*sent, (0.1*sent) % 360)).encode())
+            sent += 1
+        for key, mask in selector.select(1e-3*heart/number):
+            data = key.fileobj.recv(65536)
+            if data:
+                key.fileobj.send(reply(key.data, data))
+    selector.close()
+    return sent
+
+
+def commands(rovers, period, stop, make=None):
+    '''A server command every 'period' ms. make(ii) returns (rover,
+    command), <POS> to one rover after another by default.'''
+    ii = 0
+    while not stop.is_set():
+        if make is None:
+            rover, command = rovers[ii % len(rovers)], '<POS>'
+        else:
+            rover, command = make(ii)
+        rover.put_command(command)
+        ii += 1
+        sleep(1e-3*period)
@@ -0,0 +1,32 @@
+# Timing and message-stream helpers shared by the benchmarks
+from time import perf_counter
+
+
+def timeit(func, *args, repeat=3, number=1, clock=perf_counter):
+    '''Best of 'repeat' times (s per call, over 'number' calls) of
+    func(*args), and what the last call returned'''
+    best = float('inf')
+    out = None
+    for ii in range(repeat):
+        t0 = clock()
+        for jj in range(number):
+            out = func(*args)
+        best = min(best, (clock() - t0)/number)
+    return best, out
+
+
+def chop(stream, size=1460):
+    '''The packets recv() could return for 'stream', 'size' bytes each'''
+    return [stream[ii:ii+size] for ii in range(0, len(stream), size)]
+
+
+def heartbeat_frames(number=10000):
+    '''MYPOS frames of a rover on heartbeat, with an ACK every tenth'''
+    frames = []
+    for ii in range(number):
+        if ii % 10 == 9:
+            frames.append('<ACK,%d>' % (ii % 2))
+        else:
+            frames.append('<MYPOS,%.3f,%.3f,%.3f>' % (
+                0.001*ii, -0.002*ii, (0.1*ii) % 360))
+    return frames
@@ -0,0 +1,130 @@
+# Benchmark idle cost of the threaded and asyncio rover engines
+import socket
+import sys
+import os
+import getopt
+import logging
+import resource
+import threading
+from time import time, sleep, process_time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from daimyo_utils import Rover  # noqa: E402
+from daimyo_async import AsyncEngine  # noqa: E402
+from _fleet import scratch_dir  # noqa: E402
+
+
+def rss_kb():
+    '''Current resident set size (kB) from /proc, or peak RSS elsewhere'''
+    try:
+        with open('/proc/self/status') as _fp:
+            for line in _fp:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+crashes = []  # Exceptions that ended rover threads
+
+
+def count_crash(args):
+    crashes.append(args.exc_type.__name__)
+
+
+def run_case(enginetype='threaded', numrovers=10, idletime=5.0):
+    '''Connect 'numrovers' virtual rovers and measure CPU while idle'''
+    handler = logging.NullHandler()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('localhost', 0))
+    server.listen(128)
+    port = server.getsockname()[1]
+    if enginetype == 'asyncio':
+        engine = AsyncEngine()
+        engine.start()
+    del crashes[:]
+    rss0 = rss_kb()
+    threads0 = threading.active_count()
+    clients = []
+    rovers = []
+    t0 = time()
+    for ii in range(numrovers):
+        client = socket.create_connection(('localhost', port))
+        conn, addr = server.accept()
+        rover = Rover(conn, addr, handler, handler, logging.WARNING,
+                      threaded=(enginetype == 'threaded'))
+        if enginetype == 'asyncio':
+            engine.add_rover(rover)
+        client.sendall(('<MYPOS,%.3f,0.000,90.000>' % ii).encode())
+        clients.append(client)
+        rovers.append(rover)
+    connecttime = time() - t0
+    sleep(1.0)  # Let initial MYPOS messages settle
+    threads = threading.active_count() - threads0
+    rss = rss_kb() - rss0
+    c0 = process_time()
+    w0 = time()
+    sleep(idletime)
+    cpu = (process_time() - c0)/(time() - w0)
+
+    for client in clients:
+        client.close()
+    t0 = time()
+    while any(rover.alive for rover in rovers) and time() - t0 < 10:
+        sleep(0.1)
+    if enginetype == 'asyncio':
+        engine.stop()
+    for rover in rovers:
+        if rover.alive:
+            rover.die()
+        if rover.threaded:
+            rover.thread.join()
+    server.close()
+    return dict(engine=enginetype, rovers=numrovers, threads=threads,
+                crashed=len(crashes),
+                connect_s=connecttime, rss_kb_per_rover=rss/numrovers,
+                idle_cpu=cpu)
+
+
+if __name__ == '__main__':
+    sizes = [10, 100, 1000]
+    engines = ['threaded', 'asyncio']
+    idletime = 5.0
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:e:t:",
+                                   ["rovers=", "engine=", "idle="])
+    except getopt.GetoptError:
+        print('usage: python ', sys.argv[0],
+              '[-n|--rovers <n1,n2,...>] [-e|--engine <threaded|asyncio>] '
+              '[-t|--idle <seconds>]')
+        sys.exit(0)
+    for opt, arg in opts:
+        if opt in ["-n", "--rovers"]:
+            sizes = [int(x) for x in arg.split(',')]
+        elif opt in ["-e", "--engine"]:
+            engines = [arg]
+        elif opt in ["-t", "--idle"]:
+            idletime = float(arg)
+
+    # Each rover holds a socket pair and a datalog file
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < 4*max(sizes)+64 and hard != soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    threading.stack_size(256*1024)  # Keep 1000 threads affordable
+    workdir = scratch_dir()
+
+    # select.select() can't watch descriptors past FD_SETSIZE (1024), which
+    # ends rover threads at large fleet sizes. Count those instead.
+    threading.excepthook = count_crash
+    print('%-9s %6s %8s %8s %10s %12s %10s' % (
+        'engine', 'rovers', 'threads', 'crashed', 'connect(s)', 'kB/rover',
+        'idle CPU'))
+    for numrovers in sizes:
+        for enginetype in engines:
+            res = run_case(enginetype, numrovers, idletime)
+            print('%-9s %6d %8d %8d %10.2f %12.1f %9.1f%%' % (
+                res['engine'], res['rovers'], res['threads'], res['crashed'],
+                res['connect_s'], res['rss_kb_per_rover'],
+                100*res['idle_cpu']))
+    print('Datalogs written under %s' % workdir)
@@ -0,0 +1,168 @@
+# Emergency stop of a busy fleet: time from HALT ALL until every field
+# rover has its <HALT>, through the command queues (as HALT ALL did) and
+# through the emergency-stop lane, and HALT to ACK latency
+import sys
+import os
+import getopt
+import threading
+import random
+from time import perf_counter, sleep
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from daimyo_utils import Waker, EmergencyStop  # noqa: E402
+from daimyo_async import AsyncEngine  # noqa: E402
+from daimyo_datalog import DatalogWriter  # noqa: E402
+from _fleet import scratch_dir, make_fleet, close_fleet  # noqa: E402
+from _fleet import field, commands  # noqa: E402
+
+
+def halt_acks(trial):
+    '''Field rover replies: <ACK,1> to motion commands and <ACK,0> to
+    <HALT>. Notes when each peer got its HALT of the current trial.'''
+    def reply(index, data):
+        halts = data.count(b'<HALT>')
+        if halts and trial['t0'] is not None and \
+                index not in trial['arrived']:
+            trial['arrived'][index] = perf_counter()
+        return b'<ACK,0>'*halts + b'<ACK,1>'*(data.count(b'<') - halts)
+    return reply
+
+
+def random_goto(rovers):
+    def make(ii):
+        return random.choice(rovers), '<GOTO,%.2f,%.2f,,,>' % (
+            random.uniform(-5, 5), random.uniform(-5, 5))
+    return make
+
+
+def lock_hog(rovers, hold, stop):
+    '''A slow reader holding one rover lock after another for 'hold' ms'''
+    while not stop.is_set():
+        rover = random.choice(rovers)
+        rover.lock.acquire()
+        sleep(1e-3*hold)
+        rover.lock.release()
+
+
+def run(mode, rovers, lane, trials, trial):
+    '''HALT ALL 'trials' times. Returns per trial the seconds halting took
+    in the caller, and until the last field rover got its HALT.'''
+    calls = []
+    arrivals = []
+    for ii in range(trials):
+        trial['arrived'] = {}
+        trial['t0'] = t0 = perf_counter()
+        if mode == 'estop':
+            lane.halt(rovers)
+        else:
+            for rover in rovers:
+                if rover.alive:
+                    rover.put_command('<HALT>')
+        calls.append(perf_counter() - t0)
+        while len(trial['arrived']) < len(rovers) and \
+                perf_counter() - t0 < 2.0:
+            sleep(0.001)
+        trial['t0'] = None
+        if len(trial['arrived']) < len(rovers):
+            arrivals.append(float('inf'))
+        else:
+            arrivals.append(max(trial['arrived'].values()) - t0)
+        sleep(random.uniform(0.1, 0.2))
+    return calls, arrivals
+
+
+def ms(values, q):
+    return 1e3*np.percentile(values, q)
+
+
+if __name__ == '__main__':
+    number = 500
+    enginetype = 'asyncio'  # Rover threads select() fds below 1024 only
+    heart = 500
+    trials = 50
+    cmdperiod = 1.0
+    hold = 5.0
+    bound = 50.0
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:e:r:t:c:l:b:",
+                                   ["number=", "engine=", "heart=",
+                                    "trials=", "commands=", "hold=",
+                                    "bound="])
+    except getopt.GetoptError:
+        print('usage: python ', sys.argv[0], '[-n|--number <rovers>] '
+              '[-e|--engine <asyncio|threaded>] [-r|--heart <ms>] '
+              '[-t|--trials <HALT ALLs per mode>] '
+              '[-c|--commands <ms between>] [-l|--hold <lock hold ms>] '
+              '[-b|--bound <worst-case ms>]')
+        sys.exit(0)
+    for opt, arg in opts:
+        if opt in ["-n", "--number"]:
+            number = int(arg)
+        elif opt in ["-e", "--engine"]:
+            enginetype = arg
+        elif opt in ["-r", "--heart"]:
+            heart = int(arg)
+        elif opt in ["-t", "--trials"]:
+            trials = int(arg)
+        elif opt in ["-c", "--commands"]:
+            cmdperiod = float(arg)
+        elif opt in ["-l", "--hold"]:
+            hold = float(arg)
+        elif opt in ["-b", "--bound"]:
+            bound = float(arg)
+
+    scratch_dir()
+    datalog = DatalogWriter()
+    datalog.start()
+    upwaker = Waker()
+    engine = None
+    if enginetype == 'asyncio':
+        engine = AsyncEngine()
+        engine.start()
+    rovers, peers = make_fleet(number, engine, datalog=datalog,
+                               upwaker=upwaker)
+    lane = EmergencyStop()
+    trial = dict([('t0', None), ('arrived', {})])
+    stop = threading.Event()
+    load = [threading.Thread(target=field, args=(peers, heart, stop,
+                                                 halt_acks(trial))),
+            threading.Thread(target=commands, args=(
+                rovers, cmdperiod, stop, random_goto(rovers))),
+            threading.Thread(target=lock_hog, args=(rovers, hold, stop))]
+    for thread in load:
+        thread.start()
+    sleep(1.0)
+    print('%d rovers (%s), MYPOS every %d ms, a GOTO every %g ms, a rover '
+          'lock held %g ms at a time' % (number, enginetype, heart,
+                                         cmdperiod, hold))
+    print('%-8s %10s %10s %10s %10s %10s %7s' % (
+        'HALT ALL', 'call p50', 'call max', 'all p50', 'all p99',
+        'all max', 'missed'))
+    worst = None
+    for mode in ['queued', 'estop']:
+        calls, arrivals = run(mode, rovers, lane, trials, trial)
+        arrived = [_a for _a in arrivals if _a != float('inf')]
+        print('%-8s %10.2f %10.2f %10.2f %10.2f %10.2f %7d' % (
+            mode, ms(calls, 50), 1e3*max(calls),
+            ms(arrived, 50) if arrived else float('nan'),
+            ms(arrived, 99) if arrived else float('nan'),
+            1e3*max(arrived) if arrived else float('nan'),
+            len(arrivals) - len(arrived)))
+        if mode == 'estop':
+            worst = 1e3*max(arrivals)
+    _stats = lane.stats()
+    if _stats['acks']:
+        print('estop HALT to ACK (%d): p50 %.2f ms, p99 %.2f ms, max %.2f ms'
+              % (_stats['acks'], 1e3*_stats['ack_p50'],
+                 1e3*_stats['ack_p99'], 1e3*_stats['ack_max']))
+    stop.set()
+    for thread in load:
+        thread.join()
+    close_fleet(rovers, peers, engine)
+    datalog.stop()
+    if worst > bound:
+        print('Worst emergency HALT dispatch %.2f ms, over the %g ms bound' %
+              (worst, bound))
+        sys.exit(1)
+    print('Worst emergency HALT dispatch %.2f ms, within the %g ms bound' %
+          (worst, bound))
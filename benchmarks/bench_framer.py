@@ -0,0 +1,72 @@
+# Microbenchmark of TCPframer against TCPcompose message assembly
+import sys
+import os
+import getopt
+import logging
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from daimyo_utils import TCPcompose, TCPframer  # noqa: E402
+from _timing import timeit, chop, heartbeat_frames  # noqa: E402
+
+
+def run_compose(packets):
+    '''Old Rover.run_loop assembly, drained fully after every packet'''
+    out = []
+    inbuffer = ''
+    message = ''
+    msgstate = 0
+    for packet in packets:
+        inbuffer += packet.decode()
+        while inbuffer != '':
+            message, inbuffer, msgstate = TCPcompose(
+                growstr=message, newstr=inbuffer, messagestate=msgstate)
+            if msgstate == 2:
+                out.append(message)
+                msgstate = 0
+            else:
+                break
+    return out
+
+
+def run_framer(packets):
+    out = []
+    framer = TCPframer()
+    for packet in packets:
+        out.extend(framer.feed(packet))
+    return out
+
+
+if __name__ == '__main__':
+    numframes = 10000
+    sizes = [16, 64, 1460]
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:s:",
+                                   ["frames=", "sizes="])
+    except getopt.GetoptError:
+        print('usage: python ', sys.argv[0],
+              '[-n|--frames <number>] [-s|--sizes <bytes1,bytes2,...>]')
+        sys.exit(0)
+    for opt, arg in opts:
+        if opt in ["-n", "--frames"]:
+            numframes = int(arg)
+        elif opt in ["-s", "--sizes"]:
+            sizes = [int(x) for x in arg.split(',')]
+
+    # The server runs at logging.WARNING by default
+    logging.basicConfig(level=logging.WARNING)
+    frames = heartbeat_frames(numframes)
+    stream = ''.join(frames).encode()
+    print('%d frames, %d bytes' % (len(frames), len(stream)))
+    print('%8s %10s %14s %14s %8s %14s' % (
+        'packet', 'packets', 'TCPcompose', 'TCPframer', 'speedup',
+        'frames/packet'))
+    for size in sizes:
+        packets = chop(stream, size)
+        t_old, out_old = timeit(run_compose, packets)
+        t_new, out_new = timeit(run_framer, packets)
+        if out_old != frames or out_new != frames:
+            print('Mismatch in assembled frames for packet size %d!' % size)
+        print('%8d %10d %11.2f us %11.2f us %7.1fx %14.2f' % (
+            size, len(packets), 1e6*t_old/len(frames),
+            1e6*t_new/len(frames), t_old/t_new, len(frames)/len(packets)))
+    print('Times are per frame. The old run_loop handled at most one frame')
+    print('per 0.1 s loop iteration, TCPframer returns all of them at once.')
@@ -0,0 +1,249 @@
+# Microbenchmarks of the per-frame protocol functions (TCPcompose, cmdparse,
+# Rover.msg_parser, Rover.clean_send), compared against stored baselines.
+# Times are stored and compared as ratios to a calibration loop run in the
+# same process, so that a baseline holds on other machines.
+import sys
+import os
+import gc
+import json
+import getopt
+import platform
+import tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from daimyo_utils import TCPcompose, cmdparse  # noqa: E402
+from daimyo_datalog import DatalogWriter  # noqa: E402
+from _fleet import scratch_dir, make_fleet, drain  # noqa: E402
+from _timing import timeit, chop, heartbeat_frames  # noqa: E402
+
+baselinefile = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'bench_hotpath_baseline.json')
+
+
+def make_frames(kind='clean', number=10000):
+    '''Message frames from a field rover. 'clean' is heartbeats with
+    occasional ACKs, 'malformed' mixes in frames that fail to parse, and
+    'rfid' is a version '0_RFID' stream with RFID reports.'''
+    frames = heartbeat_frames(number)
+    for ii in range(number):
+        if kind == 'malformed' and ii % 4 == 3:
+            frames[ii] = ['<MYPOS,%d,abc,90.0>' % ii, '<MYPOS,1.0,2.0>',
+                          '<BOGUS,%d>' % ii, '<ACK,x>', '<MYPOS,,,>',
+                          '<>'][ii % 6]
+        elif kind == 'rfid' and ii % 3 == 2:
+            frames[ii] = '<RFID,%.3f,%.3f,%08X>' % (0.01*ii, -0.01*ii,
+                                                     ii*2654435761 % 2**32)
+    return frames
+
+
+def make_stream(frames, kind='clean'):
+    '''Bytes on the wire. The 'malformed' stream also has line noise and
+    abandoned partial frames between the frames.'''
+    if kind != 'malformed':
+        return ''.join(frames).encode()
+    _parts = []
+    for ii, frame in enumerate(frames):
+        if ii % 7 == 0:
+            _parts.append('~#~')
+        elif ii % 11 == 0:
+            _parts.append('<MYPO')  # Restarted by the next '<'
+        _parts.append(frame)
+    return ''.join(_parts).encode()
+
+
+def make_commands(number=10000):
+    '''Commands from the server, including '0_RFID' SEARCH and bad ones'''
+    cmds = ['<GOTO,1.0,2.0,,,>', '<HEART,500>', '<FWD,0.5,0.2,>', '<HALT>',
+            '<TURN,90,>', '<SEARCH,0.05,,10>', '<SETPOS,0,0,90>',
+            '<CTURN,0,>', '<GOTO,1.0,,,,>', '<FLY,1>']
+    return (cmds*(number//len(cmds) + 1))[:number]
+
+
+def compose_case(packets):
+    '''Rover.run_loop message assembly with TCPcompose (as it was before
+    TCPframer), one call per packet'''
+    state = dict([('inbuffer', ''), ('message', ''), ('msgstate', 0)])
+
+    def feed(packet):
+        state['inbuffer'] += packet.decode(errors='replace')
+        while state['inbuffer'] != '':
+            state['message'], state['inbuffer'], state['msgstate'] = \
+                TCPcompose(growstr=state['message'],
+                           newstr=state['inbuffer'],
+                           messagestate=state['msgstate'])
+            if state['msgstate'] == 2:
+                state['msgstate'] = 0
+            else:
+                break
+    return feed, packets
+
+
+def cmdparse_case(version, kind, frames):
+    def parse(frame):
+        cmdparse(version, kind, frame)
+    return parse, frames
+
+
+def make_rover(version, datalog):
+    '''Rover on a socket pair. A thread drains what the rover sends.'''
+    rovers, peers = make_fleet(1, threaded=False, datalog=datalog)
+    rovers[0].version = version
+    drain(peers[0])
+    return rovers[0], peers[0]
+
+
+def msg_parser_case(rover, frames):
+    def parse(frame):
+        rover.message = frame
+        rover.msg_parser()
+    return parse, frames
+
+
+def clean_send_case(rover, cmds):
+    def send(cmd):
+        rover.command = cmd
+        rover.clean_send()
+    return send, cmds
+
+
+def calibration_loop(number=10000):
+    '''A plain Python loop doing the kind of work the cases do (formatting,
+    splitting and counting frames)'''
+    _counts = {}
+    for ii in range(number):
+        _fields = ('<MYPOS,%d,%d,90.0>' % (ii, -ii))[1:-1].split(',')
+        _counts[_fields[0]] = _counts.get(_fields[0], 0) + 1
+    return _counts
+
+
+def measure(func, items, numframes, repeat=7):
+    '''(ns, ratio to the calibration loop, peak bytes allocated, bytes
+    still allocated) per frame. The calibration loop runs before each
+    repeat, so both see the machine in the same state.'''
+    def run_all():
+        for item in items:
+            func(item)
+    best = float('inf')
+    ratios = []
+    for ii in range(repeat):
+        _calibration = timeit(calibration_loop, repeat=1)[0]
+        _t = timeit(run_all, repeat=1)[0]
+        best = min(best, _t)
+        ratios.append(_t/_calibration)
+    gc.collect()
+    tracemalloc.start()
+    peak = 0
+    for item in items:
+        tracemalloc.reset_peak()
+        _current = tracemalloc.get_traced_memory()[0]
+        func(item)
+        peak += tracemalloc.get_traced_memory()[1] - _current
+    gc.collect()
+    kept = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (1e9*best/numframes, sorted(ratios)[repeat//2], peak/numframes,
+            kept/numframes)
+
+
+def run_cases(datalog, number=10000):
+    results = {}
+    for kind in ['clean', 'malformed', 'rfid']:
+        frames = make_frames(kind, number)
+        stream = make_stream(frames, kind)
+        for size, label in [(1460, 'back-to-back'), (7, 'fragmented')]:
+            func, items = compose_case(chop(stream, size))
+            results['TCPcompose %s %s' % (kind, label)] = measure(
+                func, items, number)
+        version = '0_RFID' if kind == 'rfid' else '0'
+        func, items = cmdparse_case(version, 'msg', frames)
+        results['cmdparse msg %s' % kind] = measure(func, items, number)
+        rover, peer = make_rover(version, datalog)
+        func, items = msg_parser_case(rover, frames)
+        results['msg_parser %s' % kind] = measure(func, items, number)
+        rover.die()
+        peer.close()
+    cmds = make_commands(number)
+    func, items = cmdparse_case('0_RFID', 'cmd', cmds)
+    results['cmdparse cmd 0_RFID'] = measure(func, items, number)
+    rover, peer = make_rover('0_RFID', datalog)
+    func, items = clean_send_case(rover, cmds)
+    results['clean_send 0_RFID'] = measure(func, items, number)
+    rover.die()
+    peer.close()
+    return results
+
+
+if __name__ == '__main__':
+    number = 10000
+    tolerance = 0.25
+    writeflag = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:b:t:w",
+                                   ["number=", "baseline=", "tolerance=",
+                                    "write"])
+    except getopt.GetoptError:
+        print('usage: python ', sys.argv[0], '[-n|--number <frames>] '
+              '[-b|--baseline <file.json>] [-t|--tolerance <fraction>] '
+              '[-w|--write]')
+        sys.exit(0)
+    for opt, arg in opts:
+        if opt in ["-n", "--number"]:
+            number = int(arg)
+        elif opt in ["-b", "--baseline"]:
+            baselinefile = arg
+        elif opt in ["-t", "--tolerance"]:
+            tolerance = float(arg)
+        elif opt in ["-w", "--write"]:
+            writeflag = True
+
+    baselinefile = os.path.abspath(baselinefile)
+    scratch_dir()
+    # Records queue up in a writer that isn't started, so the thread of a
+    # running one doesn't disturb timings
+    datalog = DatalogWriter()
+    results = run_cases(datalog, number)
+
+    baseline = {}
+    strict = True
+    if not writeflag and os.path.exists(baselinefile):
+        with open(baselinefile) as _fp:
+            _stored = json.load(_fp)
+        baseline = _stored['cases']
+        # Ratios (and allocations) shift between Python versions
+        if _stored['python'].split('.')[:2] != \
+                platform.python_version().split('.')[:2]:
+            print('Baseline is from Python %s, this is %s: differences are '
+                  'reported, not failed' % (_stored['python'],
+                                            platform.python_version()))
+            strict = False
+    regressions = 0
+    print('%-36s %9s %7s %9s %9s %9s' % ('case', 'ns/frame', 'ratio',
+                                         'baseline', 'B/frame', 'kept B'))
+    for case, (ns, ratio, peak, kept) in results.items():
+        _base = baseline.get(case)
+        _flag = ''
+        if _base is not None and (
+                ratio > _base['ratio']*(1+tolerance) or
+                peak > _base['bytes']*(1+tolerance) + 8 or
+                kept > _base['kept']*(1+tolerance) + 8):
+            _flag = '  REGRESSION'
+            regressions += 1
+        print('%-36s %9.0f %7.2f %9s %9.0f %9.0f%s' % (
+            case, ns, ratio,
+            '%.2f' % _base['ratio'] if _base else '-', peak, kept, _flag))
+    if writeflag:
+        with open(baselinefile, 'w') as _fp:
+            json.dump(dict([('python', platform.python_version()),
+                            ('platform', platform.platform()),
+                            ('frames', number),
+                            ('cases', dict([
+                                (case, dict([('ns', ns), ('ratio', ratio),
+                                             ('bytes', peak),
+                                             ('kept', kept)]))
+                                for case, (ns, ratio, peak, kept) in
+                                results.items()]))]), _fp, indent=2)
+        print('Baseline written to %s' % baselinefile)
+    elif regressions:
+        print('%d case(s) more than %.0f%% slower (or allocating more) than '
+              'the baseline' % (regressions, 100*tolerance))
+        if strict:
+            sys.exit(1)
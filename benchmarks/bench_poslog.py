@@ -0,0 +1,72 @@
+# Load time of a day-long datalog: text .dat against binary .pos
+import sys
+import os
+import getopt
+import tempfile
+from time import perf_counter
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from daimyo_datalog import dat_to_poslog, read_poslog  # noqa: E402
+from _timing import timeit  # noqa: E402
+
+
+def make_dat(filename, rate=10.0, hours=24.0):
+    '''Datalog of a rover driving in circles, as Rover/DatalogWriter write
+    it. Returns the number of records.'''
+    number = int(rate*hours*3600)
+    t = 1.6e9+np.arange(number)/rate
+    a = (10.0*np.arange(number)/rate) % 360
+    x = 5.0*np.cos(np.radians(a))
+    y = 5.0*np.sin(np.radians(a))
+    with open(filename, 'w') as fid:
+        fid.write('# ID, version, Thread: (Rover-0, v0, Thread-1) \n')
+        fid.write('# Time (s)\tx (m)\ty (m)\tangle (deg.)\n')
+        fid.write('# ID: (Rover-0, v0) -> (Ronin1, v0)\n')
+        np.savetxt(fid, np.column_stack([t, x, y, a]),
+                   fmt=['%.1f', '%.3f', '%.3f', '%.3f'], delimiter='\t')
+    return number
+
+
+def load_dat(filename):
+    data = np.loadtxt(filename, comments='#')
+    return data[:, 1].mean()
+
+
+def load_pos(filename):
+    header, records = read_poslog(filename)
+    return records['x'].mean()
+
+
+if __name__ == '__main__':
+    rate = 10.0
+    hours = 24.0
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "r:h:",
+                                   ["rate=", "hours="])
+    except getopt.GetoptError:
+        print('usage: python ', sys.argv[0],
+              '[-r|--rate <records/s>] [-h|--hours <log length>]')
+        sys.exit(0)
+    for opt, arg in opts:
+        if opt in ["-r", "--rate"]:
+            rate = float(arg)
+        elif opt in ["-h", "--hours"]:
+            hours = float(arg)
+
+    workdir = tempfile.mkdtemp(prefix='daimyo_bench_')
+    datfile = os.path.join(workdir, 'Ronin1.dat')
+    number = make_dat(datfile, rate, hours)
+    t0 = perf_counter()
+    posfile = dat_to_poslog(datfile)
+    t_conv = perf_counter() - t0
+
+    print('%d records (%.0f h at %g/s), converted in %.2f s' % (
+        number, hours, rate, t_conv))
+    print('%-6s %10s %12s' % ('format', 'size (MB)', 'load (s)'))
+    t_dat = timeit(load_dat, datfile, repeat=1)[0]
+    t_pos = timeit(load_pos, posfile)[0]
+    for label, filename, t in [('dat', datfile, t_dat),
+                               ('pos', posfile, t_pos)]:
+        print('%-6s %10.1f %12.4f' % (label,
+                                      os.path.getsize(filename)/1e6, t))
+    print('pos/dat: %.0fx faster load' % (t_dat/t_pos))
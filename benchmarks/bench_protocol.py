@@ -0,0 +1,104 @@
+# Parse throughput of protoparse against the older cmdparse + float() checks
+import sys
+import os
+import getopt
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from daimyo_utils import protoparse, vtypes  # noqa: E402
+from _timing import timeit  # noqa: E402
+
+
+def legacy_cmdparse(version='0', kind='cmd', instr='<x>'):
+    '''cmdparse() as it was: linear scan of a list of lists'''
+    if len(instr) < 3:
+        return False, '', []
+    strlist = instr[1:-1].split(',')
+    cmdtype = strlist.pop(0)
+    if [cmdtype, len(strlist)] in vtypes[version][kind]:
+        return True, cmdtype, strlist
+    return False, '', []
+
+
+def legacy_msg(version, instr):
+    '''Validation and conversion steps of the older Rover.msg_parser'''
+    _valid, _type, _fields = legacy_cmdparse(version, 'msg', instr)
+    if not _valid:
+        return None
+    if _type != 'ACK' and '' in _fields:
+        return None
+    elif _type not in ['ACK', 'MYID', 'RFID']:
+        try:
+            [float(ii) for ii in _fields]
+        except ValueError:
+            return None
+    if _type in ['MYPOS', 'MYPRES', 'MYMAXV', 'COL', 'DOBS']:
+        return [float(ii) for ii in _fields]
+    elif _type == 'ACK':
+        return [int(_fields[0])] if _fields[0] else [None]
+    return _fields
+
+
+def legacy_cmd(version, instr):
+    '''Validation steps of the older Rover.clean_send'''
+    _valid, _type, _fields = legacy_cmdparse(version, 'cmd', instr)
+    if not _valid:
+        return None
+    if _type in ['SETPOS', 'SETPRES', 'HEART', 'CFWD', 'CBWD', 'FWD', 'BWD',
+                 'TURN', 'ATURN', 'CTURN', 'GOTO', 'OBS', 'POBS']:
+        _fields[-1] = '0' if _fields[-1] == '' else _fields[-1]
+    if _type in ['FWD', 'BWD', 'CFWD', 'CBWD', 'GOTO', 'OBS', 'POBS']:
+        _fields[-2] = '0' if _fields[-2] == '' else _fields[-2]
+    if _type == 'GOTO':
+        _fields[-3] = '0' if _fields[-3] == '' else _fields[-3]
+    if _type in ['SEARCH']:
+        _fields[0] = '0' if _fields[0] == '' else _fields[0]
+        _fields[1] = '0'
+    try:
+        return [float(ii) for ii in _fields]
+    except ValueError:
+        return None
+
+
+def run_legacy(version, msgs, cmds):
+    for instr in msgs:
+        legacy_msg(version, instr)
+    for instr in cmds:
+        legacy_cmd(version, instr)
+
+
+def run_registry(version, msgs, cmds):
+    for instr in msgs:
+        protoparse(version, 'msg', instr)
+    for instr in cmds:
+        protoparse(version, 'cmd', instr)
+
+
+if __name__ == '__main__':
+    number = 100000
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:", ["number="])
+    except getopt.GetoptError:
+        print('usage: python ', sys.argv[0], '[-n|--number <messages>]')
+        sys.exit(0)
+    for opt, arg in opts:
+        if opt in ["-n", "--number"]:
+            number = int(arg)
+
+    mypos = ['<MYPOS,%.3f,%.3f,%.3f>' % (0.01*ii, -0.01*ii, ii % 360)
+             for ii in range(number)]
+    mixed = (['<MYPOS,1.000,2.000,90.000>', '<ACK,1>', '<ACK,>',
+              '<MYID,Ronin1,0_RFID>', '<COL,0.5,0.5>', '<DOBS,1.25>',
+              '<RFID,1.0,2.0,DEADBEEF>', '<BOGUS,1>', '<MYPOS,1,,3>'] *
+             (number//9 + 1))[:number]
+    cmds = (['<GOTO,1.0,2.0,,,>', '<HEART,>', '<FWD,0.5,0.2,>', '<HALT>',
+             '<TURN,90,>', '<SEARCH,0.05,,10>', '<SETPOS,0,0,90>'] *
+            (number//7 + 1))[:number]
+    cases = [('MYPOS only', mypos, []),
+             ('mixed messages', mixed, []),
+             ('commands', [], cmds)]
+    print('%-16s %14s %14s %8s' % ('stream', 'legacy', 'protoparse',
+                                   'speedup'))
+    for label, msgs, _cmds in cases:
+        t_old = timeit(run_legacy, '0_RFID', msgs, _cmds)[0]
+        t_new = timeit(run_registry, '0_RFID', msgs, _cmds)[0]
+        print('%-16s %10.0f k/s %10.0f k/s %7.1fx' % (
+            label, 1e-3*number/t_old, 1e-3*number/t_new, t_old/t_new))
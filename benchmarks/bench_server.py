@@ -0,0 +1,348 @@
+# End-to-end benchmark of a headless server_daimyo.py driven by a fleet of
+# virtual rovers (dummy_fleet_v0.py). Results are written to a JSON file.
+import socket
+import sys
+import os
+import re
+import ast
+import json
+import getopt
+import logging
+import platform
+import tempfile
+import subprocess
+import numpy as np
+from time import time, sleep
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+from dummy_fleet_v0 import Fleet  # noqa: E402
+
+clocktick = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+class TimedFleet(Fleet):
+    '''Fleet that notes when each rover received each command'''
+
+    def __init__(self, *args, **kwargs):
+        self.arrivals = []  # (time, rover index, command)
+        Fleet.__init__(self, *args, **kwargs)
+
+    def respond_to_server_cmd(self, ii, servercommand):
+        self.arrivals.append((time(), ii, servercommand))
+        Fleet.respond_to_server_cmd(self, ii, servercommand)
+
+    def arrived(self, command, since=0.0):
+        '''Rover index -> first arrival time of 'command' after 'since' '''
+        _times = {}
+        for _t, ii, _command in self.arrivals:
+            if _command == command and _t >= since and ii not in _times:
+                _times[ii] = _t
+        return _times
+
+
+class ServerProcess:
+    '''server_daimyo.py (no webUI) in a subprocess, driven through its
+    console. Its output goes to server.out in the working directory.'''
+
+    def __init__(self, engine='threaded', port=8081):
+        self.pid = None
+        self.outfile = open('server.out', 'w')
+        self.proc = subprocess.Popen(
+            [sys.executable, '-u', '-W', 'ignore',
+             os.path.join(root, 'server_daimyo.py'), '-e', engine,
+             '-p', str(port), '-b', '0'],  # No heartbeat budget
+            stdin=subprocess.PIPE, stdout=self.outfile,
+            stderr=subprocess.STDOUT, text=True)
+        self.pid = self.proc.pid
+        self.infile = open('server.out', 'r')
+
+    def read(self):
+        return self.infile.read()
+
+    def check(self):
+        '''Raise RuntimeError, with the end of server.out, if the server
+        has exited'''
+        if self.proc.poll() is None:
+            return
+        with open('server.out') as _fp:
+            _tail = _fp.read().splitlines()[-20:]
+        raise RuntimeError('server_daimyo.py exited with status %d:\n%s' % (
+            self.proc.returncode, '\n'.join(_tail)))
+
+    def send(self, line):
+        self.proc.stdin.write(line+'\n')
+        self.proc.stdin.flush()
+
+    def rss_kb(self):
+        '''Resident set size (kB) from /proc, or None'''
+        try:
+            with open('/proc/%d/status' % self.pid) as _fp:
+                for line in _fp:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return None
+
+    def cpu(self):
+        '''User+system CPU seconds from /proc, or None'''
+        try:
+            with open('/proc/%d/stat' % self.pid) as _fp:
+                _fields = _fp.read().rsplit(')', 1)[1].split()
+        except OSError:
+            return None
+        return (int(_fields[11]) + int(_fields[12]))/clocktick
+
+    def quit(self, timeout=30):
+        self.send('quit')
+        try:
+            self.proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self.outfile.close()
+        self.infile.close()
+
+
+def pump(fleet, seconds, tick=0.01):
+    '''Serve the fleet for 'seconds' (the server runs meanwhile)'''
+    fleet.run(tick, seconds)
+
+
+def console(server, fleet, line, expect=None, timeout=10.0):
+    '''Type 'line' into the server console. Returns its output, waiting
+    until 'expect' (regular expression) matches if given'''
+    server.send(line)
+    _out = ''
+    _t0 = time()
+    while True:
+        pump(fleet, 0.05)
+        _out += server.read()
+        if expect is None or re.search(expect, _out) or \
+                time() - _t0 > timeout:
+            return _out
+
+
+def write_seq(filename, lines, loopflag=False):
+    with open(filename, 'w') as _fp:
+        _fp.write(json.dumps(dict([('loopflag', loopflag), ('start', 0)])))
+        _fp.write('\n'+'\n'.join(lines)+'\n')
+    return os.path.abspath(filename)
+
+
+def summary(values):
+    '''count, p50, p99 and max of 'values' (s), in ms'''
+    if not len(values):
+        return dict([('count', 0), ('p50', None), ('p99', None),
+                     ('max', None)])
+    _ms = 1e3*np.array(values)
+    return dict([('count', len(_ms)), ('p50', np.percentile(_ms, 50)),
+                 ('p99', np.percentile(_ms, 99)), ('max', _ms.max())])
+
+
+def written(text):
+    '''Records written, from output of the 'datalog' console command'''
+    _found = re.findall(r'(\d+) written', text)
+    return int(_found[-1]) if _found else 0
+
+
+def run_bench(engine='threaded', numrovers=100, seconds=10.0, heart=20,
+              repeat=20):
+    results = dict([('engine', engine), ('rovers', numrovers),
+                    ('seconds', seconds), ('heart_ms', heart),
+                    ('python', platform.python_version()),
+                    ('platform', platform.platform())])
+    _probe = socket.socket()
+    _probe.bind(('localhost', 0))
+    port = _probe.getsockname()[1]
+    _probe.close()
+    server = ServerProcess(engine, port)
+    _t0 = time()
+    _out = ''
+    while 'Running' not in _out and time() - _t0 < 60 and \
+            server.proc.poll() is None:
+        sleep(0.1)
+        _out += server.read()
+    sleep(0.5)
+    server.check()  # Not started (import error, port in use, ...)
+    rss0 = server.rss_kb()
+
+    # 1. Connect rovers, and wait until the server knows all their names
+    _t0 = time()
+    fleet = TimedFleet(numrovers, 'localhost', port)
+    results['connect_s'] = time() - _t0
+    threadnames = {}
+    _t0 = time()
+    while len(threadnames) < numrovers and time() - _t0 < 30:
+        for line in console(server, fleet, 'names').splitlines():
+            if line.startswith('['):
+                [_name, _version, _thread] = ast.literal_eval(line)
+                if _name in fleet.names:
+                    threadnames[_name] = _thread
+        pump(fleet, 0.5)
+    results['connected'] = len(threadnames)
+    pump(fleet, 1.0)
+    rss1 = server.rss_kb()
+    if rss0 is not None and rss1 is not None:
+        results['rss_kb_per_rover'] = (rss1 - rss0)/max(1, numrovers)
+
+    # 2. Console-to-rover latency of broadcast commands
+    _latency = []
+    for ii in range(repeat):
+        _t0 = time()
+        server.send('<PRES>')
+        while time() - _t0 < 5.0:
+            pump(fleet, 0.01)
+            _times = fleet.arrived('<PRES>', _t0)
+            if len(_times) >= fleet.alive.sum():
+                break
+        _latency.extend(_t - _t0 for _t in _times.values())
+        pump(fleet, 0.1)
+    results['command_latency_ms'] = summary(_latency)
+
+    # 3. Command -> ACK -> next command round trip, in sequences. The
+    # second SETPRES is sent once the server has the ACK of the first.
+    _seq = write_seq('roundtrip.seq', ['<SETPRES,0.011,1>',
+                                       '<SETPRES,0.012,1>', '<WAIT,0.5>'],
+                     loopflag=True)
+    _t0 = time()
+    for _name, _thread in threadnames.items():
+        console(server, fleet, 'SEQ:%s:%s:%s' % (_name, _thread, _seq))
+    pump(fleet, seconds)
+    console(server, fleet, '<HALT>')
+    _last = {}
+    _roundtrip = []
+    for _t, ii, _command in fleet.arrivals:
+        if _t < _t0:
+            continue
+        if _command == '<SETPRES,0.012,1>' and ii in _last:
+            _roundtrip.append(_t - _last.pop(ii))
+        elif _command == '<SETPRES,0.011,1>':
+            _last[ii] = _t
+    results['ack_roundtrip_ms'] = summary(_roundtrip)
+
+    # 4. SYN broadcast fan-out. The first rover's sequence broadcasts
+    # right after the ACK of its first command. Every other rover's
+    # sequence sends a command once it hears the broadcast. (Listening
+    # starts after one command, as the ACK of the <HALT> sent when a
+    # sequence is loaded would end the st_LISTEN state.)
+    _listen = write_seq('listen.seq', ['<SETPRES,0.015,1>', '<LIS,bench>',
+                                       '<SETPRES,0.013,1>'])
+    _publish = write_seq('publish.seq', ['<SETPRES,0.014,1>',
+                                         '<SYN,bench>'])
+    _names = [_name for _name in fleet.names if _name in threadnames]
+    for _name in _names[1:]:
+        console(server, fleet, 'SEQ:%s:%s:%s' % (
+            _name, threadnames[_name], _listen))
+    pump(fleet, 1.0)
+    _t0 = time()
+    console(server, fleet, 'SEQ:%s:%s:%s' % (
+        _names[0], threadnames[_names[0]], _publish))
+    while time() - _t0 < 10.0:
+        _heard = fleet.arrived('<SETPRES,0.013,1>', _t0)
+        if len(_heard) >= len(_names) - 1:
+            break
+        pump(fleet, 0.05)
+    _start = fleet.arrived('<SETPRES,0.014,1>', _t0).get(0)
+    if _start is not None:
+        results['syn_fanout_ms'] = summary(
+            [_t - _start for _t in _heard.values()])
+        results['syn_heard'] = len(_heard)
+
+    # 5. MYPOS ingest. All rovers turn and send heartbeats every 'heart' ms.
+    # A fine precision, so that no heartbeat falls in the dead-band.
+    console(server, fleet, '<SETPRES,0.001,0.01>')
+    console(server, fleet, '<PRES>')
+    console(server, fleet, '<CTURN,0,>')
+    pump(fleet, 2.0)  # Let the datalog writer commit
+    _before = written(console(server, fleet, 'datalog', 'written'))
+    server.send('<HEART,%d>' % heart)
+    _sent = fleet.sent
+    _cpu = server.cpu()
+    _t0 = time()
+    pump(fleet, seconds, tick=min(0.01, heart*1e-3))
+    _window = time() - _t0
+    _sent = fleet.sent - _sent
+    if _cpu is not None:
+        results['ingest_server_cpu'] = (server.cpu() - _cpu)/_window
+    console(server, fleet, '<SILENT>')
+    pump(fleet, 3.0)
+    _processed = written(console(server, fleet, 'datalog', 'written')) - \
+        _before
+    console(server, fleet, '<HALT>')
+    results['ingest'] = dict([('offered_msg_s', _sent/_window),
+                              ('processed_msg_s', _processed/_window),
+                              ('processed_ratio', _processed/max(1, _sent))])
+
+    # 6. Main loop time per pass (outside select())
+    _out = console(server, fleet, 'loop', 'Main loop')
+    _found = re.search(r'(\d+) iterations, ([\d.]+) ms mean, ([\d.]+) ms max',
+                       _out)
+    if _found:
+        results['main_loop'] = dict([('iterations', int(_found.group(1))),
+                                     ('mean_ms', float(_found.group(2))),
+                                     ('max_ms', float(_found.group(3)))])
+    fleet.shutdown()
+    server.quit()
+    return results
+
+
+if __name__ == '__main__':
+    engine = 'threaded'
+    numrovers = 100
+    seconds = 10.0
+    heart = 20
+    outfile = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "e:n:s:r:o:",
+                                   ["engine=", "number=", "seconds=",
+                                    "heart=", "output="])
+    except getopt.GetoptError:
+        print('usage: python ', sys.argv[0],
+              '[-e|--engine <threaded|asyncio>] [-n|--number <rovers>] '
+              '[-s|--seconds <per phase>] [-r|--heart <period (ms)>] '
+              '[-o|--output <results.json>]')
+        sys.exit(0)
+    for opt, arg in opts:
+        if opt in ["-e", "--engine"]:
+            engine = arg
+        elif opt in ["-n", "--number"]:
+            numrovers = int(arg)
+        elif opt in ["-s", "--seconds"]:
+            seconds = float(arg)
+        elif opt in ["-r", "--heart"]:
+            heart = int(arg)
+        elif opt in ["-o", "--output"]:
+            outfile = arg
+    if outfile is None:
+        outfile = 'bench_server_%s_%d.json' % (engine, numrovers)
+    outfile = os.path.abspath(outfile)
+    logging.basicConfig(level=logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix='daimyo_bench_')
+    os.chdir(workdir)  # Server writes logs and datalogs/ relative to here
+    results = run_bench(engine, numrovers, seconds, heart)
+    with open(outfile, 'w') as _fp:
+        json.dump(results, _fp, indent=2)
+
+    print('%s engine, %d rovers (%d connected in %.1f s)' % (
+        engine, numrovers, results['connected'], results['connect_s']))
+    for key in ['command_latency_ms', 'ack_roundtrip_ms', 'syn_fanout_ms']:
+        if key in results and results[key]['count']:
+            print('%-20s p50 %8.2f  p99 %8.2f  max %8.2f  (n=%d)' % (
+                key, results[key]['p50'], results[key]['p99'],
+                results[key]['max'], results[key]['count']))
+    print('%-20s offered %.0f msg/s, processed %.0f msg/s (%.0f%%)' % (
+        'MYPOS ingest', results['ingest']['offered_msg_s'],
+        results['ingest']['processed_msg_s'],
+        100*results['ingest']['processed_ratio']))
+    if 'ingest_server_cpu' in results:
+        print('%-20s %.1f%% of one core during ingest' % (
+            'server CPU', 100*results['ingest_server_cpu']))
+    if 'main_loop' in results:
+        print('%-20s %d passes, mean %.3f ms, max %.3f ms' % (
+            'main loop', results['main_loop']['iterations'],
+            results['main_loop']['mean_ms'], results['main_loop']['max_ms']))
+    if 'rss_kb_per_rover' in results:
+        print('%-20s %.1f kB' % ('memory per rover',
+                                 results['rss_kb_per_rover']))
+    print('Results written to %s' % outfile)
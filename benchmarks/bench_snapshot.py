@@ -0,0 +1,135 @@
+# webUI tick time with a fleet of rovers on heartbeat, reading rover fields
+# under mainlock and every rover.lock (as update() did) or from the fleet
+# and rover snapshots
+import sys
+import os
+import getopt
+import threading
+from time import time, perf_counter, sleep
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from daimyo_utils import Waker  # noqa: E402
+from daimyo_async import AsyncEngine  # noqa: E402
+from daimyo_datalog import DatalogWriter  # noqa: E402
+from _fleet import scratch_dir, make_fleet, close_fleet  # noqa: E402
+from _fleet import field, commands  # noqa: E402
+
+
+def main_loop(rovers, mainlock, upwaker, stop):
+    '''Step 3 of the server main loop: passed-upstream messages'''
+    while not stop.is_set():
+        upwaker.drain()
+        sleep(0.01)
+        mainlock.acquire()
+        for rover in rovers:
+            if rover.alive and rover.sflag:
+                rover.sflag = False
+                while rover.smsg_buffer:
+                    rover.smsg_buffer.pop(0)
+        mainlock.release()
+
+
+def tick_locked(rovers, mainlock):
+    mainlock.acquire()
+    rows = []
+    for rover in rovers:
+        rover.lock.acquire()
+        rows.append((rover.name, rover.thread.getName(), rover.x, rover.y,
+                     rover.angle, rover.state))
+        rover.wevents.drain()
+        rover.lock.release()
+    mainlock.release()
+    return rows
+
+
+def tick_snapshot(fleetview, mainlock):
+    rows = []
+    for rover in fleetview:
+        snap = rover.snapshot
+        rows.append((snap.name, snap.thread, snap.x, snap.y, snap.angle,
+                     snap.state))
+        rover.wevents.drain()
+    return rows
+
+
+def run(mode, rovers, seconds, period):
+    '''Ticks every 'period' ms for 'seconds'. Returns durations (s).'''
+    mainlock = threading.RLock()
+    fleetview = tuple(rovers)
+    tick = tick_locked if mode == 'locked' else tick_snapshot
+    durations = []
+    t_end = time() + seconds
+    while time() < t_end:
+        t0 = perf_counter()
+        tick(rovers if mode == 'locked' else fleetview, mainlock)
+        durations.append(perf_counter() - t0)
+        sleep(1e-3*period)
+    return durations
+
+
+if __name__ == '__main__':
+    number = 500
+    enginetype = 'asyncio'  # Rover threads select() fds below 1024 only
+    heart = 500
+    seconds = 10.0
+    period = 100
+    cmdperiod = 1.0
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:e:r:s:p:c:",
+                                   ["number=", "engine=", "heart=",
+                                    "seconds=", "period=", "commands="])
+    except getopt.GetoptError:
+        print('usage: python ', sys.argv[0], '[-n|--number <rovers>] '
+              '[-e|--engine <asyncio|threaded>] [-r|--heart <ms>] '
+              '[-s|--seconds <per mode>] [-p|--period <tick ms>] '
+              '[-c|--commands <ms between>]')
+        sys.exit(0)
+    for opt, arg in opts:
+        if opt in ["-n", "--number"]:
+            number = int(arg)
+        elif opt in ["-e", "--engine"]:
+            enginetype = arg
+        elif opt in ["-r", "--heart"]:
+            heart = int(arg)
+        elif opt in ["-s", "--seconds"]:
+            seconds = float(arg)
+        elif opt in ["-p", "--period"]:
+            period = int(arg)
+        elif opt in ["-c", "--commands"]:
+            cmdperiod = float(arg)
+
+    scratch_dir()
+    datalog = DatalogWriter()
+    datalog.start()
+    upwaker = Waker()
+    engine = None
+    if enginetype == 'asyncio':
+        engine = AsyncEngine()
+        engine.start()
+    rovers, peers = make_fleet(number, engine, datalog=datalog,
+                               upwaker=upwaker)
+    stop = threading.Event()
+    mainlock = threading.RLock()
+    load = [threading.Thread(target=field, args=(peers, heart, stop)),
+            threading.Thread(target=commands, args=(rovers, cmdperiod,
+                                                    stop)),
+            threading.Thread(target=main_loop, args=(rovers, mainlock,
+                                                     upwaker, stop))]
+    for thread in load:
+        thread.start()
+    sleep(1.0)
+    print('%d rovers (%s), MYPOS every %d ms (%.0f msg/s), a command '
+          'every %g ms' % (number, enginetype, heart, 1e3*number/heart,
+                           cmdperiod))
+    print('%-10s %9s %9s %9s %7s' % ('tick', 'p50 ms', 'p99 ms', 'max ms',
+                                     'ticks'))
+    for mode in ['locked', 'snapshot']:
+        durations = 1e3*np.array(run(mode, rovers, seconds, period))
+        print('%-10s %9.3f %9.3f %9.3f %7d' % (
+            mode, np.percentile(durations, 50),
+            np.percentile(durations, 99), durations.max(), len(durations)))
+    stop.set()
+    for thread in load:
+        thread.join()
+    close_fleet(rovers, peers, engine)
+    datalog.stop()
@@ -0,0 +1,70 @@
+# Cost of relaying one SYN broadcast: the older lock-every-rover relay in
+# the server main loop against SynBus.publish()
+import sys
+import os
+import getopt
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from daimyo_utils import SynBus  # noqa: E402
+from _fleet import scratch_dir, make_fleet, close_fleet  # noqa: E402
+from _timing import timeit  # noqa: E402
+
+
+def legacy_relay(rovers, sender, topic):
+    '''Main loop relay as it was: append to every other rover's syn_str'''
+    for rover in rovers:
+        if rover is not sender:
+            rover.lock.acquire()
+            rover.syn_str.append(topic)
+            if len(rover.syn_str) > 10:
+                rover.syn_str.pop(0)
+            rover.lock.release()
+            rover.wake()
+
+
+def make_rovers(number, listeners, bus):
+    rovers, socks = make_fleet(number, threaded=False, synbus=bus)
+    for rover in rovers:
+        rover.syn_str = []
+    for rover in rovers[1:listeners+1]:
+        rover.listen_str = set(['x'])
+    return rovers, socks
+
+
+if __name__ == '__main__':
+    sizes = [10, 100, 500]
+    listeners = 5
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:l:",
+                                   ["number=", "listeners="])
+    except getopt.GetoptError:
+        print('usage: python ', sys.argv[0],
+              '[-n|--number <rovers,...>] [-l|--listeners <listeners>]')
+        sys.exit(0)
+    for opt, arg in opts:
+        if opt in ["-n", "--number"]:
+            sizes = [int(ii) for ii in arg.split(',')]
+        elif opt in ["-l", "--listeners"]:
+            listeners = int(arg)
+
+    scratch_dir()
+
+    print('%d rovers listening for the topic' % listeners)
+    print('%-7s %14s %14s %14s' % ('rovers', 'relay (us/SYN)',
+                                   'SynBus (us/SYN)', 'rover locks'))
+    for number in sizes:
+        bus = SynBus()
+        rovers, socks = make_rovers(number, listeners, bus)
+
+        def bus_publish():
+            for rover in rovers[1:listeners+1]:
+                bus.listen(rover, rover.listen_str)  # Listen again
+            bus.publish('x', rovers[0])
+
+        t_old = timeit(legacy_relay, rovers, rovers[0], 'x', repeat=1,
+                       number=200)[0]
+        t_new = timeit(bus_publish, repeat=1, number=200)[0]
+        print('%-7d %14.1f %14.1f %8d -> %d' % (
+            number, 1e6*t_old, 1e6*t_new, number-1, 0))
+        close_fleet(rovers, socks)
+        for rover in rovers:
+            rover.waker.close()
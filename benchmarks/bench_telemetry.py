@@ -0,0 +1,76 @@
+# Server-side MYPOS ingest rate for ASCII and binary ('0_BIN') telemetry
+import sys
+import os
+import getopt
+from time import process_time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from daimyo_utils import TCPframer, protoparse  # noqa: E402
+from daimyo_utils import binpack, binsizes  # noqa: E402
+from _fleet import scratch_dir, make_fleet, close_fleet  # noqa: E402
+from _timing import timeit, chop  # noqa: E402
+
+
+def make_stream(mode='ascii', number=100000):
+    '''Heartbeat stream of a rover turning in place at 45 deg./s'''
+    frames = []
+    for ii in range(number):
+        [x, y, a] = [0.001*ii, -0.001*ii, (0.45*ii) % 360]
+        if mode == 'binary':
+            frames.append(binpack('MYPOS', x, y, a))
+        else:
+            frames.append(('<MYPOS,%.3f,%.3f,%.3f>' % (x, y, a)).encode())
+    return b''.join(frames)
+
+
+def run_decode(version, packets):
+    '''Framing and field decoding only'''
+    framer = TCPframer(binary=binsizes())
+    for packet in packets:
+        for frame in framer.feed(packet):
+            protoparse(version, 'msg', frame)
+
+
+def run_rover(version, packets):
+    '''Rover.receive() and Rover.chug(), including datalog hand-off'''
+    rovers, peers = make_fleet(1, threaded=False)
+    rover = rovers[0]
+    rover.version = version
+    for packet in packets:
+        rover.receive(packet)
+        rover.chug()
+    close_fleet(rovers, peers)
+
+
+def rate(func, version, packets, number, repeat=3):
+    '''Best messages per CPU-second'''
+    return number/timeit(func, version, packets, repeat=repeat,
+                         clock=process_time)[0]
+
+
+if __name__ == '__main__':
+    number = 100000
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:", ["number="])
+    except getopt.GetoptError:
+        print('usage: python ', sys.argv[0], '[-n|--number <messages>]')
+        sys.exit(0)
+    for opt, arg in opts:
+        if opt in ["-n", "--number"]:
+            number = int(arg)
+
+    scratch_dir()
+
+    print('%-7s %8s %12s %16s %16s' % ('mode', 'version', 'bytes/msg',
+                                        'decode (msg/s)', 'Rover (msg/s)'))
+    results = {}
+    for mode, version in [('ascii', '0'), ('binary', '0_BIN')]:
+        stream = make_stream(mode, number)
+        packets = chop(stream)
+        results[mode] = [rate(run_decode, version, packets, number),
+                         rate(run_rover, version, packets, number)]
+        print('%-7s %8s %12.1f %16.0f %16.0f' % (
+            mode, version, len(stream)/number, results[mode][0],
+            results[mode][1]))
+    print('binary/ascii: decode %.2fx, Rover %.2fx (single core)' % (
+        results['binary'][0]/results['ascii'][0],
+        results['binary'][1]/results['ascii'][1]))
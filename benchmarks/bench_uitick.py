@@ -0,0 +1,152 @@
+# webUI tick latency under rover-thread load, with and without the
+# sys.settrace() hook that the older thread_with_trace installed
+import sys
+import os
+import getopt
+import threading
+import asyncio
+from time import perf_counter, sleep
+import numpy as np
+from tornado.ioloop import IOLoop, PeriodicCallback
+from bokeh.document import Document
+from bokeh.models import ColumnDataSource
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from daimyo_utils import protoparse  # noqa: E402
+from bench_webui import rover_rows, message_bytes  # noqa: E402
+
+
+class thread_with_trace(threading.Thread):
+    '''The webUI thread class as it was (for comparison)'''
+    def __init__(self, *args, **keywords):
+        threading.Thread.__init__(self, *args, **keywords)
+        self.killed = False
+
+    def start(self):
+        self.__run_backup = self.run
+        self.run = self.__run
+        threading.Thread.start(self)
+
+    def __run(self):
+        sys.settrace(self.globaltrace)
+        self.__run_backup()
+        self.run = self.__run_backup
+
+    def globaltrace(self, frame, event, arg):
+        if event == 'call':
+            return self.localtrace
+        else:
+            return None
+
+    def localtrace(self, frame, event, arg):
+        if self.killed:
+            if event == 'line':
+                raise SystemExit()
+        return self.localtrace
+
+    def kill(self):
+        self.killed = True
+
+
+def rover_load(stop):
+    '''Stand-in for a busy rover thread'''
+    while not stop.is_set():
+        for ii in range(100):
+            protoparse('0', 'msg', '<MYPOS,1.000,2.000,90.000>')
+        sleep(0.001)
+
+
+def ui_loop(number, period, ticks, lateness, durations, state):
+    '''IOLoop with one periodic callback doing a webUI tick: patch the
+    positions of 'number' rovers and serialize the websocket message'''
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    loop = IOLoop.current()
+    state['loop'] = loop
+    doc = Document()
+    data_s = ColumnDataSource(rover_rows(number, False))
+    doc.add_root(data_s)
+    events = []
+    doc.on_change(lambda event: events.append(event))
+    state['next'] = perf_counter() + 1e-3*period
+
+    def tick():
+        t0 = perf_counter()
+        if len(durations) < ticks:
+            lateness.append(t0 - state['next'])
+        state['next'] = t0 + 1e-3*period
+        xy = np.random.uniform(-5, 5, (number, 2))
+        data_s.patch(dict([('x', [(ii, xy[ii, 0]) for ii in range(number)]),
+                           ('y', [(ii, xy[ii, 1]) for ii in range(number)])]))
+        message_bytes(events)
+        events.clear()
+        if len(durations) < ticks:
+            durations.append(perf_counter() - t0)
+        else:
+            state['done'].set()
+
+    PeriodicCallback(tick, period).start()
+    loop.start()
+    loop.close()
+
+
+def run(mode, number, loads, period, ticks):
+    stop = threading.Event()
+    workers = [threading.Thread(target=rover_load, args=(stop,))
+               for ii in range(loads)]
+    for worker in workers:
+        worker.start()
+    lateness = []
+    durations = []
+    state = dict([('done', threading.Event())])
+    args = (number, period, ticks, lateness, durations, state)
+    if mode == 'settrace':
+        ui = thread_with_trace(target=ui_loop, args=args)
+    else:
+        ui = threading.Thread(target=ui_loop, args=args)
+    ui.start()
+    state['done'].wait()
+    t0 = perf_counter()
+    if mode == 'settrace':
+        ui.kill()
+    else:
+        state['loop'].add_callback(state['loop'].stop)
+    ui.join(10)
+    t_stop = perf_counter() - t0 if not ui.is_alive() else float('nan')
+    stop.set()
+    for worker in workers:
+        worker.join()
+    return (1e3*np.percentile(durations, [50, 99]),
+            1e3*np.percentile(lateness, [50, 99]), 1e3*t_stop)
+
+
+if __name__ == '__main__':
+    number = 50
+    loads = 50
+    period = 100
+    ticks = 100
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:l:p:t:",
+                                   ["number=", "load=", "period=",
+                                    "ticks="])
+    except getopt.GetoptError:
+        print('usage: python ', sys.argv[0],
+              '[-n|--number <rovers in UI>] [-l|--load <busy threads>] '
+              '[-p|--period <tick ms>] [-t|--ticks <ticks>]')
+        sys.exit(0)
+    for opt, arg in opts:
+        if opt in ["-n", "--number"]:
+            number = int(arg)
+        elif opt in ["-l", "--load"]:
+            loads = int(arg)
+        elif opt in ["-p", "--period"]:
+            period = int(arg)
+        elif opt in ["-t", "--ticks"]:
+            ticks = int(arg)
+
+    print('%d rovers in UI, %d busy rover threads, %d ms ticks' % (
+        number, loads, period))
+    print('%-9s %20s %20s %12s' % ('UI thread', 'tick p50/p99 (ms)',
+                                   'late p50/p99 (ms)', 'stop (ms)'))
+    for mode in ['settrace', 'plain']:
+        tick, late, t_stop = run(mode, number, loads, period, ticks)
+        print('%-9s %9.2f/%-10.2f %9.2f/%-10.2f %12.1f' % (
+            mode, tick[0], tick[1], late[0], late[1], t_stop))
@@ -0,0 +1,142 @@
+# Command-to-wire and rover-to-main-thread latency, and idle CPU, with
+# select() polling (as before) and with Waker wakeups
+import select
+import sys
+import os
+import getopt
+import threading
+import random
+from time import perf_counter, process_time, time, sleep
+import numpy as np
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from daimyo_utils import Waker  # noqa: E402
+from _fleet import scratch_dir, make_fleet, close_fleet  # noqa: E402
+
+buckets = [0.1, 0.3, 1, 3, 10, 30, 100]  # Histogram bin edges (ms)
+
+
+def connect(number, mode):
+    '''Threaded rovers on socket pairs. In 'poll' mode, nothing is woken
+    up and rovers (and the main loop) poll every 0.1 s, as they used to.'''
+    upwaker = Waker()
+    rovers, fields = make_fleet(number, upwaker=(upwaker if mode == 'wake'
+                                                 else None))
+    if mode == 'poll':
+        for rover in rovers:
+            rover._idle_timeout = 0.1
+    return rovers, fields, upwaker
+
+
+def main_loop(rovers, upwaker, mode, seen, stop):
+    '''The part of the server main loop that picks up sflag'''
+    while not stop.is_set():
+        inl, outl, exl = select.select([upwaker], [], [],
+                                       0.1 if mode == 'poll' else 1.0)
+        if upwaker in inl:
+            upwaker.drain()
+        for rover in rovers:
+            if rover.sflag:
+                rover.lock.acquire()
+                rover.smsg_buffer = []
+                rover.sflag = False
+                rover.lock.release()
+                seen.append(perf_counter())
+
+
+def command_latency(rovers, fields, mode, trials):
+    '''Time from queueing a command for the rover to the bytes arriving at
+    the field end of the connection'''
+    latency = []
+    for ii in range(trials):
+        jj = random.randrange(len(rovers))
+        rover = rovers[jj]
+        t0 = perf_counter()
+        rover.commands.put('<HALT>')
+        if mode == 'wake':
+            rover.wake()
+        select.select([fields[jj]], [], [], 2.0)
+        latency.append(perf_counter() - t0)
+        fields[jj].recv(2048)
+        sleep(random.uniform(0, 0.1))  # Don't stay in phase with polls
+    return 1e3*np.array(latency)
+
+
+def upstream_latency(rovers, fields, upwaker, mode, trials):
+    '''Time from a field rover sending <TIMEOUT> to the main loop seeing
+    the rover's sflag'''
+    seen = []
+    stop = threading.Event()
+    thread = threading.Thread(target=main_loop,
+                              args=(rovers, upwaker, mode, seen, stop))
+    thread.start()
+    latency = []
+    for ii in range(trials):
+        jj = random.randrange(len(rovers))
+        _number = len(seen)
+        t0 = perf_counter()
+        fields[jj].send(b'<TIMEOUT>')
+        while len(seen) == _number and perf_counter() - t0 < 2.0:
+            sleep(0.00005)
+        latency.append(seen[-1] - t0)
+        sleep(random.uniform(0, 0.1))
+    stop.set()
+    upwaker.wake()
+    thread.join()
+    return 1e3*np.array(latency)
+
+
+def idle_cpu(seconds):
+    c0 = process_time()
+    w0 = time()
+    sleep(seconds)
+    return (process_time() - c0)/(time() - w0)
+
+
+def histogram(latency):
+    counts = np.histogram(latency, [0]+buckets+[np.inf])[0]
+    return ' '.join('%6d' % count for count in counts)
+
+
+if __name__ == '__main__':
+    number = 100
+    trials = 200
+    seconds = 5.0
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:t:s:",
+                                   ["number=", "trials=", "seconds="])
+    except getopt.GetoptError:
+        print('usage: python ', sys.argv[0],
+              '[-n|--number <rovers>] [-t|--trials <trials>] '
+              '[-s|--seconds <idle seconds>]')
+        sys.exit(0)
+    for opt, arg in opts:
+        if opt in ["-n", "--number"]:
+            number = int(arg)
+        elif opt in ["-t", "--trials"]:
+            trials = int(arg)
+        elif opt in ["-s", "--seconds"]:
+            seconds = float(arg)
+
+    scratch_dir()
+
+    print('%d connected rovers, %d trials' % (number, trials))
+    print('%-5s %-9s %8s %8s   %s' % (
+        'mode', 'path', 'p50 (ms)', 'p99 (ms)',
+        ' '.join('%6s' % ('<%g' % edge) for edge in buckets) +
+        '   >100'))
+    cpu = {}
+    for mode in ['poll', 'wake']:
+        rovers, fields, upwaker = connect(number, mode)
+        sleep(0.5)
+        cpu[mode] = idle_cpu(seconds)
+        for path, latency in [
+                ('command', command_latency(rovers, fields, mode, trials)),
+                ('upstream', upstream_latency(rovers, fields, upwaker, mode,
+                                              trials))]:
+            print('%-5s %-9s %8.3f %8.3f   %s' % (
+                mode, path, np.percentile(latency, 50),
+                np.percentile(latency, 99), histogram(latency)))
+        close_fleet(rovers, fields)
+        upwaker.close()
+    print('idle CPU (%d rovers): poll %.1f%%, wake %.1f%%' % (
+        number, 100*cpu['poll'], 100*cpu['wake']))
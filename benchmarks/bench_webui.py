@@ -0,0 +1,101 @@
+# Websocket bytes per webUI tick: full data_s replacement against patch/stream
+import sys
+import getopt
+import random
+from bokeh.document import Document
+from bokeh.models import ColumnDataSource
+from bokeh.protocol import Protocol
+
+protocol = Protocol()
+
+
+def message_bytes(events):
+    '''Size of the PATCH-DOC websocket message the Bokeh server would send
+    for 'events' (header, metadata, content and binary buffers)'''
+    if not events:
+        return 0
+    msg = protocol.create('PATCH-DOC', events)
+    return (len(msg.header_json) + len(msg.metadata_json) +
+            len(msg.content_json) +
+            sum(len(buf) for header, buf in msg.buffers))
+
+
+def rover_rows(number, trails):
+    rows = dict([('name', ['Ronin%d_____(Thread-%d)' % (ii, ii)
+                           for ii in range(number)]),
+                 ('version', ['0']*number), ('hflag', [True]*number),
+                 ('x', [0.0]*number), ('y', [0.0]*number),
+                 ('angle', [0.0]*number), ('state', ['st_IDLE']*number),
+                 ('loop', [-1]*number), ('lflag', [False]*number),
+                 ('seqfile', ['']*number), ('seqlist', [[]]*number),
+                 ('threadname', ['Thread-%d' % ii for ii in range(number)])])
+    if trails:  # Older layout: one list of trail points per rover
+        rows['xhist'] = [[0.0]*100 for ii in range(number)]
+        rows['yhist'] = [[0.0]*100 for ii in range(number)]
+    return rows
+
+
+def run(mode, number, ticks, trail_points=100):
+    '''Average bytes per tick with every rover reporting a new position
+    each tick, after trails have filled up'''
+    doc = Document()
+    rows = rover_rows(number, mode == 'replace')
+    data_s = ColumnDataSource(dict(rows))
+    data_trail = ColumnDataSource(dict([
+        ('x0', [0.0]*trail_points*number), ('y0', [0.0]*trail_points*number),
+        ('x1', [0.0]*trail_points*number), ('y1', [0.0]*trail_points*number),
+        ('threadname', ['Thread-0']*trail_points*number)]))
+    doc.add_root(data_s)
+    doc.add_root(data_trail)
+    events = []
+    doc.on_change(lambda event: events.append(event))
+    total = 0
+    for tick in range(ticks):
+        new = [(ii, random.uniform(-5, 5), random.uniform(-5, 5),
+                random.uniform(0, 360)) for ii in range(number)]
+        if mode == 'replace':
+            for ii, x, y, a in new:
+                [rows['x'][ii], rows['y'][ii], rows['angle'][ii]] = [x, y, a]
+                rows['xhist'][ii].append(x)
+                rows['yhist'][ii].append(y)
+                rows['xhist'][ii].pop(0)
+                rows['yhist'][ii].pop(0)
+            data_s.data = dict(rows)
+        else:
+            data_s.patch(dict([
+                ('x', [(ii, x) for ii, x, y, a in new]),
+                ('y', [(ii, y) for ii, x, y, a in new]),
+                ('angle', [(ii, a) for ii, x, y, a in new])]))
+            data_trail.stream(dict([
+                ('x0', [0.0]*number), ('y0', [0.0]*number),
+                ('x1', [x for ii, x, y, a in new]),
+                ('y1', [y for ii, x, y, a in new]),
+                ('threadname', ['Thread-%d' % ii for ii in range(number)])]),
+                rollover=trail_points*number)
+        total += message_bytes(events)
+        events.clear()
+    return total/ticks
+
+
+if __name__ == '__main__':
+    sizes = [1, 50, 500]
+    ticks = 10
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:t:",
+                                   ["number=", "ticks="])
+    except getopt.GetoptError:
+        print('usage: python ', sys.argv[0],
+              '[-n|--number <rovers,...>] [-t|--ticks <ticks>]')
+        sys.exit(0)
+    for opt, arg in opts:
+        if opt in ["-n", "--number"]:
+            sizes = [int(ii) for ii in arg.split(',')]
+        elif opt in ["-t", "--ticks"]:
+            ticks = int(arg)
+
+    print('%-7s %16s %16s %8s' % ('rovers', 'replace (B/tick)',
+                                  'patch (B/tick)', 'ratio'))
+    for number in sizes:
+        old = run('replace', number, ticks)
+        new = run('delta', number, ticks)
+        print('%-7d %16.0f %16.0f %7.1fx' % (number, old, new, old/new))
@@ -0,0 +1,125 @@
+import asyncio
+import threading
+import logging
+import socket
+
+
+class AsyncEngine:
+    '''
+
+    Serve every rover connection from one asyncio event loop instead of
+    one thread per rover. Rover instances must be created with
+    threaded=False. The loop runs in its own thread, so the server main
+    loop keeps accepting connections and handing them over with
+    add_rover(). Socket reads and Rover.wake() calls (new commands etc.)
+    are driven by loop.add_reader(). Timed sequence work (st_WAIT, command
+    timeouts) wakes a rover through the same Rover.wake(), from the
+    rover's TimerHeap, so nothing is polled. While commands wait in a
+    rover's send queue, loop.add_writer() flushes it.
+
+    '''
+
+    def __init__(self):
+        self.rovers = {}  # rover -> (socket, waker) file descriptors
+        self.writing = set()  # Rovers with a writer for their send queue
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run_loop,
+                                       name='AsyncEngine')
+        self.log = logging.getLogger('AsyncEngine')
+
+    def start(self):
+        self.thread.start()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        # Loop stopped. Let go of remaining sockets.
+        for rover in list(self.rovers):
+            self._detach(rover)
+        self.loop.close()
+
+    def stop(self):
+        '''Stop event loop and wait for its thread (call from other
+        threads)'''
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    def add_rover(self, rover):
+        '''Hand over a newly accepted rover (call from other threads)'''
+        self.loop.call_soon_threadsafe(self._attach, rover)
+
+    def _attach(self, rover):
+        # Forget dead rovers first, so a reused descriptor is not confused
+        # with the one that belonged to a closed connection.
+        for _rover in list(self.rovers):
+            if not _rover.alive:
+                self._detach(_rover)
+        if not rover.alive:
+            return
+        self.rovers[rover] = (rover.conn.fileno(), rover.waker.fileno())
+        self.loop.add_reader(self.rovers[rover][0], self._on_readable, rover)
+        self.loop.add_reader(self.rovers[rover][1], self._on_wake, rover)
+
+    def _detach(self, rover):
+        _fds = self.rovers.pop(rover, None)
+        if _fds is not None:
+            if rover in self.writing:
+                self.writing.discard(rover)
+                try:
+                    self.loop.remove_writer(_fds[0])
+                except OSError:  # Closed, which also unregistered it
+                    pass
+            self.loop.remove_reader(_fds[0])
+            self.loop.remove_reader(_fds[1])
+            rover.waker.close()
+
+    def _watch_output(self, rover):
+        '''Wait for the socket to be writable while commands are queued'''
+        if (rover.alive and rover.sendq and rover in self.rovers and
+                rover not in self.writing):
+            self.writing.add(rover)
+            self.loop.add_writer(self.rovers[rover][0], self._on_writable,
+                                 rover)
+
+    def _on_writable(self, rover):
+        rover.flush()
+        if not rover.alive:
+            self._detach(rover)
+        elif not rover.sendq:
+            self.writing.discard(rover)
+            self.loop.remove_writer(self.rovers[rover][0])
+
+    def _on_readable(self, rover):
+        try:
+            _inpacket = rover.conn.recv(2048)
+        except BlockingIOError:  # Nothing after all
+            return
+        except socket.error:
+            rover.die()
+        else:
+            if rover.receive(_inpacket):
+                self._chug(rover)  # Don't wait for tick to process message
+        if not rover.alive:
+            self._detach(rover)
+
+    def _on_wake(self, rover):
+        rover.waker.drain()
+        if rover.alive:
+            self._chug(rover)
+        if not rover.alive:
+            self._detach(rover)
+
+    def _chug(self, rover):
+        # An exception would only end a rover's own thread in the threaded
+        # engine. Here it must not take down the loop, so kill the rover.
+        try:
+            rover.chug()
+        except Exception:
+            self.log.exception('%s crashed.' % rover.thread.name)
+            rover.die()
+        else:
+            self._watch_output(rover)
+            if rover.alive and rover.timeout() == 0:  # Next sequence step
+                self.loop.call_soon(self._chug, rover)
+
@@ -0,0 +1,309 @@
+import threading
+import logging
+import queue
+import atexit
+import os
+import collections
+import sys
+import numpy as np
+from time import time
+
+
+# Binary position log ('pos' format). A fixed-size text header block holds
+# the same '#' comment lines as .dat files (ID history), padded with spaces
+# up to poshead bytes. Fixed-width little-endian records follow.
+poshead = 4096
+posdtype = np.dtype([('time', '<f8'), ('x', '<f4'), ('y', '<f4'),
+                     ('angle', '<f4')])
+posmagic = '# daimyo pos v1 header=%d record=%s\n' % (
+    poshead, ','.join('%s:%s' % (_name, posdtype[_name].str)
+                      for _name in posdtype.names))
+logexts = dict([('dat', '.dat'), ('pos', '.pos')])
+
+
+def posheader(lines):
+    '''Header block with the comment lines that fit (oldest ID changes are
+    dropped first, the first line is always kept)'''
+    lines = list(lines)
+    _text = posmagic+''.join(lines)
+    while len(_text.encode()) > poshead-1 and len(lines) > 1:
+        del lines[1]
+        _text = posmagic+''.join(lines)
+    # Cut on a character boundary, so read_poslog() can decode it
+    _text = _text.encode()[:poshead-1].decode('utf-8', 'ignore').encode()
+    return _text+b' '*(poshead-1-len(_text))+b'\n'
+
+
+def read_poslog(filename):
+    '''Returns (list of header comment lines, records) of a binary position
+    log. Records are a read-only numpy memmap with fields time, x, y, and
+    angle. A partly written trailing record is ignored.'''
+    with open(filename, 'rb') as _fid:
+        _header = _fid.read(poshead).decode()
+    if not _header.startswith(posmagic):
+        raise ValueError('%s is not a daimyo pos v1 file' % filename)
+    _lines = [_line+'\n' for _line in
+              _header[len(posmagic):].rstrip().split('\n') if _line]
+    _number = (os.path.getsize(filename)-poshead)//posdtype.itemsize
+    if _number <= 0:
+        return _lines, np.zeros(0, dtype=posdtype)
+    return _lines, np.memmap(filename, dtype=posdtype, mode='r',
+                             offset=poshead, shape=(_number,))
+
+
+def dat_to_poslog(datfile, posfile=None):
+    '''Convert a text .dat datalog to a binary position log. Returns the
+    name of the new file. Data lines that are not 4 numbers (e.g. cut
+    short by a crash mid-write) are skipped with a warning.'''
+    if posfile is None:
+        posfile = os.path.splitext(datfile)[0]+logexts['pos']
+    _lines = []
+    _records = []
+    _skipped = 0
+    with open(datfile, 'r') as _fid:
+        for _line in _fid:
+            if _line.startswith('#'):
+                _lines.append(_line.rstrip('\r\n')+'\n')
+            elif _line.strip():
+                try:
+                    _record = tuple(float(ii) for ii in _line.split())
+                except ValueError:
+                    _record = ()
+                if len(_record) == len(posdtype.names):
+                    _records.append(_record)
+                else:
+                    _skipped += 1
+    if _skipped:
+        logging.getLogger('DatalogWriter').warning(
+            'Skipped %d malformed line(s) in %s' % (_skipped, datfile))
+    with open(posfile, 'wb') as _fid:
+        _fid.write(posheader(_lines))
+        _fid.write(np.array(_records, dtype=posdtype).tobytes())
+    return posfile
+
+
+class DatalogWriter:
+    '''
+
+    One background thread writes the location history (datalog) files of
+    all rovers. Rover threads hand over records with write() and return
+    immediately. Every 'interval' seconds the writer drains its queue,
+    appends each file's records in one write, and flushes (group commit).
+    At most 'maxopen' files are kept open; the least recently written ones
+    are closed and reopened in append mode when needed.
+
+    Files are identified by the key that open() returns. rename() moves a
+    file (when a rover changes ID), and leaves it in place if the new name
+    is its own (only the version changed). File names already taken by
+    another open key, or existing on disk for rename(), get a '_N' suffix,
+    so two rovers never share a file. filename() gives the name used.
+
+    Records are (time, x, y, angle) tuples. 'fmt' is 'dat' for tab
+    separated text, or 'pos' for the binary format read by read_poslog().
+    Header text (open() and rename()) are '#' comment lines either way.
+
+    '''
+
+    def __init__(self, interval=1.0, maxopen=64, fmt='dat'):
+        self.interval = interval  # Seconds between group commits
+        self.maxopen = maxopen
+        self.fmt = fmt
+        self.ext = logexts[fmt]  # File name extension
+        self.queue = queue.Queue()  # (op, key, filename, text, time)
+        self.names = {}  # key -> file name
+        self.handles = collections.OrderedDict()  # key -> open file
+        self.pending = {}  # key -> list of records awaiting commit
+        self.notes = {}  # key -> list of header lines awaiting commit
+        self.history = {}  # key -> all header lines ('pos' format)
+        self.nextkey = 0
+        self.keylock = threading.Lock()
+        self.written = 0  # Records written
+        self.failed = 0  # Records lost to write errors
+        self.commits = 0
+        self.lag = 0.0  # Age (s) of oldest record in last commit
+        self.running = False
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run_loop,
+                                       name='DatalogWriter', daemon=True)
+        self.log = logging.getLogger('DatalogWriter')
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        '''Commit everything queued, close all files and end thread'''
+        if self.running:
+            self.running = False
+            self.wake.set()
+            self.thread.join()
+
+    def stats(self):
+        return dict([('depth', self.queue.qsize()), ('lag', self.lag),
+                     ('written', self.written), ('failed', self.failed),
+                     ('commits', self.commits),
+                     ('files', len(self.names)),
+                     ('open', len(self.handles))])
+
+    # Called from rover threads
+    def open(self, filename, text=''):
+        '''Start a datalog file with 'text' (header). Returns its key'''
+        with self.keylock:
+            _key = self.nextkey
+            self.nextkey += 1
+        self.queue.put(('open', _key, filename, text, time()))
+        return _key
+
+    def write(self, key, record):
+        self.queue.put(('write', key, None, record, time()))
+
+    def rename(self, key, filename, text=''):
+        '''Move file of 'key' to 'filename', then append 'text' to it'''
+        self.queue.put(('rename', key, filename, text, time()))
+
+    def close(self, key):
+        self.queue.put(('close', key, None, None, time()))
+
+    def filename(self, key):
+        '''Name of the file of 'key' as it is now, '_N' suffix included
+        (None until the writer thread has taken the open, or once closed)'''
+        return self.names.get(key)
+
+    # Writer thread
+    def run_loop(self):
+        while self.running:
+            self.wake.wait(self.interval)
+            self.commit()
+        self.commit()
+        for _key in list(self.names):
+            self._close(_key)
+
+    def commit(self):
+        _oldest = None
+        while True:
+            try:
+                _op, _key, _filename, _text, _t = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if _oldest is None:
+                _oldest = _t
+            if _op == 'write':
+                if _key in self.pending:
+                    self.pending[_key].append(_text)
+            elif _op == 'open':
+                self.names[_key] = self._unique(_filename, _key,
+                                                ondisk=(self.fmt == 'pos'))
+                self.pending[_key] = []
+                self.notes[_key] = [_text]
+                self.history[_key] = []
+            elif _op == 'rename':
+                if _key in self.names:
+                    _filename = self._unique(_filename, _key, ondisk=True)
+                    if _filename != self.names[_key]:  # Not just a new version
+                        self._flush(_key)
+                        self._release(_key)
+                        try:
+                            os.rename(self.names[_key], _filename)
+                        except OSError as e:
+                            self.log.warning('Could not rename %s: %s' %
+                                             (self.names[_key], e))
+                        else:
+                            self.names[_key] = _filename
+                    self.notes[_key].append(_text)
+            elif _op == 'close':
+                self._close(_key)
+        for _key in list(self.names):
+            self._flush(_key)
+        if _oldest is not None:
+            self.lag = time() - _oldest
+            self.commits += 1
+
+    def _unique(self, filename, key, ondisk=False):
+        _taken = set(_name for _key, _name in self.names.items()
+                     if _key != key)
+        _base, _ext = os.path.splitext(filename)
+        _name = filename
+        _own = self.names.get(key)  # The key's file exists, but is its own
+        _ii = 0
+        while _name in _taken or (ondisk and _name != _own and
+                                  os.path.exists(_name)):
+            _ii += 1
+            _name = '%s_%d%s' % (_base, _ii, _ext)
+        return _name
+
+    def _flush(self, key):
+        _records = self.pending[key]
+        _notes = self.notes[key]
+        if not (_records or _notes):
+            return
+        _fid = self.handles.get(key)
+        try:
+            if _fid is None:
+                if len(self.handles) >= self.maxopen:
+                    self._release(next(iter(self.handles)))
+                if self.fmt == 'dat':
+                    _fid = open(self.names[key], 'a')
+                elif os.path.exists(self.names[key]):
+                    _fid = open(self.names[key], 'r+b')
+                else:
+                    _fid = open(self.names[key], 'w+b')
+                self.handles[key] = _fid
+            else:
+                self.handles.move_to_end(key)
+            if self.fmt == 'dat':
+                _fid.write(''.join(_notes)+''.join(
+                    '%.1f\t%.3f\t%.3f\t%.3f\n' % _record
+                    for _record in _records))
+            else:
+                if _notes:
+                    self.history[key] += ''.join(_notes).splitlines(True)
+                    _fid.seek(0)
+                    _fid.write(posheader(self.history[key]))
+                _fid.seek(0, os.SEEK_END)
+                _fid.write(np.array(_records, dtype=posdtype).tobytes())
+            _fid.flush()
+        except OSError as e:
+            self.log.warning('Could not write %s: %s' % (self.names[key], e))
+            self.failed += len(_records)
+        else:
+            self.written += len(_records)
+        self.pending[key] = []
+        self.notes[key] = []
+
+    def _release(self, key):
+        _fid = self.handles.pop(key, None)
+        if _fid is not None:
+            _fid.close()
+
+    def _close(self, key):
+        if key in self.names:
+            self._flush(key)
+            self._release(key)
+            del self.names[key]
+            del self.pending[key]
+            del self.notes[key]
+            del self.history[key]
+
+
+_default_writer = None
+_default_lock = threading.Lock()
+
+
+def default_writer():
+    '''Writer shared by rovers that weren't given one (started on first
+    use, and stopped when the interpreter exits)'''
+    global _default_writer
+    with _default_lock:
+        if _default_writer is None:
+            _default_writer = DatalogWriter()
+            _default_writer.start()
+            atexit.register(_default_writer.stop)
+    return _default_writer
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python ', sys.argv[0], '<datalog.dat> [...]')
+        sys.exit(0)
+    for datfile in sys.argv[1:]:
+        print('%s -> %s' % (datfile, dat_to_poslog(datfile)))
@@ -0,0 +1,143 @@
+import threading
+import itertools
+import collections
+
+
+class RoverRegistry:
+    '''
+
+    The server's live rovers, shared by the main loop, the console and the
+    webUI. Each rover gets an ID on add() that stays the same for as long
+    as it is registered and is never handed out again, and is indexed by
+    that ID, its name, thread name, version and IP address, so lookups
+    and remove() take no scan of the fleet. A rover's name and version
+    change with MYID, so the rover calls reindex() (add() sets
+    rover.registry).
+
+    Additions and removals are numbered change events, ('NEW', id) and
+    ('DIE', id), kept for readers that poll with changes() and a mark,
+    like SynBus listeners. 'view' is a tuple of the registered rovers,
+    oldest first, replaced (never changed) on every add() and remove(),
+    for readers that take no lock.
+
+    '''
+
+    def __init__(self, keep=1024):
+        self.lock = threading.RLock()
+        self.rovers = {}  # id -> rover
+        self.ids = {}  # rover -> id
+        self.keys = {}  # id -> (name, thread, version, address) indexed
+        self.by_name = {}  # name -> {id: rover}
+        self.by_thread = {}  # thread name -> {id: rover}
+        self.by_version = {}  # version -> {id: rover}
+        self.by_addr = {}  # IP address -> {id: rover}
+        self._indexes = (self.by_name, self.by_thread, self.by_version,
+                         self.by_addr)
+        self._ids = itertools.count(1)
+        self.events = collections.deque(maxlen=keep)  # (count, kind, id)
+        self.count = 0  # Change events so far
+        self.view = ()
+
+    def __len__(self):
+        return len(self.rovers)
+
+    def __contains__(self, rover):
+        return rover in self.ids
+
+    def _keys(self, rover):
+        return (rover.name, rover.thread.getName(), rover.version,
+                str(rover.addr[0]))
+
+    def _index(self, rid, rover, keys):
+        for _index, _key in zip(self._indexes, keys):
+            _index.setdefault(_key, {})[rid] = rover
+        self.keys[rid] = keys
+
+    def _unindex(self, rid):
+        for _index, _key in zip(self._indexes, self.keys.pop(rid)):
+            del _index[_key][rid]
+            if not _index[_key]:
+                del _index[_key]
+
+    def _event(self, kind, rid):
+        self.count += 1
+        self.events.append((self.count, kind, rid))
+
+    def add(self, rover):
+        '''Register a rover. Returns its ID.'''
+        self.lock.acquire()
+        rover.registry = self  # Before its keys are read, see reindex()
+        _rid = next(self._ids)
+        self.rovers[_rid] = rover
+        self.ids[rover] = _rid
+        self._index(_rid, rover, self._keys(rover))
+        self.view = self.view + (rover,)
+        self._event('NEW', _rid)
+        self.lock.release()
+        return _rid
+
+    def remove(self, rover):
+        '''Forget a rover. Returns its ID, or None if it wasn't
+        registered.'''
+        self.lock.acquire()
+        _rid = self.ids.pop(rover, None)
+        if _rid is not None:
+            del self.rovers[_rid]
+            self._unindex(_rid)
+            self.view = tuple([_rover for _rover in self.view
+                               if _rover is not rover])
+            self._event('DIE', _rid)
+        self.lock.release()
+        return _rid
+
+    def reindex(self, rover):
+        '''Follow a change of the rover's name or version'''
+        self.lock.acquire()
+        _rid = self.ids.get(rover)
+        if _rid is not None:
+            _keys = self._keys(rover)
+            if _keys != self.keys[_rid]:
+                self._unindex(_rid)
+                self._index(_rid, rover, _keys)
+        self.lock.release()
+
+    def get(self, rid):
+        '''The rover with ID 'rid', or None'''
+        return self.rovers.get(rid)
+
+    def id_of(self, rover):
+        '''ID of a registered rover, or None'''
+        return self.ids.get(rover)
+
+    def find(self, name=None, thread=None, version=None, addr=None):
+        '''Registered rovers matching all the given keys, by ID'''
+        self.lock.acquire()
+        _found = None
+        for _index, _key in zip(self._indexes,
+                                (name, thread, version, addr)):
+            if _key is None:
+                continue
+            _matches = _index.get(_key, {})
+            if _found is None:
+                _found = dict(_matches)
+            else:
+                _found = dict([(_rid, _rover) for _rid, _rover in
+                               _found.items() if _rid in _matches])
+        if _found is None:
+            _found = dict(self.rovers)
+        self.lock.release()
+        return _found
+
+    def changes(self, mark):
+        '''Change events numbered after 'mark', and the mark to pass next
+        time. The events are None if some were forgotten since 'mark'
+        (the reader has to compare with 'view' instead).'''
+        self.lock.acquire()
+        _mark = self.count
+        if _mark - mark > len(self.events):
+            _events = None
+        else:
+            _events = [(_kind, _rid) for _n, _kind, _rid in self.events
+                       if _n > mark]
+        self.lock.release()
+        return _events, _mark
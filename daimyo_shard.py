@@ -0,0 +1,586 @@
+import socket
+import select
+import threading
+import logging
+import itertools
+import collections
+import multiprocessing
+from time import time
+from multiprocessing import shared_memory
+import numpy as np
+import daimyo_utils
+from daimyo_utils import Rover, Waker, SynBus, EventQueue, RoverSnapshot
+from daimyo_utils import CommandQueue, EmergencyStop
+from daimyo_async import AsyncEngine
+from daimyo_datalog import DatalogWriter
+
+# One row per rover in the fleet table. 'seq' is odd while the owning
+# worker rewrites the row, 'gen' counts the rovers that used the slot.
+# x/y/angle are the latest position, sx/sy/sangle the one last shown
+# (outside the rover's precision dead-band, see Rover.on_mypos).
+table_dtype = np.dtype([('seq', 'u4'), ('gen', 'u4'), ('alive', 'u1'),
+                        ('heartbeat', 'u1'), ('loopflag', 'u1'),
+                        ('name', 'S32'), ('version', 'S16'),
+                        ('thread', 'S16'), ('addr', 'S40'),
+                        ('x', 'f8'), ('y', 'f8'), ('angle', 'f8'),
+                        ('sx', 'f8'), ('sy', 'f8'), ('sangle', 'f8'),
+                        ('state', 'i4'), ('superstate', 'i4'),
+                        ('heartperiod', 'f8')])
+
+
+class FleetTable:
+    '''
+
+    Rover name, position, state and superstate of the whole fleet, in
+    shared memory. Worker 'index' of 'number' owns (and is the only writer
+    of) rows index*per to (index+1)*per-1, per = capacity//number. Readers
+    copy the table and keep the rows whose 'seq' was even and unchanged
+    over the copy.
+
+    '''
+
+    def __init__(self, capacity=4096, name=None):
+        self.capacity = capacity
+        if name is None:
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=capacity*table_dtype.itemsize)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.name = self.shm.name
+        self.rows = np.ndarray((capacity,), dtype=table_dtype,
+                               buffer=self.shm.buf)
+        if self.owner:
+            self.rows[:] = np.zeros(capacity, dtype=table_dtype)
+
+    def slots(self, index, number):
+        _per = self.capacity//number
+        return range(index*_per, (index+1)*_per)
+
+    def write(self, slot, row):
+        '''Rewrite 'slot' with 'row' (all fields after 'seq')'''
+        _seq = int(self.rows['seq'][slot])
+        self.rows['seq'][slot] = _seq + 1
+        self.rows[slot] = (_seq + 1,) + row  # Still odd while copied in
+        self.rows['seq'][slot] = _seq + 2
+
+    def snapshot(self):
+        '''(rows, mask of rows read whole)'''
+        _rows = self.rows.copy()
+        _after = self.rows['seq'].copy()  # Re-read once the copy is done
+        _valid = (_rows['seq'] % 2 == 0) & (_rows['seq'] == _after)
+        return _rows, _valid
+
+    def close(self):
+        del self.rows
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class ShardSynBus(SynBus):
+    '''SynBus of a worker. SYNs of its own rovers also go to the server
+    process, which hands them to the other workers.'''
+
+    def __init__(self, index, events):
+        SynBus.__init__(self)
+        self.index = index
+        self.events = events
+
+    def publish(self, topic, sender=None):
+        if sender is not None:  # Not one relayed from another worker
+            self.events.put(('SYN', self.index, topic))
+        return SynBus.publish(self, topic, sender)
+
+
+class ShardEmergencyStop(EmergencyStop):
+    '''EmergencyStop of a worker. HALT to ACK latencies also go to the
+    server process, to the ShardRover (and lane) that sent the HALT.'''
+
+    def __init__(self, worker):
+        EmergencyStop.__init__(self)
+        self.worker = worker
+
+    def acked(self, rover, latency):
+        EmergencyStop.acked(self, rover, latency)
+        for _slot, _rover in list(self.worker.rovers.items()):
+            if _rover is rover:  # No worker lock: rover.lock is held
+                _gen = int(self.worker.table.rows['gen'][_slot])
+                self.worker.events.put(('ACKED', _slot, _gen, latency))
+                break
+
+
+class ShardWorker:
+    '''
+
+    Serves the rovers that connect to one of 'number' sockets sharing the
+    listening port (SO_REUSEPORT), in a process of its own. Rover rows of
+    the fleet table are kept up to date, messages passed upstream
+    (smsg_buffer), webUI events other than MYPOS and, every 'report'
+    seconds, rover counters are sent to the server process on 'events',
+    and commands for its rovers come in on
+    'commands'.
+
+    '''
+
+    def __init__(self, index, number, address, port, tablename, commands,
+                 events, options):
+        self.index = index
+        self.number = number
+        self.address = address
+        self.port = port
+        self.table = FleetTable(options['capacity'], tablename)
+        self.commands = commands
+        self.events = events
+        self.options = options
+        self.lock = threading.Lock()  # Guards rovers
+        self.rovers = {}  # slot -> Rover
+        self.published = {}  # slot -> row last written
+        self.reported = {}  # slot -> time() counters were last sent
+        self.free = collections.deque(self.table.slots(index, number))
+        self.upwaker = Waker()
+        self.synbus = ShardSynBus(index, events)
+        self.estop = ShardEmergencyStop(self)  # HALTs from the server
+        self.running = True
+        # Thread names stay unique across workers: Thread-1, Thread-3, ...
+        # in worker 0 of 2, Thread-2, Thread-4, ... in worker 1
+        daimyo_utils._threadcount = itertools.count(index + 1, number)
+        daimyo_utils.sendq_defaults.update(options['sendq'])
+        self.log = logging.getLogger('worker%d' % index)
+
+    def run(self):
+        _fmt = logging.Formatter('%(name)s:%(levelname)s:\t%(message)s')
+        self.streamhandler = logging.StreamHandler()
+        self.streamhandler.setFormatter(_fmt)
+        self.streamhandler.setLevel(self.options['loglevel'])
+        self.filehandler = logging.FileHandler(
+            self.options['logfile'] % self.index)
+        self.filehandler.setFormatter(logging.Formatter(
+            '%(asctime)s:%(name)s:%(levelname)s:\t%(message)s'))
+        self.filehandler.setLevel(self.options['loglevel'])
+        self.log.setLevel(self.options['loglevel'])
+        self.log.addHandler(self.streamhandler)
+        self.log.addHandler(self.filehandler)
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server.bind((self.address, self.port))
+        self.server.listen(10)
+        self.datalog = DatalogWriter(self.options['commit'],
+                                     fmt=self.options['format'])
+        self.datalog.start()
+        self.engine = None
+        if self.options['engine'] == 'asyncio':
+            self.engine = AsyncEngine()
+            self.engine.start()
+        _commandthread = threading.Thread(target=self.command_loop,
+                                          name='commands', daemon=True)
+        _commandthread.start()
+        self.events.put(('READY', self.index))
+
+        while self.running:
+            _inlist, _outlist, _exlist = select.select(
+                [self.server, self.upwaker], [], [],
+                self.options['period'])
+            if self.upwaker in _inlist:
+                self.upwaker.drain()
+            if self.server in _inlist:
+                self.accept()
+            _now = time()
+            self.lock.acquire()
+            for _slot, _rover in list(self.rovers.items()):
+                self.forward(_slot, _rover)
+                self.publish(_slot, _rover)
+                if _now - self.reported[_slot] >= self.options['report']:
+                    self.report(_slot, _rover)
+                    self.reported[_slot] = _now
+                if not _rover.alive:
+                    if _rover.threaded:
+                        _rover.thread.join()
+                    del self.rovers[_slot]
+                    del self.published[_slot]
+                    del self.reported[_slot]
+                    self.free.append(_slot)
+            self.lock.release()
+
+        self.server.close()
+        if self.engine is not None:
+            self.engine.stop()
+        self.lock.acquire()
+        for _slot, _rover in list(self.rovers.items()):
+            _rover.die()
+            if _rover.threaded:
+                _rover.thread.join()
+            self.publish(_slot, _rover)
+        self.lock.release()
+        self.datalog.stop()
+        self.table.close()
+        self.log.removeHandler(self.streamhandler)
+        self.log.removeHandler(self.filehandler)
+        self.filehandler.close()
+
+    def accept(self):
+        _conn, _addr = self.server.accept()
+        if not self.free:
+            self.log.warning('No table slot left for <%s>. Closing.' %
+                             _addr[0])
+            _conn.close()
+            return
+        _rover = Rover(_conn, _addr, self.streamhandler, self.filehandler,
+                       self.options['loglevel'],
+                       threaded=(self.engine is None), datalog=self.datalog,
+                       upwaker=self.upwaker, synbus=self.synbus)
+        if self.engine is not None:
+            self.engine.add_rover(_rover)
+        _slot = self.free.popleft()
+        self.lock.acquire()
+        self.rovers[_slot] = _rover
+        self.published[_slot] = None
+        self.reported[_slot] = time()  # First counters after 'report' s
+        self.publish(_slot, _rover, newgen=True)  # Before any of its events
+        self.lock.release()
+        self.log.info('<%s> connected' % _addr[0])
+
+    def publish(self, slot, rover, newgen=False):
+        '''Rewrite the rover's row if anything in it changed'''
+        _gen = int(self.table.rows['gen'][slot]) + (1 if newgen else 0)
+        _row = (_gen, rover.alive, rover.heartbeat, rover.loopflag,
+                rover.name.encode()[:32], rover.version.encode()[:16],
+                rover.thread.getName().encode()[:16],
+                str(rover.addr[0]).encode()[:40], rover.x, rover.y,
+                rover.angle, rover.xold, rover.yold, rover.angold,
+                rover.state, rover.superstate,
+                rover.heartperiod)
+        if _row != self.published[slot]:
+            self.table.write(slot, _row)
+            self.published[slot] = _row
+
+    def forward(self, slot, rover):
+        '''Send messages meant for the server thread, and webUI events
+        (positions shown are in the table), to the server process'''
+        _gen = int(self.table.rows['gen'][slot])
+        if rover.sflag:
+            rover.lock.acquire()
+            _msgs = rover.smsg_buffer
+            rover.smsg_buffer = []
+            rover.sflag = False
+            rover.lock.release()
+            for _msg in _msgs:
+                self.events.put(('UP', slot, _gen, _msg))
+        for _event in rover.wevents.drain():
+            if _event[0] != 'MYPOS':
+                self.events.put(('WEV', slot, _gen, _event))
+
+    def report(self, slot, rover):
+        '''Send the rover's counters (Rover.metrics()) to the server
+        process, for its metrics endpoint'''
+        _gen = int(self.table.rows['gen'][slot])
+        self.events.put(('MET', slot, _gen, rover.metrics()))
+
+    def command_loop(self):
+        '''Hand commands from the server process to rovers'''
+        while True:
+            _msg = self.commands.get()
+            if _msg[0] == 'QUIT':
+                self.running = False
+                self.upwaker.wake()
+                break
+            if _msg[0] == 'SYN':
+                self.synbus.publish(_msg[1])  # From another worker
+                continue
+            _kind, _slot, _gen = _msg[:3]
+            self.lock.acquire()
+            _rover = self.rovers.get(_slot)
+            if _rover is not None and \
+                    int(self.table.rows['gen'][_slot]) != _gen:
+                _rover = None  # Meant for a rover that is gone
+            self.lock.release()
+            if _rover is None or not _rover.alive:
+                continue
+            if _kind == 'DIE':
+                _rover.die()
+                continue
+            if _kind == 'HALT':
+                _rover.emergency_halt(self.estop)
+                continue
+            if _kind == 'CMD':
+                _rover.put_command(_msg[3])
+            elif _kind in ['SEQ', 'PAUSE']:
+                _rover.put_command((_kind,) + _msg[3:])
+
+
+def worker_main(*args):
+    ShardWorker(*args).run()
+
+
+class ShardRover:
+    '''
+
+    Stands in, in the server process, for a Rover served by a worker, so
+    that the console and webUI code can treat both alike. Fields are
+    refreshed from the fleet table, counters from the worker's reports.
+    Commands from put_command(), ('PAUSE', flag) and ('SEQ', seqfile)
+    tuples included, go to the worker's rover queue (coalesced here while
+    waiting, like there).
+
+    '''
+
+    def __init__(self, pool, worker, slot, row):
+        self.pool = pool
+        self.worker = worker
+        self.slot = slot
+        self.gen = int(row['gen'])
+        self.lock = threading.RLock()
+        self.threaded = False
+        self.thread = threading.Thread(name=row['thread'].decode(
+            errors='replace'))
+        self.addr = (row['addr'].decode(), 0)
+        self.alive = True
+        self.commands = CommandQueue()
+        self.command = ''  # What clean_send() sends at once
+        self.pause = False
+        self.seqfile = ''
+        self.seqlist = []
+        self.numseq = 0
+        self.ackflag = False
+        self.sflag = False
+        self.smsg_buffer = []
+        self.wevents = EventQueue()
+        self.x = None  # Until the first update()
+        self.shown = None  # Position last shown (sx, sy, sangle)
+        self.counters = None  # Worker Rover.metrics(), as last reported
+        self.reported = None  # time() of that report
+        self._estop_lane = None  # EmergencyStop of the last HALT
+        self.estops = 0
+        self.halt_latency = None  # As measured in the worker
+        self.snapshot = None
+        self.registry = None  # Set by RoverRegistry.add()
+        self.update(row)
+
+    def update(self, row):
+        self.lock.acquire()
+        _pos = (row['x'], row['y'], row['angle'])
+        # The webUI gets the worker rover's MYPOS events, those outside
+        # its dead-band, as a threaded rover's would
+        _shown = tuple([float(_v) for _v in (row['sx'], row['sy'],
+                                             row['sangle'])])
+        if self.shown is not None and _shown != self.shown:
+            self.wevents.push(['MYPOS'] + list(_shown))
+        self.shown = _shown
+        self.name = row['name'].decode(errors='replace')
+        self.version = row['version'].decode(errors='replace')
+        [self.x, self.y, self.angle] = [float(_v) for _v in _pos]
+        self.state = int(row['state'])
+        self.superstate = int(row['superstate'])
+        self.heartbeat = bool(row['heartbeat'])
+        self.heartperiod = float(row['heartperiod'])
+        self.loopflag = bool(row['loopflag'])
+        if not row['alive']:
+            self.alive = False
+        self.publish()
+        self.lock.release()
+
+    def publish(self):
+        '''Replace the snapshot if any of its fields changed (call with
+        self.lock held)'''
+        _fields = (self.name, self.version, self.thread.getName(), self.x,
+                   self.y, self.angle, self.state, self.superstate,
+                   self.heartbeat, self.loopflag)
+        if self.snapshot is None:
+            self.snapshot = RoverSnapshot(0, *_fields)
+        elif _fields != self.snapshot[1:]:
+            if self.registry is not None and _fields[:2] != \
+                    self.snapshot[1:3]:  # Name or version
+                self.registry.reindex(self)
+            self.snapshot = RoverSnapshot(self.snapshot.serial + 1, *_fields)
+
+    def wake(self):
+        self.lock.acquire()
+        _command = self.commands.get()
+        while _command is not None:
+            if isinstance(_command, tuple):  # See Rover.apply_local
+                if _command[0] == 'PAUSE':
+                    self.pause = _command[1]
+                elif _command[0] == 'SEQ':
+                    self.seqfile = _command[1]
+                self.send(*_command)
+            else:
+                self.send('CMD', _command)
+            _command = self.commands.get()
+        self.lock.release()
+
+    def send(self, kind, *values):
+        self.pool.send(self.worker, (kind, self.slot, self.gen) + values)
+
+    def put_command(self, command):
+        _queued = self.commands.put(command)
+        self.wake()
+        return _queued
+
+    def emergency_halt(self, lane=None):
+        '''Have the worker HALT the rover at once. The worker's rover
+        measures the HALT to ACK latency, which comes back through
+        ShardPool.poll() to acked().'''
+        self._estop_lane = lane
+        self.estops += 1
+        self.send('HALT')
+        return True
+
+    def acked(self, latency):
+        self.halt_latency = latency
+        if self._estop_lane is not None:
+            self._estop_lane.acked(self, latency)
+
+    def clean_send(self):
+        self.send('CMD', self.command)
+
+    def die(self):
+        self.lock.acquire()
+        if self.alive:
+            self.alive = False  # ShardPool.poll() keeps it from coming back
+            self.send('DIE')
+        self.lock.release()
+
+    def report(self, counters):
+        self.lock.acquire()
+        self.counters = counters
+        self.reported = time()
+        self.lock.release()
+
+    def metrics(self):
+        '''Counters of the worker's Rover as last reported, or None
+        before its first report'''
+        self.lock.acquire()
+        if self.counters is None:
+            self.lock.release()
+            return None
+        _snapshot = dict(self.counters)
+        _snapshot['name'] = self.name
+        if _snapshot['mypos_age'] is not None:
+            _snapshot['mypos_age'] += time() - self.reported
+        _snapshot['smsg_buffer'] += len(self.smsg_buffer)
+        _snapshot['estops'] = self.estops  # Known here before a report
+        if self.halt_latency is not None:
+            _snapshot['halt_latency'] = self.halt_latency
+        self.lock.release()
+        return _snapshot
+
+
+class ShardPool:
+    '''
+
+    Starts 'number' worker processes that share the listening port, and
+    keeps a ShardRover for every rover in the fleet table. The server
+    main loop calls poll() to pick up new and dead rovers and what the
+    workers sent, and is woken through 'upwaker' when there is some.
+
+    '''
+
+    def __init__(self, number, address, port, upwaker, options):
+        self.number = number
+        self.upwaker = upwaker
+        self.table = FleetTable(options['capacity'])
+        _context = multiprocessing.get_context('spawn')
+        self.events = _context.Queue()
+        self.commands = [_context.Queue() for ii in range(number)]
+        self.procs = [_context.Process(
+            target=worker_main, name='worker%d' % ii,
+            args=(ii, number, address, port, self.table.name,
+                  self.commands[ii], self.events, options))
+                      for ii in range(number)]
+        self.received = collections.deque()
+        self.rovers = {}  # slot -> ShardRover
+        self.dead = {}  # slot -> gen of a rover gone here, row still alive
+        self.ready = 0
+        self.relayed = 0  # SYNs handed from one worker to the others
+        self.log = logging.getLogger('shards')
+
+    def start(self):
+        for _proc in self.procs:
+            _proc.start()
+        self.reader = threading.Thread(target=self.read_loop, name='shards')
+        self.reader.start()
+        return self
+
+    def send(self, worker, msg):
+        self.commands[worker].put(msg)
+
+    def read_loop(self):
+        while True:
+            _msg = self.events.get()
+            if _msg is None:
+                break
+            if _msg[0] == 'SYN':
+                for ii in range(self.number):
+                    if ii != _msg[1]:
+                        self.commands[ii].put(('SYN', _msg[2]))
+                self.relayed += 1
+                continue
+            self.received.append(_msg)
+            self.upwaker.wake()
+
+    def poll(self):
+        '''Refresh ShardRovers from the table and apply what the workers
+        sent. Returns the ShardRovers that are new.'''
+        _new = []
+        _rows, _valid = self.table.snapshot()
+        _per = self.table.capacity//self.number
+        for _slot in np.flatnonzero(_valid & (_rows['gen'] > 0)):
+            _slot = int(_slot)
+            _row = _rows[_slot]
+            if self.dead.get(_slot) == int(_row['gen']):
+                if not _row['alive']:
+                    del self.dead[_slot]  # The worker saw it go too
+                continue  # Not a new rover, one that died here
+            _rover = self.rovers.get(_slot)
+            if _rover is not None and _rover.gen != int(_row['gen']):
+                _rover.alive = False  # Slot reused
+                _rover = None
+            if _rover is None:
+                if _row['alive']:
+                    _rover = ShardRover(self, _slot//_per, _slot, _row)
+                    self.rovers[_slot] = _rover
+                    _new.append(_rover)
+            else:
+                _rover.update(_row)
+        for _slot, _rover in list(self.rovers.items()):
+            if not _rover.alive:
+                del self.rovers[_slot]
+                self.dead[_slot] = _rover.gen
+        while self.received:
+            _msg = self.received.popleft()
+            if _msg[0] == 'READY':
+                self.ready += 1
+                continue
+            _kind, _slot, _gen, _value = _msg
+            _rover = self.rovers.get(_slot)
+            if _rover is None or _rover.gen != _gen:
+                continue
+            if _kind == 'UP':
+                _rover.lock.acquire()
+                _rover.smsg_buffer.append(_value)
+                _rover.sflag = True
+                _rover.lock.release()
+            elif _kind == 'WEV':
+                _rover.wevents.push(_value)
+            elif _kind == 'MET':
+                _rover.report(_value)
+            elif _kind == 'ACKED':
+                _rover.acked(_value)
+        return _new
+
+    def stop(self):
+        for ii in range(self.number):
+            self.commands[ii].put(('QUIT',))
+        for _proc in self.procs:
+            _proc.join()
+        self.events.put(None)
+        self.reader.join()
+        self.table.close()
+
+    def stats(self):
+        return dict([('workers', self.number), ('ready', self.ready),
+                     ('rovers', len(self.rovers)),
+                     ('relayed', self.relayed)])
@@ -1,51 +1,202 @@
 import socket
 import select
-import copy
+import sys
+import bisect
 import threading
 import logging
 import os
 import json
-from time import time
+import struct
+import math
+import collections
+import itertools
+import heapq
+from time import time, perf_counter
 import datetime
+from daimyo_datalog import default_writer
 
 
-# List of valid commands/messages and number of fields
-# First key is rover version name
-vtypes = {}
-vtypes['0'] = {}
-vtypes['0']['cmd'] = [['ID', 0],
-                      ['POS', 0],
-                      ['SETPOS', 3],
-                      ['PRES', 0],
-                      ['SETPRES', 2],
-                      ['MAXVEL', 0],
-                      ['HEART', 1],
-                      ['SILENT', 0],
-                      ['HALT', 0],
-                      ['FWD', 3],
-                      ['BWD', 3],
-                      ['CFWD', 2],
-                      ['CBWD', 2],
-                      ['TURN', 2],
-                      ['ATURN', 3],
-                      ['CTURN', 2],
-                      ['GOTO', 5],
-                      ['OBS', 2],
-                      ['POBS', 3],
-                      ['DIE', 0]]
-vtypes['0']['msg'] = [['MYID', 2],
-                      ['MYPOS', 3],
-                      ['MYPRES', 2],
-                      ['MYMAXV', 1],
-                      ['ACK', 1],
-                      ['COL', 2],
-                      ['FAIL', 0],
-                      ['TIMEOUT', 0],
-                      ['DOBS', 1],
-                      ['BYE', 0]]
-vtypes['0_RFID'] = copy.deepcopy(vtypes['0'])
-vtypes['0_RFID']['cmd'].extend([['SEARCH', 3]])
-vtypes['0_RFID']['msg'].extend([['RFID', 3]])
+# Field types of valid commands/messages, keyed by rover version name.
+# 'f' is a float, 'i' an int, and 's' a string. A trailing '?' marks a
+# field that may be left empty (it then decodes to None).
+ftypes = {}
+ftypes['0'] = {}
+ftypes['0']['cmd'] = dict([('ID', []),
+                           ('POS', []),
+                           ('SETPOS', ['f', 'f', 'f?']),
+                           ('PRES', []),
+                           ('SETPRES', ['f', 'f?']),
+                           ('MAXVEL', []),
+                           ('HEART', ['f?']),
+                           ('SILENT', []),
+                           ('HALT', []),
+                           ('FWD', ['f', 'f?', 'f?']),
+                           ('BWD', ['f', 'f?', 'f?']),
+                           ('CFWD', ['f?', 'f?']),
+                           ('CBWD', ['f?', 'f?']),
+                           ('TURN', ['f', 'f?']),
+                           ('ATURN', ['f', 'f', 'f?']),
+                           ('CTURN', ['f', 'f?']),
+                           ('GOTO', ['f', 'f', 'f?', 'f?', 'f?']),
+                           ('OBS', ['f?', 'f?']),
+                           ('POBS', ['f', 'f?', 'f?']),
+                           ('DIE', [])])
+ftypes['0']['msg'] = dict([('MYID', ['s', 's']),
+                           ('MYPOS', ['f', 'f', 'f']),
+                           ('MYPRES', ['f', 'f']),
+                           ('MYMAXV', ['f']),
+                           ('ACK', ['i?']),
+                           ('COL', ['f', 'f']),
+                           ('FAIL', []),
+                           ('TIMEOUT', []),
+                           ('DOBS', ['f']),
+                           ('BYE', [])])
+ftypes['0_RFID'] = dict([('cmd', dict([('SEARCH', ['f?', 's?', 'f'])])),
+                         ('msg', dict([('RFID', ['s', 's', 's'])]))])
+ftypes['0_BIN'] = dict([('binary', ['MYPOS'])])
+fdecoders = dict([('f', float), ('i', int), ('s', str)])
+
+# Binary telemetry frames: a marker byte, a little-endian struct payload,
+# and binend. Neither byte occurs in the ASCII protocol, so both kinds of
+# frames can share one stream. Versions list the types they send this way.
+binend = b'\x03'
+binformats = dict([(b'\x02', ('MYPOS', struct.Struct('<3f')))])
+binmarkers = dict([(_type, _marker)
+                   for _marker, (_type, _st) in binformats.items()])
+
+
+def binpack(msgtype='MYPOS', *values):
+    '''Pack a binary telemetry frame (for field rovers)'''
+    _marker = binmarkers[msgtype]
+    return _marker + binformats[_marker][1].pack(*values) + binend
+
+
+def binsizes():
+    '''Frame size (bytes) of each binary marker, as used by TCPframer'''
+    return dict([(_marker, _st.size + 2)
+                 for _marker, (_type, _st) in binformats.items()])
+
+
+class Protocol:
+    '''
+
+    Compiled command/message specs of one rover version. Each type maps to
+    a tuple of (decoder, optional) pairs, one per field. Message handlers
+    are functions handler(rover, values) that Rover.msg_parser() calls for
+    a valid message. Types and handlers not found here are looked up in
+    the 'base' version.
+
+    '''
+
+    def __init__(self, version, cmd={}, msg={}, binary=[], base=None):
+        self.version = version
+        self.base = base
+        self.specs = dict([('cmd', {}), ('msg', {})])
+        self.binary = set(binary)  # Message types also sent as binary
+        if base is not None:
+            self.specs['cmd'].update(base.specs['cmd'])
+            self.specs['msg'].update(base.specs['msg'])
+            self.binary.update(base.binary)
+        for kind, types in [('cmd', cmd), ('msg', msg)]:
+            for _type, _fields in types.items():
+                self.specs[kind][_type] = tuple(
+                    (fdecoders[_field.rstrip('?')], _field.endswith('?'))
+                    for _field in _fields)
+        # Types whose fields are all compulsory floats (like MYPOS)
+        self.floatspecs = dict([
+            (kind, set(_type for _type, _spec in self.specs[kind].items()
+                       if _spec and all(_field == (float, False)
+                                        for _field in _spec)))
+            for kind in ['cmd', 'msg']])
+        self.handlers = {}
+
+    def handler(self, msgtype):
+        _handler = self.handlers.get(msgtype)
+        if _handler is None and self.base is not None:
+            return self.base.handler(msgtype)
+        return _handler
+
+    def parse(self, kind='cmd', instr='<x>'):
+        '''
+
+        Validate string 'instr' of 'kind' ('cmd' or 'msg') and decode its
+        fields. Returns (status, type, values), where status is:
+        0:\t Valid. 'values' holds the decoded fields
+        1:\t Unknown type or wrong number of fields
+        2:\t A compulsory field is empty
+        3:\t A field could not be decoded
+
+        '''
+        if len(instr) < 3:
+            return 1, '', []
+        _strlist = instr[1:-1].split(',')
+        _type = _strlist.pop(0)
+        _spec = self.specs[kind].get(_type)
+        if _spec is None or len(_spec) != len(_strlist):
+            return 1, '', []
+        if _type in self.floatspecs[kind]:
+            if '' in _strlist:
+                return 2, _type, []
+            try:
+                return 0, _type, list(map(float, _strlist))
+            except ValueError:
+                return 3, _type, []
+        _values = []
+        for (_decode, _optional), _field in zip(_spec, _strlist):
+            if _field == '':
+                if not _optional:
+                    return 2, _type, []
+                _values.append(None)
+            else:
+                try:
+                    _values.append(_decode(_field))
+                except ValueError:
+                    return 3, _type, []
+        return 0, _type, _values
+
+    def unpack(self, frame=b''):
+        '''Decode a binary telemetry frame. Returns as parse() does'''
+        _format = binformats.get(frame[:1])
+        if _format is None or _format[0] not in self.binary:
+            return 1, '', []
+        try:
+            return 0, _format[0], list(_format[1].unpack_from(frame, 1))
+        except struct.error:
+            return 3, _format[0], []
+
+
+protocols = {}  # Protocol instances keyed by rover version name
+vtypes = {}  # Lists of [type, number of fields] (older interface)
+
+
+def register_version(version, cmd={}, msg={}, binary=[], base=None,
+                     handlers={}):
+    '''Compile and register specs (as in ftypes) of a rover version,
+    optionally extending the version named by base'''
+    _base = protocols[base] if base is not None else None
+    protocols[version] = Protocol(version, cmd=cmd, msg=msg, binary=binary,
+                                  base=_base)
+    protocols[version].handlers.update(handlers)
+    vtypes[version] = dict([
+        (kind, [[_type, len(_spec)] for _type, _spec in
+                protocols[version].specs[kind].items()])
+        for kind in ['cmd', 'msg']])
+    return protocols[version]
+
+
+register_version('0', **ftypes['0'])
+register_version('0_RFID', base='0', **ftypes['0_RFID'])
+register_version('0_BIN', base='0', **ftypes['0_BIN'])
+
+
+def protoparse(version='0', kind='cmd', instr='<x>'):
+    '''Parse and decode 'instr' (see Protocol.parse)'''
+    _proto = protocols.get(version)
+    if _proto is None:
+        return 1, '', []
+    if isinstance(instr, bytes):  # Binary telemetry frame
+        return _proto.unpack(instr)
+    return _proto.parse(kind, instr)
 
 
 def cmdparse(version='0', kind='cmd', instr='<x>'):
@@ -55,7 +206,8 @@ def cmdparse(version='0', kind='cmd', instr='<x>'):
 
     strlist = instr[1:-1].split(',')
     cmdtype = strlist.pop(0)
-    if [cmdtype, len(strlist)] in vtypes[version][kind]:
+    _spec = protocols[version].specs[kind].get(cmdtype)
+    if _spec is not None and len(_spec) == len(strlist):
         return True, cmdtype, strlist
     return False, '', []
 
@@ -139,6 +291,908 @@ def TCPcompose(growstr='', newstr='', start='<', end='>',
                 return growstr+newstr, '', 1
 
 
+class TCPframer:
+    '''
+
+    Incremental replacement for TCPcompose. Received packets are appended
+    to a bytearray with feed(), which returns every complete message
+    (delimited by 'start' and 'end', inclusive) found in one pass. Bytes
+    preceding a 'start' are discarded, and a 'start' seen before the
+    pending message ends restarts the message from there, as in
+    TCPcompose. Only the unfinished tail is kept between calls.
+
+    The 'overflow' attribute turns True once the unfinished tail plus
+    discarded bytes (since the last 'start') exceed 'maxlen'. Nothing is
+    logged here, so feed() is cheap enough to call for every packet.
+
+    Optional 'binary' maps marker bytes of fixed-size binary frames to
+    their sizes (see binsizes()). These frames are returned as bytes, and
+    are dropped (one byte at a time) if they don't end with 'binend'.
+
+    '''
+
+    def __init__(self, start=b'<', end=b'>', maxlen=10240, binary={}):
+        if not start or not end or start == end:
+            raise ValueError("Got 'start'=%r and 'end'=%r" % (start, end))
+        self.start = start
+        self.end = end
+        self.maxlen = maxlen
+        self.binary = dict(binary)
+        self.buffer = bytearray()
+        self.junk = 0  # Bytes discarded since last 'start'
+        self.overflow = False
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def reset(self):
+        del self.buffer[:]
+        self.junk = 0
+        self.overflow = False
+
+    def feed(self, packet=b''):
+        '''Append 'packet' and return list of all completed messages'''
+        _buf = self.buffer
+        _buf += packet
+        _start = self.start
+        _end = self.end
+        _frames = []
+        _pos = 0
+        while True:
+            _st = _buf.find(_start, _pos)
+            _bst = -1
+            for _marker in self.binary:
+                _ii = _buf.find(_marker, _pos, _st if _st != -1 else None)
+                if _ii != -1 and (_bst == -1 or _ii < _bst):
+                    [_bst, _bsize] = [_ii, self.binary[_marker]]
+            if _bst != -1:  # Binary frame comes first
+                self.junk += _bst - _pos
+                if len(_buf) < _bst + _bsize:  # Partial. Keep for later
+                    _pos = _bst
+                    break
+                if _buf[_bst+_bsize-1:_bst+_bsize] == binend:
+                    self.junk = 0
+                    _pos = _bst + _bsize
+                    _frames.append(bytes(_buf[_bst:_pos]))
+                else:  # Not really a frame. Skip marker
+                    self.junk += 1
+                    _pos = _bst + 1
+                continue
+            if _st == -1:  # Nothing worth keeping
+                self.junk += len(_buf) - _pos
+                _pos = len(_buf)
+                break
+            self.junk = 0
+            _en = _buf.find(_end, _st + len(_start))
+            if _en == -1:  # Partial message. Keep for next packet
+                _pos = _st
+                break
+            # A later 'start' before 'end' abandons the earlier one
+            _st = _buf.rfind(_start, _st, _en)
+            _pos = _en + len(_end)
+            _frames.append(_buf[_st:_pos].decode(errors='replace'))
+        del _buf[:_pos]
+        self.overflow = len(_buf) + self.junk > self.maxlen
+        return _frames
+
+
+class EventQueue:
+    '''
+
+    Bounded queue of events (lists such as ['ACK', state]) passed from a
+    rover to the webUI thread, which drains it in batches. An event whose
+    type is in 'coalesce' replaces an event of the same type that is last
+    in line. Once 'maxlen' events are waiting, the oldest event of such a
+    type is dropped first, so that state transitions survive a slow webUI
+    tick. Counters record how many events were coalesced and dropped.
+
+    '''
+
+    def __init__(self, maxlen=64, coalesce=('MYPOS', 'DOBS')):
+        self.events = collections.deque()
+        self.maxlen = maxlen
+        self.coalesce = set(coalesce)
+        self.lock = threading.Lock()
+        self.pushed = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    def push(self, event):
+        self.lock.acquire()
+        self.pushed += 1
+        if (event[0] in self.coalesce and self.events and
+                self.events[-1][0] == event[0]):
+            self.events[-1] = event
+            self.coalesced += 1
+        else:
+            if len(self.events) >= self.maxlen:
+                for _ii, _event in enumerate(self.events):
+                    if _event[0] in self.coalesce:
+                        del self.events[_ii]
+                        break
+                else:
+                    self.events.popleft()
+                self.dropped += 1
+            self.events.append(event)
+        self.lock.release()
+
+    def drain(self):
+        '''Return (and forget) all waiting events, oldest first'''
+        self.lock.acquire()
+        _events = list(self.events)
+        self.events.clear()
+        self.lock.release()
+        return _events
+
+
+class CommandQueue:
+    '''
+
+    Bounded queue of commands from the server (webUI, console, broadcasts,
+    HeartScheduler) for one rover, taken in order by the thread serving
+    it. A motion command replaces any motion command still waiting, since
+    the rover would only act on the latest. Other commands (HEART,
+    SILENT, ID, POS, ...) keep their order, and so do tuples meant for the
+    rover object rather than the field rover, ('PAUSE', flag) and ('SEQ',
+    seqfile) (see Rover.apply_local). Once 'maxlen' commands are waiting,
+    put() refuses new ones, except HALT, which takes the place of the
+    oldest waiting command (counted as refused). Has its own lock, so
+    callers need not hold the rover's.
+
+    '''
+
+    motion = set(['HALT', 'FWD', 'BWD', 'CFWD', 'CBWD', 'TURN', 'ATURN',
+                  'CTURN', 'GOTO', 'OBS', 'POBS', 'SEARCH'])
+
+    def __init__(self, maxlen=32):
+        self.commands = collections.deque()  # [command type, command]
+        self.maxlen = maxlen
+        self.lock = threading.Lock()
+        self.put_count = 0
+        self.coalesced = 0
+        self.refused = 0
+
+    def __len__(self):
+        return len(self.commands)
+
+    def put(self, command):
+        '''Queue a command string or tuple. Returns False if the queue is
+        full.'''
+        if isinstance(command, tuple):
+            _type = command[0]
+        else:
+            _type = command[1:].split(',', 1)[0].rstrip('>')
+        self.lock.acquire()
+        if _type in self.motion:
+            for _ii, _entry in enumerate(self.commands):
+                if _entry[0] in self.motion:
+                    del self.commands[_ii]
+                    self.coalesced += 1
+                    break  # There is never more than one
+        if len(self.commands) >= self.maxlen:
+            self.refused += 1
+            if _type != 'HALT':
+                self.lock.release()
+                return False
+            self.commands.popleft()  # Never a motion command by now
+        self.commands.append([_type, command])
+        self.put_count += 1
+        self.lock.release()
+        return True
+
+    def drop(self, types):
+        '''Forget waiting commands with a type in 'types' '''
+        self.lock.acquire()
+        _kept = [_entry for _entry in self.commands
+                 if _entry[0] not in types]
+        self.commands = collections.deque(_kept)
+        self.lock.release()
+
+    def get(self):
+        '''The next command, or None'''
+        self.lock.acquire()
+        _command = self.commands.popleft()[1] if self.commands else None
+        self.lock.release()
+        return _command
+
+    def stats(self):
+        self.lock.acquire()
+        _stats = dict([('depth', len(self.commands)),
+                       ('put', self.put_count),
+                       ('coalesced', self.coalesced),
+                       ('refused', self.refused)])
+        self.lock.release()
+        return _stats
+
+
+class SendQueue:
+    '''
+
+    Outbound buffer of a rover connection. Commands are queued and written
+    by flush() with sends that never block, as the socket takes them, so a
+    stalled link holds up neither the thread serving the rover nor anyone
+    waiting on its lock. Once more than 'highwater' bytes are waiting,
+    'policy' decides what to do with a new command: 'coalesce' replaces
+    waiting commands of the same type (only the last one counts),
+    'drop' discards heartbeat-related ones (HEART, SILENT, POS) and
+    queues the rest, and 'disconnect' gives up on the connection. Past
+    'hardlimit' bytes the connection is given up on under any policy.
+
+    The rover's thread calls push(), send() and flush() holding the
+    rover's lock. urgent() may be called from any thread without it, so
+    the queue and socket writes have a lock of their own, held only for
+    sends that don't block.
+
+    '''
+
+    policies = ('coalesce', 'drop', 'disconnect')
+    heart_cmds = set(['HEART', 'SILENT', 'POS'])
+
+    def __init__(self, highwater=4096, policy='coalesce', hardlimit=65536):
+        if policy not in self.policies:
+            raise ValueError('Unknown send queue policy: %s' % policy)
+        self.items = collections.deque()  # [command type, bytes]
+        self.highwater = highwater
+        self.policy = policy
+        self.hardlimit = hardlimit
+        self.lock = threading.Lock()
+        self.held = set()  # Types refused since urgent(), until release()
+        self.offset = 0  # Bytes of the first item already sent
+        self.depth = 0  # Bytes waiting
+        self.maxdepth = 0
+        self.queued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.overflows = 0  # Commands that found the queue past highwater
+        self.bytes_out = 0
+        self.stalls = 0  # Flushes that left bytes for the next writable
+
+    def __len__(self):
+        return len(self.items)
+
+    def push(self, cmdtype, data):
+        '''Queue a command. Returns 0 if queued, 1 if dropped, 2 if the
+        connection should be closed.'''
+        self.lock.acquire()
+        _status = self._push(cmdtype, data)
+        self.lock.release()
+        return _status
+
+    def _push(self, cmdtype, data):
+        if cmdtype in self.held:
+            self.dropped += 1
+            return 1
+        if self.depth + len(data) > self.highwater:
+            self.overflows += 1
+            if self.policy == 'disconnect':
+                return 2
+            elif self.policy == 'drop' and cmdtype in self.heart_cmds:
+                self.dropped += 1
+                return 1
+            elif self.policy == 'coalesce':
+                # Not the first item once it is partly sent
+                _start = 1 if self.offset else 0
+                for _ii in range(len(self.items) - 1, _start - 1, -1):
+                    if self.items[_ii][0] == cmdtype:
+                        self.depth -= len(self.items[_ii][1])
+                        del self.items[_ii]
+                        self.coalesced += 1
+        if self.depth + len(data) > self.hardlimit:
+            return 2
+        self.items.append([cmdtype, data])
+        self.depth += len(data)
+        self.maxdepth = max(self.maxdepth, self.depth)
+        self.queued += 1
+        return 0
+
+    def send(self, sock, cmdtype, data):
+        '''push() and flush(), except that a command is not queued at all
+        if nothing is waiting and the socket takes all of it. Returns the
+        status of push(), or 3 on a socket error.'''
+        self.lock.acquire()
+        if not self.items and cmdtype not in self.held:
+            try:
+                _sent = sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                _sent = 0
+            except OSError:
+                self.lock.release()
+                return 3
+            self.bytes_out += _sent
+            self.queued += 1
+            if _sent < len(data):
+                self.stalls += 1
+                self.items.append([cmdtype, data])
+                self.offset = _sent
+                self.depth = len(data) - _sent
+                self.maxdepth = max(self.maxdepth, self.depth)
+            self.lock.release()
+            return 0
+        _status = self._push(cmdtype, data)
+        if _status == 0 and not self._flush(sock):
+            _status = 3
+        self.lock.release()
+        return _status
+
+    def urgent(self, sock, cmdtype, data, hold=()):
+        '''Send a command ahead of all waiting ones (but the rest of one
+        partly sent), drop waiting commands with a type in 'hold', and
+        refuse those until release(). Returns False on a socket error.'''
+        self.lock.acquire()
+        _first = [self.items.popleft()] if self.offset else []
+        _kept = [_item for _item in self.items if _item[0] not in hold]
+        self.dropped += len(self.items) - len(_kept)
+        self.items = collections.deque(_first + [[cmdtype, data]] + _kept)
+        self.depth = sum([len(_item[1]) for _item in self.items]) - \
+            self.offset
+        self.maxdepth = max(self.maxdepth, self.depth)
+        self.queued += 1
+        self.held = set(hold)
+        _ok = self._flush(sock)
+        self.lock.release()
+        return _ok
+
+    def release(self):
+        '''Accept the types held back by urgent() again'''
+        self.lock.acquire()
+        self.held = set()
+        self.lock.release()
+
+    def flush(self, sock):
+        '''Send what the socket takes without blocking. Returns False on
+        a socket error.'''
+        self.lock.acquire()
+        _ok = self._flush(sock)
+        self.lock.release()
+        return _ok
+
+    def _flush(self, sock):
+        while self.items:
+            _data = self.items[0][1]
+            try:
+                _sent = sock.send(_data[self.offset:] if self.offset
+                                  else _data)
+            except (BlockingIOError, InterruptedError):
+                self.stalls += 1
+                break
+            except OSError:
+                return False
+            self.offset += _sent
+            self.depth -= _sent
+            self.bytes_out += _sent
+            if self.offset < len(_data):
+                self.stalls += 1
+                break
+            self.items.popleft()
+            self.offset = 0
+        return True
+
+    def stats(self):
+        self.lock.acquire()
+        _stats = dict([('depth', self.depth), ('items', len(self.items)),
+                       ('maxdepth', self.maxdepth), ('queued', self.queued),
+                       ('coalesced', self.coalesced),
+                       ('dropped', self.dropped),
+                       ('overflows', self.overflows),
+                       ('bytes_out', self.bytes_out),
+                       ('stalls', self.stalls)])
+        self.lock.release()
+        return _stats
+
+
+# Settings of each new rover's SendQueue (see server_daimyo.py -q)
+sendq_defaults = dict([('highwater', 4096), ('policy', 'coalesce')])
+
+
+class Waker:
+    '''
+
+    Self-pipe (a socket pair, so that select() also takes it on Windows)
+    for waking a thread blocked in select(), or an asyncio reader, from
+    another thread. wake() may be called any number of times before the
+    sleeper gets to drain() it.
+
+    '''
+
+    def __init__(self):
+        self.rsock, self.wsock = socket.socketpair()
+        self.rsock.setblocking(False)
+        self.wsock.setblocking(False)
+
+    def fileno(self):
+        return self.rsock.fileno()
+
+    def wake(self):
+        try:
+            self.wsock.send(b'x')
+        except OSError:  # Pipe full (already woken) or closed
+            pass
+
+    def drain(self):
+        try:
+            while self.rsock.recv(4096):
+                pass
+        except OSError:  # Nothing left to read
+            pass
+
+    def close(self):
+        self.rsock.close()
+        self.wsock.close()
+
+
+class SynBus:
+    '''
+
+    Broadcast bus for the <SYN,...> and <LIS,...> sequence keywords,
+    indexed by topic (the broadcast string). publish() hands a topic only
+    to rovers listening for it at that moment and wakes them. A rover
+    that starts to listen also hears a topic that another rover published
+    after 'since', the bus count at its previous match, so a rover that
+    comes late (or was paused) does not miss it.
+
+    Each rover's heard set ('syn_heard') is guarded by the bus lock, not
+    by rover.lock, so a rover can publish from its own thread without
+    taking the locks of other rovers. Per-topic counters record SYNs
+    published and listeners woken.
+
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0  # SYNs published so far
+        self.last = {}  # topic -> (count at latest SYN, sending rover)
+        self.listeners = {}  # topic -> set of listening rovers
+        self.published = collections.Counter()  # topic -> SYNs
+        self.delivered = collections.Counter()  # topic -> listeners woken
+
+    def listen(self, rover, topics, since=0):
+        '''Listen for any of 'topics' (a set). Returns True if one of them
+        was already published by another rover after 'since'.'''
+        self.lock.acquire()
+        _heard = set(_topic for _topic in topics if _topic in self.last
+                     and self.last[_topic][0] > since
+                     and self.last[_topic][1] is not rover)
+        if _heard:
+            rover.syn_heard |= _heard
+        else:
+            for _topic in topics:
+                self.listeners.setdefault(_topic, set()).add(rover)
+        self.lock.release()
+        return bool(_heard)
+
+    def unlisten(self, rover, topics):
+        self.lock.acquire()
+        for _topic in topics:
+            _rovers = self.listeners.get(_topic)
+            if _rovers is not None:
+                _rovers.discard(rover)
+                if not _rovers:
+                    del self.listeners[_topic]
+        self.lock.release()
+
+    def publish(self, topic, sender=None):
+        '''Broadcast 'topic'. Returns the number of listeners woken.'''
+        self.lock.acquire()
+        self.count += 1
+        self.last[topic] = (self.count, sender)
+        self.published[topic] += 1
+        _rovers = self.listeners.pop(topic, set())
+        if sender in _rovers:  # Rovers don't hear themselves
+            _rovers.discard(sender)
+            self.listeners[topic] = set([sender])
+        for _rover in _rovers:
+            _rover.syn_heard.add(topic)
+            for _topic in _rover.listen_str:  # Heard. Stop listening.
+                if _topic != topic and _topic in self.listeners:
+                    self.listeners[_topic].discard(_rover)
+        self.delivered[topic] += len(_rovers)
+        self.lock.release()
+        for _rover in _rovers:
+            _rover.wake()
+        return len(_rovers)
+
+    def take(self, rover):
+        '''Return (and forget) the topics that 'rover' has heard'''
+        self.lock.acquire()
+        _heard = rover.syn_heard
+        rover.syn_heard = set()
+        self.lock.release()
+        return _heard
+
+    def stats(self):
+        '''topic -> (SYNs published, listeners woken, listening now)'''
+        self.lock.acquire()
+        _stats = dict([(_topic, (self.published[_topic],
+                                 self.delivered[_topic],
+                                 len(self.listeners.get(_topic, ()))))
+                       for _topic in set(self.published) |
+                       set(self.listeners)])
+        self.lock.release()
+        return _stats
+
+
+default_synbus = SynBus()  # Shared by rovers that weren't given a bus
+
+
+class TimerHeap:
+    '''
+
+    One thread that wakes rovers when their timers expire: the end of a
+    sequence WAIT (Rover.gong) or the deadline of a command with a timeout
+    field (Rover.deadline). Timers are kept in a heap, and the thread
+    sleeps until the earliest is due, so rover threads and the asyncio
+    engine need not poll for them. A timer is never cancelled; a rover
+    woken for nothing finds nothing due in state_machine_chug().
+
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.due = threading.Condition(self.lock)
+        self.heap = []  # (time, count, rover)
+        self._count = itertools.count()
+        self.thread = None
+        self.fired = 0  # Timers that woke a rover
+        self.late = 0.0  # Largest delay (s) past a timer's time
+
+    def schedule(self, rover, when):
+        '''Wake 'rover' at time() 'when' or just after'''
+        self.lock.acquire()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run_loop,
+                                           name='TimerHeap', daemon=True)
+            self.thread.start()
+        heapq.heappush(self.heap, (when, next(self._count), rover))
+        if self.heap[0][2] is rover:
+            self.due.notify()  # Earlier than what the thread sleeps for
+        self.lock.release()
+
+    def run_loop(self):
+        self.lock.acquire()
+        while True:
+            if not self.heap:
+                self.due.wait()
+                continue
+            _now = time()
+            if self.heap[0][0] > _now:
+                self.due.wait(self.heap[0][0] - _now)
+                continue
+            _when, _n, _rover = heapq.heappop(self.heap)
+            self.fired += 1
+            self.late = max(self.late, _now - _when)
+            self.lock.release()
+            _rover.wake()
+            self.lock.acquire()
+
+    def stats(self):
+        self.lock.acquire()
+        _stats = dict([('pending', len(self.heap)), ('fired', self.fired),
+                       ('late', self.late)])
+        self.lock.release()
+        return _stats
+
+
+default_timers = TimerHeap()  # Shared by rovers that weren't given one
+
+
+class LockStats:
+    '''
+
+    Wait and hold time histograms of instrumented locks (TimedLock), keyed
+    by lock name and the call site (file:line (function)) of the outermost
+    acquire. Bucket i counts times below 'bounds[i]' seconds, the last
+    bucket the rest. Locks made by new_lock() are only instrumented once
+    'enabled' is set, so that the fleet pays nothing for it otherwise.
+
+    '''
+
+    bounds = [1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0]
+    labels = ['<1us', '<10us', '<100us', '<1ms', '<10ms', '<100ms', '<1s',
+              '>=1s']
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.wait = {}  # (name, site) -> [count, total, max, buckets]
+        self.hold = {}
+
+    def record(self, table, key, seconds):
+        self.lock.acquire()
+        _entry = table.get(key)
+        if _entry is None:
+            _entry = table[key] = [0, 0.0, 0.0, [0]*(len(self.bounds)+1)]
+        _entry[0] += 1
+        _entry[1] += seconds
+        _entry[2] = max(_entry[2], seconds)
+        _entry[3][bisect.bisect_right(self.bounds, seconds)] += 1
+        self.lock.release()
+
+    def report(self):
+        '''Histograms as text, the call sites that waited longest first'''
+        self.lock.acquire()
+        _keys = sorted(set(self.wait) | set(self.hold), key=lambda _key: (
+            -self.wait.get(_key, [0, 0.0])[1], _key))
+        _lines = ['Lock wait/hold times per call site, counts per bucket: '
+                  + ' '.join(self.labels)]
+        for _key in _keys:
+            _lines.append('%s  %s' % _key)
+            for _kind, _table in [('wait', self.wait), ('hold', self.hold)]:
+                if _key in _table:
+                    _n, _total, _max, _buckets = _table[_key]
+                    _lines.append('  %s %8d x, %10.3f ms total, %8.3f ms max'
+                                  '  [%s]' % (_kind, _n, 1e3*_total, 1e3*_max,
+                                              ' '.join(map(str, _buckets))))
+        self.lock.release()
+        if not _keys:
+            _lines.append('(no locks instrumented)')
+        return '\n'.join(_lines)
+
+
+lockstats = LockStats()  # Filled by TimedLocks
+
+
+class TimedLock:
+    '''
+
+    threading.RLock wrapper recording, into 'stats', how long each outermost
+    acquire waited for the lock and how long the lock was then held, under
+    the lock 'name' and the caller's file:line. Re-entrant acquires by the
+    owning thread are not timed separately.
+
+    '''
+
+    def __init__(self, name, stats=lockstats):
+        self.name = name
+        self.stats = stats
+        self._lock = threading.RLock()
+        self._depth = 0  # Re-entrancy depth of the owner (guarded by _lock)
+        self._site = None
+        self._since = 0.0
+
+    def acquire(self, blocking=True, timeout=-1, _frames=1):
+        _t0 = perf_counter()
+        if not self._lock.acquire(blocking, timeout):
+            return False
+        self._depth += 1
+        if self._depth == 1:
+            _frame = sys._getframe(_frames)
+            self._site = '%s:%d (%s)' % (os.path.basename(
+                _frame.f_code.co_filename), _frame.f_lineno,
+                _frame.f_code.co_name)
+            self._since = perf_counter()
+            self.stats.record(self.stats.wait, (self.name, self._site),
+                              self._since - _t0)
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self.stats.record(self.stats.hold, (self.name, self._site),
+                              perf_counter() - self._since)
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire(_frames=2)
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def new_lock(name):
+    '''RLock for 'name', timed if lock instrumentation is enabled'''
+    if lockstats.enabled:
+        return TimedLock(name)
+    return threading.RLock()
+
+
+class HeartScheduler:
+    '''
+
+    Fleet-wide heartbeat. Starting every rover's heartbeat at once brings
+    a burst of MYPOS from the whole fleet every period, so HEART commands
+    go out one at a time instead: rover i of n gets its HEART at offset
+    i*period/n, and its first beat (and every beat after it) falls in its
+    own slot. The period is the requested one, lengthened so that n rovers
+    stay under 'budget' MYPOS per second, and the fleet is re-planned when
+    a change in n moves that period by more than a fraction 'slack'.
+    Smaller changes fit new rovers into the widest gap between slots.
+
+    A rover that already beats is silenced first, and gets its HEART no
+    sooner than one of its periods later, so that it beats as the HEART
+    arrives. Rovers on the schedule are not silenced by a re-plan: they
+    keep their order and beat on until the HEART with the new period
+    reaches them in their new slot. Rover clocks drift apart over time,
+    which nothing corrects.
+
+    Calls come from the main loop and webUI callbacks, under mainlock.
+
+    '''
+
+    def __init__(self, period=0.5, budget=1000.0, slack=0.2):
+        self.period = period  # Requested period (s)
+        self.budget = budget  # MYPOS per second, 0 for no limit
+        self.slack = slack
+        self.active = False
+        self.planned = period  # Period in use (s)
+        self.base = 0.0  # Time of the slot at phase 0
+        self.phases = {}  # rover -> phase (s) in [0, planned)
+        self.pending = []  # Heap of (time, count, rover) HEARTs to send
+        self._count = itertools.count()
+        self.sent = 0  # HEARTs sent
+        self.replans = 0
+
+    def fleet_period(self, number):
+        if self.budget > 0:
+            return max(self.period, number/self.budget)
+        return self.period
+
+    def command(self, rover, cmd):
+        rover.put_command(cmd)
+
+    def enlist(self, rover, phase, now):
+        '''Queue rover's HEART for its first slot at 'phase' that leaves
+        time for a beating rover to fall silent'''
+        _earliest = now
+        if rover.heartbeat:
+            self.command(rover, '<SILENT>')
+            _earliest += rover.heartperiod
+        self.retime(rover, phase, _earliest)
+
+    def retime(self, rover, phase, earliest):
+        '''Queue rover's HEART for its first slot at 'phase' from
+        'earliest' on'''
+        _when = self.base + phase
+        if _when < earliest:
+            _when += self.planned*(
+                (earliest - _when)//self.planned + 1)
+        self.phases[rover] = phase
+        heapq.heappush(self.pending, (_when, next(self._count), rover))
+
+    def plan(self, rovers, now, keep=False):
+        '''Spread the rovers evenly over the period. With 'keep', those
+        already on the schedule keep beating, in the same order, until
+        their new slot.'''
+        _rovers = [_rover for _rover in rovers if _rover.alive]
+        _old = self.phases if keep else {}
+        _waiting = dict([(_rover, _when) for _when, _n, _rover in
+                         self.pending]) if keep else {}
+        _rovers.sort(key=lambda _rover: (_rover not in _old,
+                                         _old.get(_rover, 0.0)))
+        self.planned = self.fleet_period(len(_rovers))
+        self.base = now
+        self.phases = {}
+        self.pending = []
+        for ii, _rover in enumerate(_rovers):
+            _phase = ii*self.planned/len(_rovers)
+            if _rover in _old:  # Still silent, or already beating
+                self.retime(_rover, _phase, _waiting.get(_rover, now))
+            else:
+                self.enlist(_rover, _phase, now)
+        self.replans += 1
+
+    def start(self, rovers, now, period=None):
+        if period is not None:
+            self.period = max(period, 0.01)  # Rovers go no lower
+        self.active = True
+        self.plan(rovers, now)
+
+    def stop(self):
+        '''Forget the schedule (the caller silences the rovers)'''
+        self.active = False
+        self.phases = {}
+        self.pending = []
+
+    def timeout(self, now, longest=1.0):
+        '''How long the main loop may wait before the next HEART'''
+        if not self.pending:
+            return longest
+        return min(longest, max(0.0, self.pending[0][0] - now))
+
+    def tick(self, rovers, now):
+        '''Follow rovers joining and leaving, and send HEARTs that are
+        due'''
+        if not self.active:
+            return
+        for _rover in [_rover for _rover in self.phases
+                       if not _rover.alive]:
+            del self.phases[_rover]
+        _rovers = [_rover for _rover in rovers if _rover.alive]
+        if abs(self.fleet_period(len(_rovers)) - self.planned) > \
+                self.slack*self.planned:
+            self.plan(_rovers, now, keep=True)
+        for _rover in _rovers:
+            if _rover not in self.phases:
+                self.enlist(_rover, self.widest_gap(), now)
+        while self.pending and self.pending[0][0] <= now:
+            _when, _n, _rover = heapq.heappop(self.pending)
+            if _rover.alive and _rover in self.phases:
+                self.command(_rover, '<HEART,%d>' % round(1e3*self.planned))
+                self.sent += 1
+
+    def widest_gap(self):
+        '''Phase in the middle of the widest gap between slots'''
+        if not self.phases:
+            return 0.0
+        _phases = sorted(self.phases.values())
+        _gaps = [(_next - _phase, _phase) for _phase, _next in
+                 zip(_phases, _phases[1:] + [_phases[0] + self.planned])]
+        _gap, _phase = max(_gaps)
+        return (_phase + _gap/2) % self.planned
+
+    def stats(self):
+        return dict([('active', self.active),
+                     ('rovers', len(self.phases)),
+                     ('period', self.planned),
+                     ('requested', self.period),
+                     ('budget', self.budget),
+                     ('pending', len(self.pending)),
+                     ('sent', self.sent),
+                     ('replans', self.replans)])
+
+
+class EmergencyStop:
+    '''
+
+    Emergency-stop lane. halt() writes <HALT> to every rover's socket
+    from the calling thread, one after another, ahead of whatever waits in
+    the rover's command and send queues (see Rover.emergency_halt), and
+    without taking mainlock or any rover's lock. It does not wait for
+    rover threads, sequences or queued work; each rover drops its
+    sequence on its next pass. The time halt() took to get through the
+    fleet (dispatch), and from each rover's HALT to its next <ACK,0>,
+    are recorded.
+
+    '''
+
+    def __init__(self, keep=4096):
+        self.lock = threading.Lock()
+        self.halts = 0
+        self.dispatch = collections.deque(maxlen=keep)  # Seconds per halt()
+        self.latency = collections.deque(maxlen=keep)  # HALT to ACK (s)
+        self.failed = 0  # Sockets that failed the write
+
+    def halt(self, rovers):
+        '''HALT every live rover in 'rovers' now. Returns the seconds it
+        took.'''
+        _t0 = perf_counter()
+        _failed = 0
+        for rover in rovers:
+            if rover.alive and not rover.emergency_halt(self):
+                _failed += 1
+        _dt = perf_counter() - _t0
+        self.lock.acquire()
+        self.halts += 1
+        self.dispatch.append(_dt)
+        self.failed += _failed
+        self.lock.release()
+        return _dt
+
+    def acked(self, rover, latency):
+        '''A rover's first <ACK,0> after its emergency HALT'''
+        self.lock.acquire()
+        self.latency.append(latency)
+        self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        _latency = sorted(self.latency)
+        _stats = dict([('halts', self.halts), ('failed', self.failed),
+                       ('dispatch_last', self.dispatch[-1] if self.dispatch
+                        else None),
+                       ('dispatch_max', max(self.dispatch) if self.dispatch
+                        else None),
+                       ('acks', len(_latency))])
+        self.lock.release()
+        for _name, _q in [('p50', 0.5), ('p99', 0.99)]:
+            _stats['ack_'+_name] = _latency[int(_q*(len(_latency) - 1))] \
+                if _latency else None
+        _stats['ack_max'] = _latency[-1] if _latency else None
+        return _stats
+
+
 # Rover states
 num_states = 5
 st_dict = dict([(0, 'st_IDLE'),
@@ -149,10 +1203,27 @@ st_dict = dict([(0, 'st_IDLE'),
                 (5, 'st_SEARCH')])
 
 
+_threadcount = itertools.count(1)  # Numbers rover thread names
+# What readers (webUI, console, main loop) see of a rover. A rover
+# replaces its snapshot with a new one, 'serial' one higher, whenever a
+# field changed (see Rover.publish), so readers take no rover.lock to get
+# a consistent view of it.
+RoverSnapshot = collections.namedtuple('RoverSnapshot', [
+    'serial', 'name', 'version', 'thread', 'x', 'y', 'angle', 'state',
+    'superstate', 'heartbeat', 'loopflag'])
+# Commands whose last field is a timeout (ms). The server halts the rover
+# if it hasn't finished (ACK,0 COL FAIL TIMEOUT DOBS) shortly after.
+timed_cmds = set(['FWD', 'BWD', 'CFWD', 'CBWD', 'TURN', 'ATURN', 'CTURN',
+                  'GOTO', 'OBS', 'POBS'])
+
+
 class Rover:
 
-    def __init__(self, conn, addr, streamhandler, filehandler, loglevel):
+    def __init__(self, conn, addr, streamhandler, filehandler, loglevel,
+                 threaded=True, datalog=None, upwaker=None, synbus=None,
+                 timers=None, sendq=None):
         self.conn = conn
+        self.conn.setblocking(False)  # Written through self.sendq
         self.addr = addr
         self.logsh = streamhandler  # Stream handler for logging
         self.logfh = filehandler  # File handler for logging (main log file)
@@ -167,6 +1238,9 @@ class Rover:
         self.angold = 0.0
         self.Dxy = 0.01  # XY-precision (meters)
         self.Dangle = 1  # Angle precision (degrees)
+        # Log/show next MYPOS even inside the precision dead-band (set for
+        # the first one and after state transitions)
+        self.posforce = True
         self.maxvel = 0.01  # Maximum (latching) speed (m/s)
         self.alive = True
         self.state = 0  # st_IDLE
@@ -176,48 +1250,115 @@ class Rover:
         self.seqlist = []  # List of sequence commands
         self.numseq = 0  # Length of sequence
         self.gong = time()  # For time keeping when asked to wait
+        self.deadline = None  # When a timed command should have finished
+        self._deadline_grace = 0.5  # Beyond its timeout field (s)
+        # Wakes the rover at gong and deadline
+        self.timers = timers if timers is not None else default_timers
         self.heartbeat = False  # Whether or not in heartbeat mode
-        self.lock = threading.RLock()
-        self.cflag = False  # Flag for when server command is available
-        self.command = ''
+        self.heartperiod = 0.5  # Heartbeat period last asked for (s)
+        self.lock = new_lock('Rover.lock')
+        self.commands = CommandQueue()  # From the server, see put_command()
+        # Set by emergency_halt() (any thread). The next pass drops the
+        # sequence, and the next <ACK,0> times the HALT.
+        self.estop = False
+        self.halt_sent = None  # perf_counter() of the emergency HALT
+        self.halt_latency = None  # Seconds from the last one to its ACK
+        self.estops = 0
+        self._estop_lane = None
+        self.command = ''  # The command clean_send() sends
         self.mflag = False  # Flag for when message from rover is ready
         self.message = ''
         self.sflag = False  # Flag to pass message upstream to server thread
         self.smsg_buffer = []  # Buffer of messages meant for server thread
-        self.wflag = False  # Flag to pass info to webUI server thread
-        self.wlist = []  # List of params to send webUI server thread
+        self.wevents = EventQueue()  # Events for webUI server thread
         self.pause = False   # Whether to pause stepping through sequence
         self.pflag = False   # Used to track reply to HALT when paused
         self.pause_t_store = 0.0  # Store wait time when paused
         self.pause_s_store = 0  # Store state when paused
-        self.listen_str = []  # Strings to listen for (sequence command)
-        self.syn_str = []  # Strings broadcasted from main thread
-        self.syn_limit = 10  # Maximum number of syn broadcasts to store
+        # SYN/LIS broadcasts between rovers (see SynBus)
+        self.synbus = synbus if synbus is not None else default_synbus
+        self.listen_str = set()  # Strings to listen for (sequence command)
+        self.syn_heard = set()  # Strings heard while listening
+        self.syn_mark = self.synbus.count  # Bus count at last match
         self.ackflag = False  # Marking reception of ACK message
-        self.thread = threading.Thread(target=self.run_loop)
+        self._rogue_stream_limit = 10240  # Die if framer holds more
+        self.framer = TCPframer(maxlen=self._rogue_stream_limit,
+                                binary=binsizes())
+        self._inframes = []  # Assembled messages awaiting msg_parser
+        # Counters read by the metrics endpoint (see server_daimyo.py)
+        self.msgs_in = collections.Counter()  # Valid messages, by type
+        self.cmds_out = collections.Counter()  # Commands sent, by type
+        self.invalid = 0  # Messages that failed to parse
+        self.bytes_in = 0  # Bytes received from field rover
+        self.datalog_writes = 0  # Records handed to the datalog writer
+        self.pos_suppressed = 0  # MYPOS inside the dead-band, not passed on
+        self.last_mypos = None  # When the last MYPOS arrived
+        self.loopstats = dict([('iterations', 0), ('busy', 0.0),
+                               ('max', 0.0)])  # chug() count and times
+        # Other threads call wake() after queueing a command (put_command),
+        # changing pause or superstate (and SynBus on a match), instead of
+        # waiting for a select() timeout.
+        # 'upwaker' (main server thread) is woken when sflag is set.
+        self.waker = Waker()
+        self.upwaker = upwaker
+        self.registry = None  # Set by RoverRegistry.add() (server side)
+        # Commands waiting for the socket to take them (see send())
+        self.sendq = sendq if sendq is not None else SendQueue(
+            **sendq_defaults)
+        self._idle_timeout = 1.0  # Longest sleep when nothing is timed
+        # If not threaded, an engine (see daimyo_async.py) drives
+        # receive() and chug() instead of run_loop. The thread object is
+        # still created so that its name can identify the rover.
+        self.threaded = threaded
+        # Named 'Thread-N' explicitly: Python 3.10+ appends ' (run_loop)'
+        # to default names, and the CMD: and SEQ: console commands cannot
+        # address a name with a space in it.
+        self.thread = threading.Thread(target=self.run_loop,
+                                       name='Thread-%d' % next(_threadcount))
+        self.snapshot = RoverSnapshot(0, *self.snapshot_fields())
         # self.thread.setName(self.name)
         _ddate = datetime.datetime.now()
         self.dataprefix = 'datalogs/'+_ddate.strftime(
             '%Y_%m_%d/')+_ddate.strftime('%H_%M_%S_')
-        self.datafile = self.dataprefix+self.name+'.dat'
-        self.datfid = open(self.datafile, 'a')
+        # Datalog records are handed to one shared background writer
+        # (see daimyo_datalog.py) instead of being written here
+        self.datalog = datalog if datalog is not None else default_writer()
         _msgdat = '# ID, version, Thread: ({on}, v{ov}, {thread}) '.format(
             on=self.name, ov=self.version,
             thread=self.thread.getName())
-        self.datfid.write(_msgdat+'\n')
-        self.datfid.write('# Time (s)\tx (m)\ty (m)\tangle (deg.)\n')
-        self.datfid.flush()
+        self.datakey = self.datalog.open(
+            self.dataprefix+self.name+self.datalog.ext,
+            _msgdat+'\n# Time (s)\tx (m)\ty (m)\tangle (deg.)\n')
         self.log = logging.getLogger(self.name+':'+self.thread.getName())
         self.log.setLevel(self.loglvl)
         self.log.addHandler(self.logfh)
         self.log.addHandler(self.logsh)
-        self.thread.start()
+        if self.threaded:
+            self.thread.start()
+
+    @property
+    def datafile(self):
+        '''The datalog file as named by the writer, so with any '_N'
+        suffix it added (None until the writer has opened it)'''
+        return self.datalog.filename(self.datakey)
+
+    def snapshot_fields(self):
+        return (self.name, self.version, self.thread.getName(), self.x,
+                self.y, self.angle, self.state, self.superstate,
+                self.heartbeat, self.loopflag)
+
+    def publish(self):
+        '''Replace the snapshot if any of its fields changed (call with
+        self.lock held)'''
+        _fields = self.snapshot_fields()
+        if _fields != self.snapshot[1:]:
+            self.snapshot = RoverSnapshot(self.snapshot.serial + 1,
+                                          *_fields)
 
     def state_machine_chug(self):
         self.lock.acquire()
-        # prune syn_str list
-        if len(self.syn_str) > self.syn_limit:
-            self.syn_str.pop(0)  # Lose oldest broadcast
+        if self.deadline is not None and time() > self.deadline:
+            self.command_timeout()
         # Patrols and command sequence stuff will go here
         if self.superstate == -2 and self.seqfile != '':  # load new seq file
             if os.path.exists(self.seqfile):
@@ -273,32 +1414,30 @@ class Rover:
                     self.pause_t_store = self.gong - time()  # pending wait
                 self.pflag = False
                 self.state = 3  # st_PAUSE
-                self.wflag = True
-                self.wlist = ['ACK', self.state]  # Let webUI know state change
+                self.wevents.push(['ACK', self.state])  # Let webUI know
         elif self.superstate > -1 and self.state == 3 and not self.pause:
             # Unpaused
             self.log.info('Unpaused. Continuing sequence (%d of %d)' %
                           (self.superstate, self.numseq-1))
             self.state = self.pause_s_store
             self.pause_s_store = 0  # Reset this
-            self.wflag = True
-            self.wlist = ['ACK', self.state]  # Let webUI know state change
+            self.wevents.push(['ACK', self.state])  # Let webUI know
             if self.state == 2:  # st_WAIT
                 self.gong = time() + self.pause_t_store
+                self.timers.schedule(self, self.gong)
             elif self.state == 1:  # st_MOVE
                 self.state = 0  # st_IDLE
                 self.superstate -= 1
                 if self.superstate < 0:
                     self.superstate = self.numseq - 1
-        elif self.superstate > -1 and self.state == 4 and any(
-                string in self.syn_str for string in self.listen_str):
-            # Found a listen string in the broadcast list
+        elif self.superstate > -1 and self.state == 4 and self.syn_heard:
+            # Heard one of the listen strings
             self.state = 0  # IDLE
             self.log.info('Heard %r in broadcasts.' %
-                          set(self.listen_str).intersection(
-                              set(self.syn_str)))
-            self.listen_str = []
-            self.syn_str = []
+                          self.synbus.take(self))
+            self.synbus.unlisten(self, self.listen_str)
+            self.listen_str = set()
+            self.syn_mark = self.synbus.count  # Forget older broadcasts
         elif self.superstate > -1 and self.ackflag and self.state == 0:  # IDLE
             # ready for next sequence command
             if self.superstate >= self.numseq:
@@ -319,25 +1458,30 @@ class Rover:
                             'Sequence interrupted. Bad wait time supplied')
                     else:
                         self.gong = time() + _waitfor
+                        self.timers.schedule(self, self.gong)
                         self.state = 2  # st_WAIT
-                        self.wflag = True
-                        self.wlist = ['ACK', self.state]  # Let webUI know
+                        self.wevents.push(['ACK', self.state])  # For webUI
                         self.log.info('Started wait for %.2f seconds' %
                                       _waitfor)
                 elif self.seqlist[self.superstate][0:5] == '<SYN,':
-                    # Broadcast message found. Send to server main thread
-                    self.sflag = True
-                    self.smsg_buffer.append(self.seqlist[self.superstate])
+                    # Broadcast message found. Hand to listening rovers
+                    _topic = self.seqlist[self.superstate][5:-1]
+                    _number = self.synbus.publish(_topic, self)
+                    self.log.info("Broadcast SYN string '%s' to %d "
+                                  "listener(s)." % (_topic, _number))
                     self.superstate += 1
                 elif self.seqlist[self.superstate][0:5] == '<LIS,':
                     # Set up to listen for one of the string broadcasts
-                    self.listen_str = self.seqlist[
-                        self.superstate][5:-1].split(',')
+                    self.synbus.unlisten(self, self.listen_str)
+                    self.listen_str = set(self.seqlist[
+                        self.superstate][5:-1].split(','))
                     self.log.info('Listening for %r' % self.listen_str)
                     self.state = 4  # st_LISTEN
-                    self.wflag = True
-                    self.wlist = ['ACK', self.state]  # Let webUI know
+                    self.wevents.push(['ACK', self.state])  # Let webUI know
                     self.superstate += 1
+                    if self.synbus.listen(self, self.listen_str,
+                                          self.syn_mark):
+                        self.wake()  # Already broadcast. Go on right away.
                 else:
                     self.command = self.seqlist[self.superstate]  # payload
                     self.log.info('Continuing sequence at %d of %d.' % (
@@ -352,271 +1496,440 @@ class Rover:
         elif self.superstate == -2:
             self.log.warning('No sequence file supplied.')
             self.superstate = -1
+        self.publish()
         self.lock.release()
 
     def msg_parser(self):
         '''Parse messages received from field rover and take action'''
-        _floatflag = True
-        _valid, _type, _fields = cmdparse(
+        _status, _type, _values = protoparse(
             version=self.version, kind='msg', instr=self.message)
-        if not _valid:
+        if _status != 0:
+            self.invalid += 1
+        if _status == 1:
             self.log.warning("Received invalid message: %s" % self.message)
+        elif _status == 2:  # Empty fields
+            self.log.warning("Received empty field(s): %s"
+                             % self.message)
+        elif _status == 3:  # Fields not of expected type
+            self.log.warning("Received bad field(s): %s"
+                             % self.message)
         else:
+            self.msgs_in[_type] += 1
             self.log.debug("Processing: %s" % self.message)
-            if _type != 'ACK' and '' in _fields:  # Check for empty fields
-                self.log.warning("Received empty field(s): %s"
-                                 % self.message)
-                _floatflag = False
-            elif _type not in ['ACK', 'MYID', 'RFID']:
-                # Check if float cast-able
-                try:
-                    [float(ii) for ii in _fields]
-                except ValueError:
-                    self.log.warning("Received bad field(s): %s"
-                                     % self.message)
-                    _floatflag = False
-
-            if _floatflag:
-                if _type == 'MYID':
-                    if [self.name, self.version] != [str(_fields[0]),
-                                                     str(_fields[1])]:
-                        # Change data logging file name
-                        self.datfid.close()
-                        os.rename(
-                            self.datafile, self.dataprefix+str(
-                                _fields[0])+'.dat')
-                        self.datafile = self.dataprefix+str(_fields[0])+'.dat'
-                        self.datfid = open(self.datafile, 'a')
-                        _msgdat = '# ID: ({on}, v{ov})'.format(
-                            on=self.name, ov=self.version)
-                        _msgdat += ' -> ({nn}, v{nv})'.format(
-                            nn=_fields[0], nv=_fields[1])
-                        self.datfid.write(_msgdat+'\n')
-                        self.datfid.flush()
-                    self.name = str(_fields[0])
-                    self.version = str(_fields[1])
-                    self.log.info("Changing (name, version) to (%s, %s)" %
-                                  (self.name, self.version))
-                    for _handler in self.log.handlers:
-                        _handler.close()
-                        self.log.removeFilter(_handler)
-                    self.log = logging.getLogger(
-                        self.name+':'+self.thread.getName())
-                    self.log.setLevel(self.loglvl)
-                    self.log.addHandler(self.logfh)
-                    self.log.addHandler(self.logsh)
-                    self.sflag = True  # Report ID change to main server
-                    self.smsg_buffer.append(self.message)
-                    self.wflag = True  # Report ID change to webUI
-                    self.wlist = [_type, self.name, self.version]
-                elif _type == 'MYPOS':
-                    [self.x, self.y, self.angle] = [
-                        float(_fields[0]), float(_fields[1]),
-                        float(_fields[2])]
-                    if [self.xold, self.yold, self.angold] != [
-                            self.x, self.y, self.angle]:
-                        # _msgdat = '{t}\t{x}\t{y}'.format(
-                        #     t=time(), x=self.x, y=self.y)
-                        _msgdat = '%.1f\t%.3f\t%.3f\t%.3f\n' % (
-                            time(), self.x, self.y, self.angle)
-                        self.datfid.write(_msgdat)
-                        self.datfid.flush()
-                        [self.xold, self.yold, self.angold] = [
-                            self.x, self.y, self.angle]
-                    if self.ackflag and self.state == 0:  # st_IDLE
-                        if self.superstate == -1:
-                            self.ackflag = False
-                        self.log.info(
-                            "Updated POS to (%.3f, %.3f, %.3f)" %
-                            (self.x, self.y, self.angle))
-                    else:
-                        self.log.debug(
-                            "Updated POS to (%.3f, %.3f, %.3f)" %
-                            (self.x, self.y, self.angle))
-                    self.wflag = True  # Send upstream to webUI thread
-                    self.wlist = [_type, self.x, self.y, self.angle]
-                elif _type == 'MYPRES':
-                    [self.Dxy, self.Dangle] = [float(_fields[0]),
-                                               float(_fields[1])]
-                    self.log.info("Updated PRES to (%.3f, %.3f)" %
-                                  (self.Dxy, self.Dangle))
-                elif _type == 'MYMAXV':
-                    self.maxvel = float(_fields[0])
-                    self.log.info("Updated maxvel to %.3f" % self.maxvel)
-                elif _type == 'ACK':
-                    self.ackflag = True
-                    if _fields[0] == '':
-                        self.log.debug("Received <ACK,>")
-                    else:
-                        try:
-                            _tempflag = int(_fields[0]) < num_states
-                        except ValueError:
-                            self.log.warning("Received bad fields: %s" %
-                                             self.message)
-                            _tempflag = False
-                        if _tempflag:
-                            if int(_fields[0]) != self.state:
-                                self.log.debug("State changed: %s->%s" %
-                                               (st_dict[self.state],
-                                                st_dict[int(_fields[0])]))
-                            self.state = int(_fields[0])
-                            self.wflag = True  # Send upstream to webUI thread
-                            self.wlist = [_type, self.state]
-                elif _type == 'COL':
-                    self.wflag = True  # Report obstacle to webUI thread
-                    self.wlist = [_type, float(_fields[0]), float(_fields[1])]
-                    self.log.debug("Collision reported: %s" % self.message)
-                elif _type in ['FAIL', 'TIMEOUT']:
-                    self.sflag = True  # Report this to main server thread
-                    self.smsg_buffer.append(self.message)
-                    if _type == 'FAIL':
-                        self.log.warning("Failure reported!")
-                        try:
-                            self.conn.sendall('<HALT>'.encode())
-                        except OSError:
-                            self.die()
-                        self.superstate = -1
-                    else:
-                        self.log.debug("Timeout reproted!")
-                        self.paused = True  # timeout => sequence paused
-                elif _type == 'DOBS':
-                    self.wflag = True  # Report dist to webUI thread
-                    self.wlist = [_type, float(_fields[0])]
-                    self.log.debug("Distance from obstacle: %s" %
-                                   self.message)
-                elif _type == 'BYE':  # Field rover is closing connection
-                    self.log.info("Rover is closing connection.")
-                    self.die()
-                elif _type == 'RFID':  # Found an RFID, report upstream
-                    self.log.info("Found: %s" % self.message)
-                    self.sflag = True  # Report RFID tag to main server
-                    self.smsg_buffer.append(self.message)
+            _handler = protocols[self.version].handler(_type)
+            if _handler is not None:
+                _handler(self, _values)
         self.mflag = False
         return True
 
+    # Handlers of messages from field rover, registered with Protocol
+    def on_myid(self, values):
+        if values[1] not in protocols:
+            self.log.warning("Unknown version: %s" % self.message)
+            return
+        if [self.name, self.version] != values:
+            # Change data logging file name
+            _msgdat = '# ID: ({on}, v{ov})'.format(
+                on=self.name, ov=self.version)
+            _msgdat += ' -> ({nn}, v{nv})'.format(
+                nn=values[0], nv=values[1])
+            self.datalog.rename(self.datakey,
+                                self.dataprefix+values[0]+self.datalog.ext,
+                                _msgdat+'\n')
+        [self.name, self.version] = values
+        if self.registry is not None:
+            self.registry.reindex(self)
+        self.log.info("Changing (name, version) to (%s, %s)" %
+                      (self.name, self.version))
+        for _handler in self.log.handlers:
+            _handler.close()
+            self.log.removeFilter(_handler)
+        self.log = logging.getLogger(
+            self.name+':'+self.thread.getName())
+        self.log.setLevel(self.loglvl)
+        self.log.addHandler(self.logfh)
+        self.log.addHandler(self.logsh)
+        self.pass_up()  # Report ID change to main server
+        # Report ID change to webUI
+        self.wevents.push(['MYID', self.name, self.version])
+
+    def outside_deadband(self):
+        '''Whether x/y/angle moved by the rover's precision (Dxy, Dangle)
+        or more since the position last logged'''
+        return (math.hypot(self.x - self.xold, self.y - self.yold) >=
+                self.Dxy or
+                abs((self.angle - self.angold + 180) % 360 - 180) >=
+                self.Dangle)
+
+    def on_mypos(self, values):
+        # x/y/angle always hold the latest report. It is only logged and
+        # shown when outside the dead-band around the last one logged.
+        [self.x, self.y, self.angle] = values
+        self.last_mypos = time()
+        _passon = self.posforce or self.outside_deadband()
+        if _passon:
+            self.posforce = False
+            if [self.xold, self.yold, self.angold] != values:
+                self.datalog.write(self.datakey, (self.last_mypos, self.x,
+                                                  self.y, self.angle))
+                self.datalog_writes += 1
+                [self.xold, self.yold, self.angold] = values
+        else:
+            self.pos_suppressed += 1
+        if self.ackflag and self.state == 0:  # st_IDLE
+            if self.superstate == -1:
+                self.ackflag = False
+            self.log.info(
+                "Updated POS to (%.3f, %.3f, %.3f)" %
+                (self.x, self.y, self.angle))
+        else:
+            self.log.debug(
+                "Updated POS to (%.3f, %.3f, %.3f)" %
+                (self.x, self.y, self.angle))
+        # Send upstream to webUI thread
+        if _passon:
+            self.wevents.push(['MYPOS', self.x, self.y, self.angle])
+
+    def on_mypres(self, values):
+        [self.Dxy, self.Dangle] = values
+        self.log.info("Updated PRES to (%.3f, %.3f)" %
+                      (self.Dxy, self.Dangle))
+
+    def on_mymaxv(self, values):
+        self.maxvel = values[0]
+        self.log.info("Updated maxvel to %.3f" % self.maxvel)
+
+    def on_ack(self, values):
+        self.ackflag = True
+        if values[0] is None:
+            self.log.debug("Received <ACK,>")
+        elif values[0] < num_states:
+            if values[0] == 0:  # st_IDLE, done with any timed command
+                self.deadline = None
+                if self.halt_sent is not None:  # After an emergency HALT
+                    self.halt_latency = perf_counter() - self.halt_sent
+                    self.halt_sent = None
+                    if self._estop_lane is not None:
+                        self._estop_lane.acked(self, self.halt_latency)
+            if values[0] != self.state:
+                self.log.debug("State changed: %s->%s" %
+                               (st_dict[self.state],
+                                st_dict[values[0]]))
+                self.posforce = True  # e.g. the final MYPOS of a move
+            self.state = values[0]
+            self.wevents.push(['ACK', self.state])  # Send to webUI thread
+
+    def on_col(self, values):
+        self.deadline = None
+        # Report obstacle to webUI thread
+        self.wevents.push(['COL', values[0], values[1]])
+        self.log.debug("Collision reported: %s" % self.message)
+
+    def on_fail(self, values):
+        self.pass_up()  # Report this to main server thread
+        self.log.warning("Failure reported!")
+        self.deadline = None
+        self.send('HALT', '<HALT>')
+        self.superstate = -1
+
+    def on_timeout(self, values):
+        self.deadline = None
+        self.pass_up()  # Report this to main server thread
+        self.log.debug("Timeout reproted!")
+        if self.superstate > -1:
+            self.pause = True  # timeout => sequence paused
+
+    def on_dobs(self, values):
+        self.deadline = None
+        self.wevents.push(['DOBS', values[0]])  # Report dist to webUI
+        self.log.debug("Distance from obstacle: %s" %
+                       self.message)
+
+    def on_bye(self, values):  # Field rover is closing connection
+        self.log.info("Rover is closing connection.")
+        self.die()
+
+    def on_rfid(self, values):  # Found an RFID, report upstream
+        self.log.info("Found: %s" % self.message)
+        self.pass_up()  # Report RFID tag to main server
+
     def clean_send(self):
         '''Check if valid command, then send to field rover'''
-        _sendflag = True
-        _valid, _type, _fields = cmdparse(
+        _status, _type, _values = protoparse(
             version=self.version, kind='cmd', instr=self.command)
-        if not _valid:
-            _sendflag = False
-        else:
-            # Handle optional fields and decide if to check for floats
-            # List of _types where last field is optional
-            if _type in ['SETPOS', 'SETPRES', 'HEART', 'CFWD', 'CBWD',
-                         'FWD', 'BWD',
-                         'TURN', 'ATURN', 'CTURN', 'GOTO', 'OBS', 'POBS']:
-                # This next line won't be sent.
-                _fields[-1] = '0' if _fields[-1] == '' else _fields[-1]
-            # List of _types where second-last field is optional
-            if _type in ['FWD', 'BWD', 'CFWD', 'CBWD', 'GOTO', 'OBS', 'POBS']:
-                # This lext line won't be sent.
-                _fields[-2] = '0' if _fields[-2] == '' else _fields[-2]
-            if _type == 'GOTO':  # This one has third-last field optional
-                _fields[-3] = '0' if _fields[-3] == '' else _fields[-3]
-            if _type in ['SEARCH']:
-                _fields[0] = '0' if _fields[0] == '' else _fields[0]
-                _fields[1] = '0'
-
-            try:  # Check if float cast-able. Works with empty list
-                [float(ii) for ii in _fields]
-            except ValueError:
-                _sendflag = False
-
+        # Not sent if the send queue dropped it or closed the connection
+        _sendflag = _status == 0 and self.send(_type, self.command) == 0
         if _sendflag:
+            self.log.info("Sent: %s" % self.command)
             if _type == 'HEART':
                 self.heartbeat = True
-                self.wflag = True
-                self.wlist = ['HEART']
+                if _values[0] is not None:
+                    self.heartperiod = max(1e-3*_values[0], 0.01)
+                self.wevents.push(['HEART'])
+            elif _type in timed_cmds and _values[-1]:  # None/0: untimed
+                self.deadline = time() + 1e-3*_values[-1] + \
+                    self._deadline_grace
+                self.timers.schedule(self, self.deadline)
+            elif _type in timed_cmds or _type == 'HALT':
+                self.deadline = None
             elif _type == 'SILENT':
                 self.heartbeat = False
-                self.wflag = False
-                self.wlist = ['SILENT']
-            try:
-                self.conn.sendall(self.command.encode())
-                self.log.info("Sent: %s" % self.command)
-            except OSError:
-                self.die()
-        else:
+                self.wevents.push(['SILENT'])
+        elif _status != 0:
             self.log.warning('Bad command string: %s' % self.command)
-            _sendflag = False
         self.command = ''
-        self.cflag = False
         return _sendflag
 
+    def put_command(self, command):
+        '''Queue a command from the server for the field rover (from any
+        thread, no need to hold self.lock). Returns False if the command
+        queue is full.'''
+        _queued = self.commands.put(command)
+        if not _queued:
+            self.log.warning('Command queue full, refused: %s' % (command,))
+        self.wake()
+        return _queued
+
+    def apply_local(self, command):
+        '''Apply a queued command meant for this object (call with
+        self.lock held): ('PAUSE', flag) sets the sequence pause flag, and
+        ('SEQ', seqfile) has state_machine_chug() load and start a
+        sequence file'''
+        if command[0] == 'PAUSE':
+            self.pause = command[1]
+        elif command[0] == 'SEQ':
+            self.seqfile = command[1]
+            self.superstate = -2
+            self.ackflag = False
+            self.state = 0  # IDLE
+
+    def emergency_halt(self, lane=None):
+        '''Write <HALT> to the field rover now, from any thread, ahead of
+        waiting commands. Waiting motion commands are dropped, and refused
+        until the next pass, which also drops any sequence. Takes no rover
+        lock, only the send queue's. Returns False on a socket error.'''
+        self._estop_lane = lane
+        self.commands.drop(CommandQueue.motion)
+        self.halt_sent = perf_counter()
+        _ok = self.sendq.urgent(self.conn, 'HALT', b'<HALT>',
+                                CommandQueue.motion)
+        self.estops += 1
+        self.estop = True  # After urgent(), so the pass releases its hold
+        self.wake()
+        self.log.info('Sent: <HALT> (emergency)')
+        return _ok
+
+    def send(self, cmdtype, command):
+        '''Send a command to the field rover, queueing what the socket
+        doesn't take now (call with self.lock held). Returns the status of
+        SendQueue.send().'''
+        _status = self.sendq.send(self.conn, cmdtype, command.encode())
+        if _status == 0:
+            self.cmds_out[cmdtype] += 1
+        elif _status == 1:
+            self.log.info('Dropped by the send queue: %s' % command)
+        elif _status == 2:
+            self.log.warning('%d bytes waiting to be sent. Closing '
+                             'connection.' % self.sendq.depth)
+            self.die()
+        else:
+            self.die()
+        return _status
+
+    def flush(self):
+        '''Send queued commands, once the socket is writable'''
+        self.lock.acquire()
+        if self.alive and not self.sendq.flush(self.conn):
+            self.die()
+        self.lock.release()
+
     def die(self):
+        self.lock.acquire()
+        if not self.alive:  # A failed send and a failed recv both get here
+            self.lock.release()
+            return
+        self.alive = False
+        self.lock.release()
         for _handler in self.log.handlers:
             _handler.close()
             self.log.removeFilter(_handler)
-        self.datfid.close()
+        self.datalog.close(self.datakey)
         self.conn.close()
+        self.synbus.unlisten(self, self.listen_str)
+        self.waker.wake()  # Let run_loop see that it is dead
+        self.wake_server()  # So that it gets pruned
+        self.log.info('Died.')
+
+    def command_timeout(self):
+        '''A timed command went past its timeout (and some grace) without
+        word from the field rover. Stop it, and handle as a TIMEOUT.'''
+        self.deadline = None
+        self.log.warning('Timed command not finished within its timeout.')
+        if self.superstate == -1:  # Otherwise the sequence pause halts it
+            self.command = '<HALT>'
+            self.clean_send()
+        self.message = '<TIMEOUT>'
+        self.on_timeout([])
+
+    def wake(self):
+        '''Wake whatever serves this rover (run_loop or an engine)'''
+        self.waker.wake()
+
+    def pass_up(self):
+        '''Pass the current message to the server thread (call with
+        self.lock held). The main loop reads sflag without the lock and
+        clears it before taking messages, so the message goes in first.
+        sflag is not in the snapshot: passing a message up makes none.'''
+        self.smsg_buffer.append(self.message)
+        self.sflag = True
+        self.wake_server()
+
+    def wake_server(self):
+        if self.upwaker is not None:
+            self.upwaker.wake()
+
+    def timeout(self):
+        '''Seconds until state_machine_chug() has work to do'''
+        if self.superstate == -2 or (self.superstate > -1 and self.ackflag
+                                     and self.state == 0 and not self.pause):
+            return 0.0  # Sequence to load, or ready for its next step
+        return self._idle_timeout  # self.timers wakes it for gong, deadline
+
+    def receive(self, packet):
+        '''Append a packet from field rover to input buffer.
+        Returns False if the rover died as a result.'''
+        if not packet:
+            # _message has no content. Die.
+            self.die()
+            return False
+        self.bytes_in += len(packet)
+        self._inframes.extend(self.framer.feed(packet))
+        if len(self.framer) > 2048:
+            self.log.warning('framer length: %d' % len(self.framer))
+        if self.framer.overflow:
+            self.log.warning('Rogue stream. Closing connection.')
+            self.die()
+            return False
+        return True
+
+    def chug(self):
+        '''Steps 2-4 of run_loop that come after reading the socket.'''
+        _t0 = time()
+        # 2. Process every message assembled from field rover
+        if self._inframes:
+            self.lock.acquire()
+            for _frame in self._inframes:
+                if not self.alive:
+                    break
+                self.message = _frame
+                self.mflag = True
+                self.msg_parser()
+            self._inframes = []
+            self.publish()
+            self.lock.release()
+
+        # Emergency HALT was sent (see emergency_halt). Drop any sequence.
+        if self.estop:
+            self.lock.acquire()
+            self.estop = False
+            self.sendq.release()
+            self.superstate = -1
+            self.deadline = None
+            self.publish()
+            self.lock.release()
+
+        # 3. Process commands from server, in order
+        if self.commands:
+            self.lock.acquire()
+            _command = self.commands.get()
+            while _command is not None and self.alive:
+                if isinstance(_command, tuple):  # Not for the field rover
+                    self.apply_local(_command)
+                    _command = self.commands.get()
+                    continue
+                self.command = _command
+                if self.superstate != -1 and self.command[0:4] not in [
+                        '<HEA', '<SIL']:
+                    # If in middle of command sequence
+                    self.send('HALT', '<HALT>')
+                    self.superstate = -1
+                self.clean_send()
+                _command = self.commands.get()
+            self.publish()
+            self.lock.release()
+
+        # 4. Perform command sequence executions
+        self.state_machine_chug()
+        _t0 = time() - _t0
+        self.loopstats['iterations'] += 1
+        self.loopstats['busy'] += _t0
+        self.loopstats['max'] = max(self.loopstats['max'], _t0)
+
+    def metrics(self):
+        '''Snapshot of the counters, for the metrics endpoint'''
         self.lock.acquire()
-        self.alive = False
+        _snapshot = dict([
+            ('name', self.name), ('version', self.version),
+            ('thread', self.thread.getName()),
+            ('msgs_in', dict(self.msgs_in)),
+            ('cmds_out', dict(self.cmds_out)),
+            ('invalid', self.invalid), ('bytes_in', self.bytes_in),
+            ('datalog_writes', self.datalog_writes),
+            ('pos_suppressed', self.pos_suppressed),
+            ('mypos_age', None if self.last_mypos is None
+             else time() - self.last_mypos),
+            ('smsg_buffer', len(self.smsg_buffer)),
+            ('cmdq', self.commands.stats()),
+            ('estops', self.estops),
+            ('halt_latency', self.halt_latency),
+            ('sendq', self.sendq.stats()),
+            ('loop', dict(self.loopstats))])
         self.lock.release()
-        self.log.info('Died.')
+        return _snapshot
 
     def run_loop(self):
 
-        _inbuffer = ''
-        _msgstate = 0
-        _rogue_stream_limit = 10240
         while self.alive:
             # 1. Handle message assembly from field rover
             # 2. Handle assembled message from field rover
             # 3. Handle new commands from server to change state
             # 4. Handle timed execution of current command and state
 
-            # 1. Message assembly, append received packets to _inbuffer
+            # 1. Message assembly, feed received packets to framer.
+            # Sleep until data, a wake() from another thread, or timed work
+            # (and until the socket takes queued commands)
             inl, outl, exl = select.select(
-                [self.conn], [], [], 0.1)  # timeout necessary
+                [self.conn, self.waker], [self.conn] if self.sendq else [],
+                [], self.timeout())
+            if self.waker in inl:
+                self.waker.drain()
+            if not self.alive:
+                break
+            if self.conn in outl:
+                self.flush()
             if self.conn in inl:
                 try:
-                    _inpacket = self.conn.recv(2048).decode()
+                    _inpacket = self.conn.recv(2048)
+                except BlockingIOError:  # Nothing after all
+                    pass
                 except socket.error:
                     self.die()
                     break
                 else:
-                    pass
-                if not _inpacket:
-                    # _message has no content. Die.
-                    self.die()
-                    break
-                _inbuffer += _inpacket
-                if len(_inbuffer) > 2048:
-                    self.log.warning('_inbuffer length: %d' %
-                                     len(_inbuffer))
-                    if len(_inbuffer) > _rogue_stream_limit:
-                        self.die()
+                    if not self.receive(_inpacket):
                         break
-            # Eat through _inbuffer for message assembly
-            if _msgstate != 2 and _inbuffer != '':
-                self.message, _inbuffer, _msgstate = TCPcompose(
-                    growstr=self.message, newstr=_inbuffer,
-                    messagestate=_msgstate)
-            if _msgstate == 2:  # valid message has been assembled
-                self.mflag = True
+            self.chug()
+        self.waker.close()
 
-            # 2. Process message from field rover
-            if self.mflag:
-                self.lock.acquire()
-                self.msg_parser()
-                _msgstate = 0
-                self.lock.release()
-
-            # 3. Process commands from server
-            if self.cflag:
-                self.lock.acquire()
-                if self.superstate != -1 and self.command[0:4] not in [
-                        '<HEA', '<SIL']:
-                    # If in middle of command sequence
-                    try:
-                        self.conn.sendall('<HALT>'.encode())
-                    except OSError:
-                        self.die()
-                    self.superstate = -1
-                self.clean_send()
-                self.lock.release()
 
-            # 4. Perform command sequence executions
-            self.state_machine_chug()
+protocols['0'].handlers.update([('MYID', Rover.on_myid),
+                                ('MYPOS', Rover.on_mypos),
+                                ('MYPRES', Rover.on_mypres),
+                                ('MYMAXV', Rover.on_mymaxv),
+                                ('ACK', Rover.on_ack),
+                                ('COL', Rover.on_col),
+                                ('FAIL', Rover.on_fail),
+                                ('TIMEOUT', Rover.on_timeout),
+                                ('DOBS', Rover.on_dobs),
+                                ('BYE', Rover.on_bye)])
+protocols['0_RFID'].handlers.update([('RFID', Rover.on_rfid)])
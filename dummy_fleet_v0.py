@@ -0,0 +1,411 @@
+# Simulate a fleet of field rovers for command_and_control_server in one
+# process. Each virtual rover behaves like dummy_rover_v0.py and has its
+# own TCP connection, but the motion of all of them is integrated at once.
+import socket
+import os
+import selectors
+import sys
+import logging
+import getopt
+import numpy as np
+from daimyo_utils import TCPframer, cmdparse
+from time import time, sleep, process_time
+
+inbufmax = 32  # Same command buffer size as dummy_rover_v0.py
+verb_dict = dict([('HALT', 0),
+                  ('FWD', 1),
+                  ('BWD', 2),
+                  ('CFWD', 3),
+                  ('CBWD', 4),
+                  ('TURN', 5),
+                  ('ATURN', 6),
+                  ('CTURN', 7),
+                  ('GOTO', 8),
+                  ('OBS', 9),
+                  ('POBS', 10)])
+
+
+def shortest_turn(destang, angle):
+    '''Signed turn (deg.) from angle to destang, as dummy_rover_v0.py'''
+    diffang = destang-angle
+    if abs(diffang) > 180:
+        diffang = np.sign(diffang)*(abs(diffang) - 360)
+    if abs(destang-angle) == 180:
+        diffang = 180
+    return diffang
+
+
+class Fleet:
+    '''
+
+    'number' virtual version '0' rovers. Rover ii's state is element ii of
+    the numpy arrays below. Commands from the server are handled per
+    rover as they arrive. Once per tick, positions and angles of all
+    moving rovers are integrated together. Only rovers that finish a
+    move or owe a heartbeat message are then visited one by one.
+
+    '''
+
+    def __init__(self, number, address='localhost', port=8081,
+                 prefix='Sim'):
+        self.number = number
+        self.names = ['%s%d' % (prefix, ii) for ii in range(number)]
+        self.version = '0'
+        self.x = 2*np.random.random(number)-1
+        self.y = 2*np.random.random(number)-1
+        self.angle = 360*np.random.random(number)
+        self.Nangle = np.full(number, 90.0)  # Between north and x-axis
+        self.Dxy = np.full(number, 0.01)  # Precision (meters)
+        self.Dangle = np.full(number, 1.0)  # Precision (degrees)
+        self.maxvel = 0.5  # Maximum speed (m/s)
+        self.defvel = 0.3  # Default speed (m/s)
+        self.vx = np.zeros(number)
+        self.vy = np.zeros(number)
+        self.angvel = np.full(number, 45.0)  # Angular speed (deg./s)
+        self.heartbeat = np.zeros(number, dtype=bool)
+        self.heartperiod = np.full(number, 0.5)  # Seconds
+        self.heart = np.zeros(number)  # Time of last heartbeat
+        self.state = np.zeros(number, dtype=int)  # 0: st_IDLE, 1: st_MOVE
+        self.move = np.zeros(number, dtype=int)  # verb_dict value
+        self.step = np.zeros(number, dtype=int)  # GOTO: turn, fwd, turn
+        self.gong = np.zeros(number)  # End time of timed moves
+        self.ping = np.zeros(number)  # Time of last integration
+        self.goto_x = np.zeros(number)
+        self.goto_y = np.zeros(number)
+        self.goto_vel = np.zeros(number)
+        self.goto_ang = np.zeros(number)  # Final angle (GOTO and TURN)
+        self.goto_destang = np.zeros(number)
+        self.alive = np.zeros(number, dtype=bool)
+        self.framers = [TCPframer(maxlen=inbufmax) for ii in range(number)]
+        self.socks = [None]*number
+        self.selector = selectors.DefaultSelector()
+        self.sent = 0  # Messages sent
+        self.received = 0  # Commands received
+        self.log = logging.getLogger('%s[%d]' % (prefix, number))
+        self.connect(address, port)
+
+    def connect(self, address, port, burst=8, timeout=10.0):
+        '''Open the connections 'burst' at a time (one by one, each connect()
+        waits for a round trip, while too many at once overflow the server's
+        listen() backlog), and introduce every rover'''
+        _pending = selectors.DefaultSelector()
+        _next = 0
+        while _next < self.number or _pending.get_map():
+            while _next < self.number and len(_pending.get_map()) < burst:
+                _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                _sock.setblocking(False)
+                _sock.connect_ex((address, port))
+                self.socks[_next] = _sock
+                _pending.register(_sock, selectors.EVENT_WRITE,
+                                  [_next, time() + timeout])
+                _next += 1
+            _now = time()
+            for key in list(_pending.get_map().values()):
+                if key.data[1] < _now:
+                    self.log.warning('%s could not connect: timed out' %
+                                     self.names[key.data[0]])
+                    _pending.unregister(key.fileobj)
+                    key.fileobj.close()
+            for key, mask in _pending.select(0.1):
+                ii = key.data[0]
+                _pending.unregister(self.socks[ii])
+                _error = self.socks[ii].getsockopt(socket.SOL_SOCKET,
+                                                   socket.SO_ERROR)
+                if _error:
+                    self.log.warning('%s could not connect: %s' % (
+                        self.names[ii], os.strerror(_error)))
+                    self.socks[ii].close()
+                    continue
+                self.socks[ii].setblocking(True)
+                self.alive[ii] = True
+                self.selector.register(self.socks[ii], selectors.EVENT_READ,
+                                       ii)
+                self.send(ii, '<MYID,%s,%s>' % (self.names[ii],
+                                                self.version))
+                self.send(ii, self.posmsg(ii))
+        _pending.close()
+
+    def posmsg(self, ii):
+        return '<MYPOS,%.3f,%.3f,%.3f>' % (self.x[ii], self.y[ii],
+                                           self.angle[ii])
+
+    def send(self, ii, sendmsg):
+        if not self.alive[ii]:
+            return
+        try:
+            self.socks[ii].sendall(sendmsg.encode('latin-1'))
+        except OSError as e:
+            self.log.info('%s could not send: %s' % (self.names[ii], e))
+            self.close(ii)
+        else:
+            self.sent += 1
+
+    def close(self, ii):
+        if self.alive[ii]:
+            self.alive[ii] = False
+            self.selector.unregister(self.socks[ii])
+            self.socks[ii].close()
+            self.move[ii] = verb_dict['HALT']
+            self.heartbeat[ii] = False
+
+    def receive(self, ii):
+        try:
+            _inpacket = self.socks[ii].recv(2048)
+        except OSError:
+            _inpacket = b''
+        if not _inpacket:  # Server closed connection
+            self.log.info('%s: server died.' % self.names[ii])
+            self.close(ii)
+            return
+        for _command in self.framers[ii].feed(_inpacket):
+            self.received += 1
+            self.respond_to_server_cmd(ii, _command)
+            if not self.alive[ii]:
+                break
+
+    def respond_to_server_cmd(self, ii, servercommand):
+        sendmsg = ''
+        self.log.debug("%s processing: %s" % (self.names[ii], servercommand))
+        valid, type, fields = cmdparse(version=self.version, kind='cmd',
+                                       instr=servercommand)
+        if not valid:
+            self.log.warning("%s received invalid command: %s" %
+                             (self.names[ii], servercommand))
+        elif type == 'ID':  # Server is asking for ID
+            sendmsg = '<MYID,%s,%s>' % (self.names[ii], self.version)
+        elif type == 'POS':  # Server is asking for position
+            sendmsg = self.posmsg(ii)
+        elif type == 'SETPOS':  # Server is setting position
+            [self.x[ii], self.y[ii]] = [float(fields[0]), float(fields[1])]
+            if fields[2]:
+                self.Nangle[ii] = float(fields[2])
+            self.angle[ii] = self.Nangle[ii]
+            sendmsg = self.posmsg(ii)
+        elif type == 'PRES':  # Server is asking for precision
+            sendmsg = '<MYPRES,%.3f,%.3f>' % (self.Dxy[ii], self.Dangle[ii])
+        elif type == 'SETPRES':  # Server is setting precision
+            self.Dxy[ii] = float(fields[0])
+            if fields[1]:
+                self.Dangle[ii] = float(fields[1])
+            sendmsg = '<ACK,>'
+        elif type == 'MAXVEL':  # Server is asking for max speed
+            sendmsg = '<MYMAXV,%.3f>' % self.maxvel
+        elif type == 'HEART':  # Server is asking for position periodically
+            self.heartbeat[ii] = True
+            if fields[0]:
+                self.heartperiod[ii] = max(float(fields[0])*1e-3, 0.01)
+            sendmsg = '<ACK,>'
+        elif type == 'SILENT':  # Server is asking to stop periodic updates
+            self.heartbeat[ii] = False
+            sendmsg = '<ACK,>'
+        elif type in verb_dict:
+            sendmsg = self.begin_move(ii, type, fields, time())
+        elif type == 'DIE':  # Server is closing connection
+            self.close(ii)
+        if sendmsg:
+            self.send(ii, sendmsg)
+
+    def begin_move(self, ii, type, fields, now):
+        '''Start a verb command. Returns the reply for the server, <FAIL>
+        for a timed move at zero speed (which would never end).'''
+        if ((type in ['FWD', 'BWD'] and fields[1] != '' and
+             float(fields[1]) == 0) or
+                (type == 'GOTO' and fields[2] != '' and
+                 float(fields[2]) == 0)):
+            self.log.warning('%s refused %s at zero speed.' %
+                             (self.names[ii], type))
+            return '<FAIL>'
+        self.move[ii] = verb_dict[type]
+        self.step[ii] = 0
+        self.ping[ii] = now
+        if type == 'HALT':
+            self.angle[ii] = self.angle[ii] % 360
+            self.state[ii] = 0  # st_IDLE
+            return '<ACK,0>'+self.posmsg(ii)
+        if type in ['OBS', 'POBS']:  # Not simulated (as dummy_rover_v0)
+            return ''
+        self.state[ii] = 1  # st_MOVE
+        if type in ['FWD', 'BWD']:
+            speed = float(fields[1]) if fields[1] != '' else self.defvel
+            speed = min(speed, self.maxvel)
+            self.gong[ii] = abs(float(fields[0]))/speed + now
+        elif type in ['CFWD', 'CBWD']:
+            speed = abs(float(fields[0])) if fields[0] != '' else self.defvel
+            speed = min(speed, self.maxvel)
+        if type in ['FWD', 'BWD', 'CFWD', 'CBWD']:
+            _sign = -1 if type in ['BWD', 'CBWD'] else 1
+            self.vx[ii] = _sign*speed*np.cos(np.radians(self.angle[ii]))
+            self.vy[ii] = _sign*speed*np.sin(np.radians(self.angle[ii]))
+        elif type == 'TURN':
+            self.goto_ang[ii] = float(fields[0]) % 360
+            diffang = shortest_turn(self.goto_ang[ii], self.angle[ii])
+            self.angvel[ii] = np.copysign(self.angvel[ii], diffang)
+            self.gong[ii] = abs(diffang)/abs(self.angvel[ii]) + now
+        elif type == 'ATURN':
+            self.angvel[ii] = np.copysign(
+                self.angvel[ii], -1 if float(fields[0]) != 0 else 1)
+            self.gong[ii] = ((float(fields[1]) % 360)/abs(self.angvel[ii]) +
+                             now)
+        elif type == 'CTURN':
+            self.angvel[ii] = np.copysign(
+                self.angvel[ii], -1 if float(fields[0]) != 0 else 1)
+        elif type == 'GOTO':
+            self.goto_x[ii] = float(fields[0])
+            self.goto_y[ii] = float(fields[1])
+            if fields[2] == '':
+                self.goto_vel[ii] = self.defvel
+            else:
+                self.goto_vel[ii] = min(abs(float(fields[2])), self.maxvel)
+            [_dx, _dy] = [self.goto_x[ii]-self.x[ii],
+                          self.goto_y[ii]-self.y[ii]]
+            if _dx != 0:
+                destang = np.degrees(np.arctan2(_dy, _dx)) % 360
+            else:
+                destang = 90.0 if _dy > 0 else 270.0
+            self.goto_destang[ii] = destang
+            if fields[3] != '':
+                self.goto_ang[ii] = float(fields[3]) % 360
+            else:
+                self.goto_ang[ii] = destang
+            diffang = shortest_turn(destang, self.angle[ii])
+            self.angvel[ii] = np.copysign(self.angvel[ii], diffang)
+            self.gong[ii] = abs(diffang)/abs(self.angvel[ii]) + now
+            self.step[ii] = 1  # First turn
+        return '<ACK,1>'
+
+    def end_move(self, ii, now):
+        '''Timed move (or GOTO step) of rover ii has run out'''
+        _move = self.move[ii]
+        if _move == verb_dict['GOTO'] and self.step[ii] == 1:
+            self.angle[ii] = self.goto_destang[ii]
+            self.send(ii, self.posmsg(ii))
+            self.step[ii] = 2  # First turn finished. Start forward
+            dist = np.hypot(self.goto_x[ii]-self.x[ii],
+                            self.goto_y[ii]-self.y[ii])
+            self.gong[ii] = dist/self.goto_vel[ii] + now
+            self.vx[ii] = self.goto_vel[ii]*np.cos(np.radians(
+                self.angle[ii]))
+            self.vy[ii] = self.goto_vel[ii]*np.sin(np.radians(
+                self.angle[ii]))
+            self.ping[ii] = now
+            return
+        if _move == verb_dict['GOTO'] and self.step[ii] == 2:
+            self.send(ii, self.posmsg(ii))
+            self.step[ii] = 3  # Begin second turn
+            diffang = shortest_turn(self.goto_ang[ii],
+                                    self.goto_destang[ii])
+            self.angvel[ii] = np.copysign(self.angvel[ii], diffang)
+            self.gong[ii] = abs(diffang)/abs(self.angvel[ii]) + now
+            self.ping[ii] = now
+            return
+        if _move in [verb_dict['GOTO'], verb_dict['TURN']]:
+            self.angle[ii] = self.goto_ang[ii]
+        self.angle[ii] = self.angle[ii] % 360
+        self.state[ii] = 0  # st_IDLE
+        self.move[ii] = verb_dict['HALT']
+        self.step[ii] = 0
+        self.send(ii, '<ACK,0>'+self.posmsg(ii))
+
+    def chug(self, now):
+        '''Integrate motion of all rovers up to 'now', then finish moves
+        and send heartbeats'''
+        _move = self.move
+        _goto = _move == verb_dict['GOTO']
+        _linear = (((_move >= verb_dict['FWD']) &
+                    (_move <= verb_dict['CBWD'])) |
+                   (_goto & (self.step == 2)))
+        _turning = (((_move >= verb_dict['TURN']) &
+                     (_move <= verb_dict['CTURN'])) |
+                    (_goto & ((self.step == 1) | (self.step == 3))))
+        _timed = ((_move == verb_dict['FWD']) | (_move == verb_dict['BWD']) |
+                  (_move == verb_dict['TURN']) |
+                  (_move == verb_dict['ATURN']) | _goto)
+        _end = np.where(_timed, np.minimum(self.gong, now), now)
+        _dt = np.maximum(_end - self.ping, 0.0)
+        self.x += np.where(_linear, self.vx*_dt, 0.0)
+        self.y += np.where(_linear, self.vy*_dt, 0.0)
+        self.angle += np.where(_turning, self.angvel*_dt, 0.0)
+        self.ping = np.where(_linear | _turning, now, self.ping)
+        for ii in np.flatnonzero(_timed & (self.gong <= now)):
+            self.end_move(ii, now)
+        _beat = self.heartbeat & (now - self.heart >= self.heartperiod)
+        self.heart[_beat] = now
+        for ii in np.flatnonzero(_beat):
+            self.send(ii, self.posmsg(ii))
+
+    def run(self, tick=0.1, seconds=None, report=10.0):
+        '''Serve until all connections are closed (or for 'seconds')'''
+        _start = time()
+        _next = _start
+        _last = [_start, process_time(), self.sent]
+        while self.alive.any():
+            _now = time()
+            if seconds is not None and _now - _start > seconds:
+                break
+            for key, mask in self.selector.select(max(0.0, _next - _now)):
+                self.receive(key.data)
+            _now = time()
+            if _now >= _next:
+                self.chug(_now)
+                _next = max(_next + tick, _now)
+            if _now - _last[0] >= report:
+                _cpu = process_time()
+                self.log.info('%d rovers alive, %.0f msg/s, CPU %.1f%%' % (
+                    self.alive.sum(), (self.sent-_last[2])/(_now-_last[0]),
+                    100*(_cpu-_last[1])/(_now-_last[0])))
+                _last = [_now, _cpu, self.sent]
+
+    def shutdown(self):
+        for ii in range(self.number):
+            if self.alive[ii]:
+                self.send(ii, '<BYE>')
+                self.close(ii)
+
+
+if __name__ == '__main__':
+    number = 100
+    IP_address = 'localhost'  # command server IP
+    Port = 8081  # command server port
+    tick = 0.1
+    seconds = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "dia:p:n:t:s:",
+                                   ["debug", "info", "address=", "port=",
+                                    "number=", "tick=", "seconds="])
+    except getopt.GetoptError:
+        print('usage: python ', sys.argv[0],
+              '[-d|--debug|-i|--info] [-a|--address <IP_address>] '
+              '[-p|--port <port_number>] [-n|--number <rovers>] '
+              '[-t|--tick <seconds>] [-s|--seconds <run time>]')
+        sys.exit(0)
+    numerical_level = logging.WARNING
+    for opt, arg in opts:
+        if opt in ["-i", "--info"]:
+            numerical_level = logging.INFO
+        elif opt in ["-d", "--debug"]:
+            numerical_level = logging.DEBUG
+        elif opt in ["-a", "--address"]:
+            IP_address = str(arg)
+        elif opt in ["-p", "--port"]:
+            Port = int(arg)
+        elif opt in ["-n", "--number"]:
+            number = int(arg)
+        elif opt in ["-t", "--tick"]:
+            tick = float(arg)
+        elif opt in ["-s", "--seconds"]:
+            seconds = float(arg)
+    logging.basicConfig(level=numerical_level,
+                        format='%(name)s:%(levelname)s:\t%(message)s')
+
+    fleet = Fleet(number, IP_address, Port)
+    sleep(1)
+    c0 = process_time()
+    w0 = time()
+    try:
+        fleet.run(tick, seconds)
+    except KeyboardInterrupt:
+        pass
+    cpu = (process_time() - c0)/(time() - w0)
+    fleet.shutdown()
+    print('%d rovers: %d commands received, %d messages sent, CPU %.1f%%' % (
+        number, fleet.received, fleet.sent, 100*cpu))
@@ -5,7 +5,7 @@ import sys
 import logging
 import getopt
 import numpy as np
-from daimyo_utils import TCPcompose, cmdparse
+from daimyo_utils import TCPframer, cmdparse, binpack
 from time import time, sleep
 
 
@@ -17,11 +17,10 @@ def nsin(ang):
     return np.sin(np.radians(ang))
 
 
-inbuffer = ''  # Use malloc and/or ringbuffer if on embedded system
-inbufmax = 32
-inpacket = ''
-commandstate = 0  # State of command assembly
-cflag = False  # Whether a full command has been asssembled
+inbufmax = 32  # Use malloc and/or ringbuffer if on embedded system
+framer = TCPframer(maxlen=inbufmax)  # Assembles commands from packets
+inpacket = b''
+servercommands = []  # Fully assembled commands awaiting response
 servercommand = ''
 
 # Field rover state variables
@@ -43,6 +42,15 @@ heartbeat = False  # heartbeat flag for periodic position reporting
 heartperiod = 0.5  # heartbeat period (seconds)
 
 
+def posmsg():
+    '''Position message. In binary telemetry mode (version '0_BIN') this is
+    a struct-packed frame, carried in a str as latin-1 so that it can be
+    concatenated with the other messages.'''
+    if version == '0_BIN':
+        return binpack('MYPOS', xpos, ypos, angle).decode('latin-1')
+    return '<MYPOS,%.3f,%.3f,%.3f>' % (xpos, ypos, angle)
+
+
 def orient_compass(Nangle=0):
     '''Code here would go to convert compass reading to angle relative
     to global map x-axis as supplied by server.'''
@@ -84,12 +92,13 @@ oldmoveflag = moveflag
 movefields = []
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], "daip",
-                               ["debug", "info",  "address", "port"])
+    opts, args = getopt.getopt(sys.argv[1:], "daipb",
+                               ["debug", "info",  "address", "port",
+                                "binary"])
 except getopt.GetoptError:
     print('usage: python ', sys.argv[0],
           '[-d|--debug|-i|--info] [-a|--address <IP_address>] '
-          '[-p|--port <port_number>]')
+          '[-p|--port <port_number>] [-b|--binary]')
     sys.exit(0)
 numerical_level = logging.WARNING
 logfmt = '%(name)s:%(levelname)s:\t%(message)s'
@@ -103,6 +112,8 @@ for opt, arg in opts:
         IP_address = str(arg)
     elif opt in ["-p", "--port"]:
         Port = int(arg)
+    elif opt in ["-b", "--binary"]:
+        version = '0_BIN'  # Binary position telemetry
 
 roverlog = logging.getLogger(name+'_v'+version)
 logging.basicConfig(  # filename=basename+'.log', filemode='w',
@@ -115,14 +126,14 @@ server.connect((IP_address, Port))
 running = True
 sendmsg = '<MYID,%s,%s>' % (name, version)
 sleep(1)
-server.send(sendmsg.encode())
-sendmsg = '<MYPOS,%.3f,%.3f,%.3f>' % (xpos, ypos, angle)
+server.send(sendmsg.encode('latin-1'))
+sendmsg = posmsg()
 sleep(1)
-server.send(sendmsg.encode())
+server.send(sendmsg.encode('latin-1'))
 
 
 def respond_to_server_cmd():
-    global servercommand, cflag, commandstate, server
+    global servercommand, server
     global xpos, ypos, angle, Nangle, Dxy, Dangle, maxvel
     global heartbeat, heartperiod, state, moveflag, movefields
     global verb_dict, running, oldmoveflag
@@ -139,16 +150,14 @@ def respond_to_server_cmd():
             sendmsg = '<MYID,%s,%s>' % (name, version)
         elif type == 'POS':  # Server is asking for position
             roverlog.debug("Sending position.")
-            sendmsg = '<MYPOS,%.3f,%.3f,%.3f>' % (
-                xpos, ypos, angle)
+            sendmsg = posmsg()
         elif type == 'SETPOS':  # Server is setting position
             roverlog.debug("Setting position.")
             [xpos, ypos] = [float(fields[0]), float(fields[1])]
             Nangle = float(fields[2]) if fields[2] else Nangle
             angle = orient_compass(Nangle)  # Compute rover orientation
             sendmsg = '<ACK,>'
-            sendmsg = '<MYPOS,%.3f,%.3f,%.3f>' % (
-                xpos, ypos, angle)
+            sendmsg = posmsg()
         elif type == 'PRES':  # Server is asking for precision
             roverlog.debug("Sending precision.")
             sendmsg = '<MYPRES,%.3f,%.3f>' % (Dxy, Dangle)
@@ -183,10 +192,8 @@ def respond_to_server_cmd():
             running = False
             moveflag = verb_dict['HALT']
         if sendmsg:
-            server.send(sendmsg.encode())
+            server.send(sendmsg.encode('latin-1'))
     servercommand = ''
-    cflag = False
-    commandstate = 0
     return
 
 
@@ -200,7 +207,7 @@ def state_machine_chug():
     if heartbeat:
         if curtime-mytimers.heart >= heartperiod:
             mytimers.heart = curtime
-            sendmsg = '<MYPOS,%.3f,%.3f,%.3f>' % (xpos, ypos, angle)
+            sendmsg = posmsg()
             roverlog.debug('heartbeat.')
     # Handle other verbs
     # ['HALT', 'FWD', 'BWD', 'CFWD', 'CBWD', 'TURN',
@@ -254,7 +261,7 @@ def state_machine_chug():
                 mytimers.ping = curtime
             else:
                 angle = mytimers.goto_destang
-                sendmsg += '<MYPOS,%.3f,%.3f,%.3f>' % (xpos, ypos, angle)
+                sendmsg += posmsg()
                 mytimers.gotostep = 2  # First turn finished. Start forward
                 dist = np.sqrt(
                     (mytimers.goto_x-xpos)**2+(mytimers.goto_y-ypos)**2)
@@ -270,7 +277,7 @@ def state_machine_chug():
                 mytimers.ping = curtime
             else:
                 roverlog.debug('GOTO finished forward.')
-                sendmsg += '<MYPOS,%.3f,%.3f,%.3f>' % (xpos, ypos, angle)
+                sendmsg += posmsg()
                 mytimers.gotostep = 3  # Begin second turn
                 diffang = mytimers.goto_ang-mytimers.goto_destang
                 if abs(diffang) > 180:
@@ -291,7 +298,7 @@ def state_machine_chug():
                 [moveflag, oldmoveflag] = [verb_dict['HALT']]*2
                 sendmsg = '<ACK,%d>' % state
                 angle = mytimers.goto_ang
-                sendmsg += '<MYPOS,%.3f,%.3f,%.3f>' % (xpos, ypos, angle)
+                sendmsg += posmsg()
                 mytimers.gotostep = 0  # Last turn finished.
                 roverlog.debug('GOTO finished last turn.')
     if moveflag in [verb_dict['FWD'], verb_dict['BWD'], verb_dict['CFWD'],
@@ -308,7 +315,7 @@ def state_machine_chug():
                 state = 0  # st_IDLE
                 [moveflag, oldmoveflag] = [verb_dict['HALT']]*2
                 sendmsg = '<ACK,%d>' % state
-                sendmsg += '<MYPOS,%.3f,%.3f,%.3f>' % (xpos, ypos, angle)
+                sendmsg += posmsg()
         else:
             roverlog.debug('Moving.')
             state = 1  # st_MOVE
@@ -340,7 +347,7 @@ def state_machine_chug():
                     angle = float(movefields[0]) % 360.0
                 else:
                     angle = (angle+np.sign(angvel)*float(movefields[0])) % 360
-                sendmsg += '<MYPOS,%.3f,%.3f,%.3f>' % (xpos, ypos, angle)
+                sendmsg += posmsg()
                 [moveflag, oldmoveflag] = [verb_dict['HALT']]*2
                 angle = angle % 360
         else:
@@ -377,9 +384,9 @@ def state_machine_chug():
         angle = angle % 360
         state = 0  # st_IDLE
         sendmsg = '<ACK,%d>' % state
-        sendmsg += '<MYPOS,%.3f,%.3f,%.3f>' % (xpos, ypos, angle)
+        sendmsg += posmsg()
     if sendmsg:
-        server.send(sendmsg.encode())
+        server.send(sendmsg.encode('latin-1'))
     return
 
 
@@ -400,16 +407,10 @@ while running:
             roverlog.info("Server died.")
             server.close()
             running = False
-        inbuffer += inpacket.decode()
-        if len(inbuffer) > inbufmax:
+        servercommands.extend(framer.feed(inpacket))
+        if framer.overflow:
             roverlog.warning("Buffer is becoming too big (%d)!\n" %
-                             len(inbuffer))
-        if commandstate != 2:
-            servercommand, inbuffer, commandstate = TCPcompose(
-                growstr=servercommand, newstr=inbuffer,
-                messagestate=commandstate)
-        if commandstate == 2:
-            cflag = True  # A full command has been assembled
+                             len(framer))
 
     # 2. Handle console/terminal user input
     if sys.stdin in inlist:
@@ -432,7 +433,8 @@ while running:
                 roverlog.warning("Invalid message.")
 
     # 3. Respond to assembled commands, modify appropriate state variables
-    if cflag:
+    while servercommands and running:
+        servercommand = servercommands.pop(0)
         respond_to_server_cmd()
 
     # 4. Handle timed execution of current state
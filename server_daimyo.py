@@ -8,8 +8,16 @@ import threading
 import json
 import datetime
 import numpy as np
+from time import time
 from functools import partial
-from daimyo_utils import Rover, st_dict
+from daimyo_utils import Rover, Waker, default_synbus, default_timers
+from daimyo_utils import st_dict
+from daimyo_utils import lockstats, new_lock, HeartScheduler, protoparse
+from daimyo_utils import SendQueue, sendq_defaults, EmergencyStop
+from daimyo_async import AsyncEngine
+from daimyo_shard import ShardPool
+from daimyo_registry import RoverRegistry
+from daimyo_datalog import DatalogWriter
 
 # For rendering web application/page
 from bokeh.models import Select, Button, TextInput, Div, Diamond
@@ -28,13 +36,19 @@ from bokeh.server.server import Server
 from jinja2 import Environment, FileSystemLoader
 from tornado.web import RequestHandler
 from tornado.web import StaticFileHandler
+from tornado.web import Application
+from tornado.ioloop import IOLoop
 from bokeh.embed import server_document
 import asyncio
 
 # Change below to LAN IP address if you want access to webGUI over LAN
 webapp_addr = 'localhost:5006'
+# Period (ms) of webUI updates. Rover events queue up in between
+webUI_period = 500
+# Trail segments kept per rover (on average) in the webUI map
+trail_points = 100
 
-mainlock = threading.RLock()
+mainlock = new_lock('mainlock')  # Remade timed by -l|--lockstats
 if not os.path.exists('maps'):  # Store map (json) files here
     os.mkdir('maps')
 if not os.path.exists('sequences'):  # Store command sequences and patrols
@@ -57,6 +71,112 @@ class IndexHandler(RequestHandler):
         self.write(template.render(script=script, template="Tornado"))
 
 
+def metric_line(name, value, labels=[]):
+    '''One sample in the Prometheus text format'''
+    if labels:
+        name += '{%s}' % ','.join(
+            '%s="%s"' % (_key, str(_value).replace('\\', '\\\\').replace(
+                '"', '\\"')) for _key, _value in labels)
+    return '%s %r\n' % (name, value)
+
+
+def metrics_text():
+    '''Counters of the server main loop, the datalog writer, and every live
+    rover, in the Prometheus text format'''
+    _lines = ['# TYPE daimyo_main_loop_iterations_total counter\n',
+              metric_line('daimyo_main_loop_iterations_total',
+                          loopstats['iterations']),
+              '# TYPE daimyo_main_loop_busy_seconds_total counter\n',
+              metric_line('daimyo_main_loop_busy_seconds_total',
+                          loopstats['busy']),
+              '# TYPE daimyo_main_loop_max_seconds gauge\n',
+              metric_line('daimyo_main_loop_max_seconds', loopstats['max'])]
+    if datalog is not None:
+        _stats = datalog.stats()
+        _lines += [metric_line('daimyo_datalog_queue_depth', _stats['depth']),
+                   metric_line('daimyo_datalog_lag_seconds', _stats['lag']),
+                   metric_line('daimyo_datalog_written_total',
+                               _stats['written']),
+                   metric_line('daimyo_datalog_failed_total',
+                               _stats['failed']),
+                   metric_line('daimyo_datalog_commits_total',
+                               _stats['commits'])]
+    _stats = default_timers.stats()
+    _lines += [metric_line('daimyo_timers_pending', _stats['pending']),
+               metric_line('daimyo_timers_fired_total', _stats['fired']),
+               metric_line('daimyo_timers_late_max_seconds', _stats['late'])]
+    _stats = estop.stats()
+    _lines += [metric_line('daimyo_estop_halts_total', _stats['halts']),
+               metric_line('daimyo_estop_failed_total', _stats['failed'])]
+    for _name in ['dispatch_last', 'dispatch_max', 'ack_p50', 'ack_p99',
+                  'ack_max']:
+        if _stats[_name] is not None:
+            _lines.append(metric_line('daimyo_estop_%s_seconds' % _name,
+                                      _stats[_name]))
+    _rovers = [rover for rover in registry.view if rover.alive]
+    _lines.append(metric_line('daimyo_rovers', len(_rovers)))
+    for rover in _rovers:
+        _m = rover.metrics()
+        if _m is None:  # Worker process rover, not reported yet
+            continue
+        _id = [('rover', _m['name']), ('thread', _m['thread'])]
+        for _type, _count in sorted(_m['msgs_in'].items()):
+            _lines.append(metric_line('daimyo_rover_messages_in_total',
+                                      _count, _id+[('type', _type)]))
+        for _type, _count in sorted(_m['cmds_out'].items()):
+            _lines.append(metric_line('daimyo_rover_commands_out_total',
+                                      _count, _id+[('type', _type)]))
+        _lines += [
+            metric_line('daimyo_rover_invalid_messages_total',
+                        _m['invalid'], _id),
+            metric_line('daimyo_rover_bytes_in_total', _m['bytes_in'], _id),
+            metric_line('daimyo_rover_datalog_writes_total',
+                        _m['datalog_writes'], _id),
+            metric_line('daimyo_rover_mypos_suppressed_total',
+                        _m['pos_suppressed'], _id),
+            metric_line('daimyo_rover_smsg_buffer', _m['smsg_buffer'], _id),
+            metric_line('daimyo_rover_cmdq_depth', _m['cmdq']['depth'], _id),
+            metric_line('daimyo_rover_cmdq_coalesced_total',
+                        _m['cmdq']['coalesced'], _id),
+            metric_line('daimyo_rover_cmdq_refused_total',
+                        _m['cmdq']['refused'], _id),
+            metric_line('daimyo_rover_sendq_bytes', _m['sendq']['depth'],
+                        _id),
+            metric_line('daimyo_rover_sendq_max_bytes',
+                        _m['sendq']['maxdepth'], _id),
+            metric_line('daimyo_rover_sendq_coalesced_total',
+                        _m['sendq']['coalesced'], _id),
+            metric_line('daimyo_rover_sendq_dropped_total',
+                        _m['sendq']['dropped'], _id),
+            metric_line('daimyo_rover_sendq_overflows_total',
+                        _m['sendq']['overflows'], _id),
+            metric_line('daimyo_rover_sendq_stalls_total',
+                        _m['sendq']['stalls'], _id),
+            metric_line('daimyo_rover_bytes_out_total',
+                        _m['sendq']['bytes_out'], _id),
+            metric_line('daimyo_rover_loop_iterations_total',
+                        _m['loop']['iterations'], _id),
+            metric_line('daimyo_rover_loop_busy_seconds_total',
+                        _m['loop']['busy'], _id),
+            metric_line('daimyo_rover_loop_max_seconds',
+                        _m['loop']['max'], _id)]
+        _lines.append(metric_line('daimyo_rover_estops_total', _m['estops'],
+                                  _id))
+        if _m['halt_latency'] is not None:
+            _lines.append(metric_line('daimyo_rover_halt_ack_seconds',
+                                      _m['halt_latency'], _id))
+        if _m['mypos_age'] is not None:
+            _lines.append(metric_line('daimyo_rover_mypos_age_seconds',
+                                      _m['mypos_age'], _id))
+    return ''.join(_lines)
+
+
+class MetricsHandler(RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics_text())
+
+
 def check_sane_str(instr):
     instr = str(instr)
     if any(char in instr for char in ['/', '*', '..']):
@@ -72,9 +192,10 @@ def webapp(doc):
 
     global updatecmd  # Integer for next_tick_callback to update DataSources
     global eventx, eventy
-    global list_of_rovers, roverlistchanged, roverchangetype
+    global registry_mark, webrows
     global webroverlist, rover_indx, rovermenu, seqdict
     global infodict, infofmt, data_s, data_seq, seqdict
+    global data_trail, trailtip
     # global weblog
     updatecmd = 0
     [eventx, eventy] = [0, 0]
@@ -82,9 +203,14 @@ def webapp(doc):
                          ('x', []), ('y', []), ('angle', []),
                          ('state', []), ('loop', []), ('lflag', []),
                          ('seqfile', []), ('seqlist', []),
-                         ('xhist', []), ('yhist', []), ('threadname', [])])
+                         ('threadname', []), ('rid', [])])
     # emptyroverlist = webroverlist
     data_s = ColumnDataSource(webroverlist)
+    # Trails are line segments, one row each, streamed as rovers move
+    data_trail = ColumnDataSource(dict([('x0', []), ('y0', []),
+                                        ('x1', []), ('y1', []),
+                                        ('threadname', [])]))
+    trailtip = {}  # Last trail point ([x, y] or None) for each threadname
     rover_indx = -1  # index if rover currently selected
 
     # Next-tick callback for updating ColumnDataSources
@@ -142,36 +268,69 @@ def webapp(doc):
         except RuntimeError:  # Happens if you reload webpage when running
             pass
 
-    def append_data_s(rover):
+    def append_data_s(rover, rid):
         global data_s, webroverlist
-        rover.lock.acquire()
-        webroverlist['version'].append(rover.version)
-        webroverlist['x'].append(rover.x)
-        webroverlist['y'].append(rover.y)
-        webroverlist['angle'].append(rover.angle)
-        webroverlist['state'].append(st_dict[rover.state])
-        webroverlist['loop'].append(rover.superstate)
-        webroverlist['hflag'].append(rover.heartbeat)
-        webroverlist['lflag'].append(rover.loopflag)
+        _snap = rover.snapshot  # Consistent without rover.lock
+        webroverlist['rid'].append(rid)
+        webroverlist['version'].append(_snap.version)
+        webroverlist['x'].append(_snap.x)
+        webroverlist['y'].append(_snap.y)
+        webroverlist['angle'].append(_snap.angle)
+        webroverlist['state'].append(st_dict[_snap.state])
+        webroverlist['loop'].append(_snap.superstate)
+        webroverlist['hflag'].append(_snap.heartbeat)
+        webroverlist['lflag'].append(_snap.loopflag)
         webroverlist['seqfile'].append(rover.seqfile)
         webroverlist['seqlist'].append(rover.seqlist)
-        webroverlist['xhist'].append([rover.x])
-        webroverlist['yhist'].append([rover.y])
-        webroverlist['threadname'].append(rover.thread.getName())
-        rover.lock.release()
+        webroverlist['threadname'].append(_snap.thread)
+        if [_snap.x, _snap.y] == [0, 0]:  # Wait for first MYPOS
+            trailtip[_snap.thread] = None
+        else:
+            trailtip[_snap.thread] = [_snap.x, _snap.y]
         webroverlist['angle'] = [x-90 for x in webroverlist['angle']]
 
-    for rover in list_of_rovers:
-        rover.lock.acquire()
-        _tmpvar = rover.name+'_____('+rover.thread.getName()+')'
+    # Rows of the rovers registered so far, then follow registry changes
+    # from this mark on (a rover already shown is not added again)
+    registry_mark = registry.changes(0)[1]
+    for rover in registry.view:
+        _rid = registry.id_of(rover)
+        if _rid is None:  # Just removed
+            continue
+        _snap = rover.snapshot
+        _tmpvar = _snap.name+'_____('+_snap.thread+')'
         webroverlist['name'].append(_tmpvar)
-        append_data_s(rover)
-        rover.lock.release()
+        append_data_s(rover, _rid)
+    webrows = dict([(_rid, _row) for _row, _rid in
+                    enumerate(webroverlist['rid'])])  # Rover ID -> row
     data_s.data = dict(webroverlist)
     numrovs = len(webroverlist['name'])
-    mainlock.acquire()
-    roverlistchanged = False
-    mainlock.release()
+
+    def rover_at(row):
+        '''The rover shown in a row of webroverlist, or None if gone'''
+        if 0 <= row < len(webroverlist['rid']):
+            return registry.get(webroverlist['rid'][row])
+        return None
+
+    def clear_trail(threadname):
+        '''Drop trail of one rover (rare, so the source is replaced)'''
+        global data_trail, trailtip
+        _keep = [ii for ii, _name in enumerate(data_trail.data['threadname'])
+                 if _name != threadname]
+        data_trail.data = dict([(key, [val[ii] for ii in _keep])
+                                for key, val in data_trail.data.items()])
+        trailtip[threadname] = None
+
+    def send_deltas(patches, segments):
+        '''Send this tick's row changes as one patch, and new trail
+        segments as one stream, to the browser'''
+        global data_s, data_trail, webroverlist
+        if len(data_s.data['name']) != len(webroverlist['name']):
+            data_s.data = dict(webroverlist)  # Rows changed: send all
+        elif patches:
+            data_s.patch(patches)
+        if segments['threadname']:
+            data_trail.stream(segments, rollover=trail_points*max(
+                1, len(webroverlist['name'])))
 
     # map variables
     global dnorth, dobs, dwalls, drfid, mapread
@@ -195,11 +354,14 @@ def webapp(doc):
     Name: {name}   (ver: {version})<br />
     (x, y): ({x:.3f}, {y:.3f}) m<br />
     angle: {ang:.1f} deg.<br />
-    state: {state} <br/>seq_indx: {loop}, loop: {lflag}"""
+    state: {state} <br/>seq_indx: {loop}, loop: {lflag}<br />
+    UI events coalesced/dropped: {wcoal}/{wdrop}<br />
+    Commands queued: {cmdq} (coalesced: {ccoal})"""
     infodict = dict([('name', 'sam'), ('x', 0.0), ('y', 0.0), ('version', '0'),
                      ('ang', 90), ('state', 'st_IDLE'), ('loop', -1),
-                     ('lflag', False)])
-    roverstate = Div(text='''''', width=left_w-160, height=120,
+                     ('lflag', False), ('wcoal', 0), ('wdrop', 0),
+                     ('cmdq', 0), ('ccoal', 0)])
+    roverstate = Div(text='''''', width=left_w-160, height=160,
                      background="whitesmoke", align='end',
                      style=dict([("font-weight", "bold"),
                                  ("font-size", "large"),
@@ -328,32 +490,32 @@ def webapp(doc):
     setposdict = dict([('names', ['x (m)', 'y (m)', '[angle (deg.)]']),
                        ('values', [0.0, 0.0, dnorth.data['ang'][0]])])
     fwddict = dict([('names', ['distance (m)', '[speed (m/s)]',
-                               '[timeout (s)]']),
+                               '[timeout (ms)]']),
                     ('values', [0.1, 0.2, None])])
     bwddict = dict([('names', ['distance (m)', '[speed (m/s)]',
-                               '[timeout (s)]']),
+                               '[timeout (ms)]']),
                     ('values', [0.1, 0.2, None])])
-    cfwddict = dict([('names', ['[speed (m/s)]', '[timeout (s)]']),
+    cfwddict = dict([('names', ['[speed (m/s)]', '[timeout (ms)]']),
                      ('values', [0.2, None])])
-    cbwddict = dict([('names', ['[speed (m/s)]', '[timeout (s)]']),
+    cbwddict = dict([('names', ['[speed (m/s)]', '[timeout (ms)]']),
                      ('values', [0.2, None])])
-    turndict = dict([('names', ['angle (deg.)', '[timeout (s)]']),
+    turndict = dict([('names', ['angle (deg.)', '[timeout (ms)]']),
                      ('values', [45.0, None])])
     aturndict = dict([('names', ['direction (0/1)', 'angle (deg.)',
-                                 '[timeout (s)]']),
+                                 '[timeout (ms)]']),
                       ('values', [0, 30.0, None])])
-    cturndict = dict([('names', ['direction (0/1)', '[timeout (s)]']),
+    cturndict = dict([('names', ['direction (0/1)', '[timeout (ms)]']),
                       ('values', [0, None])])
     gotodict = dict([('names', ['x (m)', 'y (m)', '[speed (m/s)]',
-                                '[end angle (deg.)]', '[timeout (s)]']),
+                                '[end angle (deg.)]', '[timeout (ms)]']),
                      ('values', [0.0, 0.0, None, None, None])])
-    obsdict = dict([('names', ['[angle (deg.)]', '[timeout (s)]']),
+    obsdict = dict([('names', ['[angle (deg.)]', '[timeout (ms)]']),
                     ('values', [180.0, None])])
     pobsdict = dict([('names', ['distance (m)', '[angle (deg.)]',
-                                '[timeout (s)]']),
+                                '[timeout (ms)]']),
                      ('values', [0.5, -45.0, None])])
     searchdict = dict([('names', ['[radius (m)]', '[RFID tag UID]',
-                                  'timeout (s)']),
+                                  'timeout (ms)']),
                        ('values', [0.01, None, None])])
 
     fcmdsource = ColumnDataSource(setposdict)
@@ -504,10 +666,10 @@ def webapp(doc):
     mapp.yaxis.major_label_text_font_size = '16pt'
     mapp.yaxis.axis_label = "y-position (meters)"
     mapp.yaxis.axis_label_text_font_size = '16pt'
-    hist_lines = mapp.multi_line(xs='xhist', ys='yhist',
-                                 source=data_s, visible=True,
-                                 color="red", alpha=0.8,
-                                 line_width=2, line_dash=[4, 4])
+    hist_lines = mapp.segment(x0='x0', y0='y0', x1='x1', y1='y1',
+                              source=data_trail, visible=True,
+                              color="red", alpha=0.8,
+                              line_width=2, line_dash=[4, 4])
     rover_triangles = mapp.triangle(x='x', y='y', angle='angle',
                                     source=data_s, fill_color=None,
                                     line_width=2, line_color="green",
@@ -600,133 +762,159 @@ def webapp(doc):
     # roverstate set
     def set_roverstate(rover):
         global infodict, infofmt
-        infodict['name'] = rover.name
-        infodict['version'] = rover.version
-        [infodict['x'], infodict['y']] = [rover.x, rover.y]
-        infodict['ang'] = rover.angle
-        infodict['state'] = st_dict[rover.state]
-        infodict['loop'] = rover.superstate
-        infodict['lflag'] = rover.loopflag
+        _snap = rover.snapshot
+        infodict['name'] = _snap.name
+        infodict['version'] = _snap.version
+        [infodict['x'], infodict['y']] = [_snap.x, _snap.y]
+        infodict['ang'] = _snap.angle
+        infodict['state'] = st_dict[_snap.state]
+        infodict['loop'] = _snap.superstate
+        infodict['lflag'] = _snap.loopflag
+        infodict['wcoal'] = rover.wevents.coalesced
+        infodict['wdrop'] = rover.wevents.dropped
+        infodict['cmdq'] = len(rover.commands)
+        infodict['ccoal'] = rover.commands.coalesced
         roverstate.text = infofmt.format(**infodict)
         roverstate.style['color'] = 'DarkRed'
 
-    if numrovs > 0:  # Do this at startup
-        set_roverstate(list_of_rovers[0])
+    if numrovs > 0 and rover_at(0) is not None:  # Do this at startup
+        set_roverstate(rover_at(0))
         rover_indx = 0
 
+    def rover_joined(rid):
+        global rover_indx, webrows, updatecmd
+        rover = registry.get(rid)
+        if rover is None:  # Gone already
+            return
+        _snap = rover.snapshot
+        _tmpvar = _snap.name+'_____('+_snap.thread+')'
+        set_logbox(text="New rover %s detected." % _tmpvar)
+        webroverlist['name'].append(_tmpvar)
+        append_data_s(rover, rid)
+        webrows[rid] = len(webroverlist['rid']) - 1
+        updatecmd = 0
+        doc.add_next_tick_callback(update_CDS)
+        if len(webroverlist['name']) == 1:
+            rover_indx = 0
+            set_roverstate(rover)
+        rovermenu.options = []  # Seems to be necessary for update
+        rovermenu.options = webroverlist['name']
+        rover_indx = 0 if rover_indx == -1 else rover_indx
+        if rover_indx == webrows[rid]:
+            set_roverstate(rover)
+        rovermenu.title = 'Live Rovers: %d' % len(webroverlist['name'])
+
+    def rover_left(rid):
+        global rover_indx, webrows, updatecmd
+        rovermenu.options = []  # Seems to be necessary for update
+        tempindx = webrows[rid]
+        set_logbox(text="Rover %s disconnected." %
+                   webroverlist['name'][tempindx], color="Red")
+        clear_trail(webroverlist['threadname'][tempindx])
+        del trailtip[webroverlist['threadname'][tempindx]]
+        for key in webroverlist.keys():
+            del webroverlist[key][tempindx]
+        webrows = dict([(_rid, _row) for _row, _rid in
+                        enumerate(webroverlist['rid'])])
+        updatecmd = 0
+        doc.add_next_tick_callback(update_CDS)
+        if webroverlist['name']:
+            rovermenu.options = webroverlist['name']
+        else:
+            roverstate.text = ''''''
+            seqfilein.value = ''
+            seqdict["lines"] = []
+        updatecmd = 0
+        doc.add_next_tick_callback(update_CDS)
+        if rovermenu.value in webroverlist['name']:
+            rover_indx = webroverlist['name'].index(rovermenu.value)
+        else:
+            rover_indx = len(webroverlist['name'])-1
+            if rover_indx > -1:
+                rovermenu.value = rovermenu.options[rover_indx]
+        rovermenu.title = 'Live Rovers: %d' % len(webroverlist['name'])
+
     # Periodic update
     def update():
-        global roverlistchanged, roverchangetype, rover_indx
+        global registry_mark, rover_indx
         global data_s, rovermenu, updatecmd
-        if roverlistchanged:
-            mainlock.acquire()
-            roverlistchanged = False
-            if roverchangetype == 'NEW':  # New rover has joined
-                rover = list_of_rovers[-1]
-                rover.lock.acquire()
-                _tmpvar = rover.name+'_____('+rover.thread.getName()+')'
-                set_logbox(text="New rover %s detected." % _tmpvar)
-                webroverlist['name'].append(_tmpvar)
-                append_data_s(rover)
-                rover.lock.release()
-                updatecmd = 0
-                doc.add_next_tick_callback(update_CDS)
-                if len(webroverlist['name']) == 1:
-                    rover_indx = 0
-                    set_roverstate(rover)
-                rovermenu.options = []  # Seems to be necessary for update
-                rovermenu.options = webroverlist['name']
-                rover_indx = 0 if rover_indx == -1 else rover_indx
-                if rover_indx == len(list_of_rovers)-1:
-                    set_roverstate(rover)
-                rovermenu.title = 'Live Rovers: %d' % len(webroverlist['name'])
-            elif roverchangetype[0:4] == 'DIE:':  # A rover has died
-                rovermenu.options = []  # Seems to be necessary for update
-                tempindx = int(roverchangetype[4:])
-                set_logbox(text="Rover %s disconnected." %
-                           webroverlist['name'][tempindx], color="Red")
-                for key in webroverlist.keys():
-                    del webroverlist[key][tempindx]
-                updatecmd = 0
-                doc.add_next_tick_callback(update_CDS)
-                if webroverlist['name']:
-                    rovermenu.options = webroverlist['name']
-                else:
-                    roverstate.text = ''''''
-                    seqfilein.value = ''
-                    seqdict["lines"] = []
-                updatecmd = 0
-                doc.add_next_tick_callback(update_CDS)
-                if rovermenu.value in webroverlist['name']:
-                    rover_indx = webroverlist['name'].index(rovermenu.value)
-                else:
-                    rover_indx = len(webroverlist['name'])-1
-                    if rover_indx > -1:
-                        rovermenu.value = rovermenu.options[rover_indx]
-                rovermenu.title = 'Live Rovers: %d' % len(webroverlist['name'])
-            mainlock.release()
-        tempindx = -1
-        for rover in list_of_rovers:  # Look for messages passed to webUI
-            tempindx += 1
-            rover.lock.acquire()
-            if rover.wflag:
-                rover.wflag = False
-                if rover.wlist[0] == 'MYID':  # ID change
-                    _tmpvar = rover.name+'_____('+rover.thread.getName()+')'
+        _changes, registry_mark = registry.changes(registry_mark)
+        if _changes is None:  # Too many to keep. Compare with the view.
+            _live = [registry.id_of(rover) for rover in registry.view]
+            _changes = [('DIE', _rid) for _rid in webroverlist['rid']
+                        if _rid not in _live] + \
+                [('NEW', _rid) for _rid in _live if _rid is not None]
+        for _kind, _rid in _changes:
+            if _kind == 'NEW' and _rid not in webrows:
+                rover_joined(_rid)
+            elif _kind == 'DIE' and _rid in webrows:
+                rover_left(_rid)
+        _patches = {}  # data_s column -> [(row, new value), ...]
+        _segments = dict([('x0', []), ('y0', []), ('x1', []), ('y1', []),
+                          ('threadname', [])])  # New trail segments
+        # Neither mainlock nor rover locks: the registry view and rover
+        # snapshots are replaced, never changed, and wevents has its own
+        # lock
+        for rover in registry.view:  # Look for messages passed to webUI
+            tempindx = webrows.get(registry.id_of(rover))
+            if tempindx is None:  # Not shown yet
+                continue
+            for wlist in rover.wevents.drain():
+                if wlist[0] == 'MYID':  # ID change
+                    _snap = rover.snapshot
+                    _tmpvar = _snap.name+'_____('+_snap.thread+')'
                     set_logbox(text="Rover %s changed ID to %s." %
                                (webroverlist['name'][tempindx], _tmpvar))
                     webroverlist['name'][tempindx] = _tmpvar
-                    webroverlist['version'][tempindx] = rover.version
+                    webroverlist['version'][tempindx] = _snap.version
+                    _patches.setdefault('name', []).append(
+                        (tempindx, _tmpvar))
+                    _patches.setdefault('version', []).append(
+                        (tempindx, _snap.version))
                     rovermenu.options = []  # Seems to be necessary for update
                     rovermenu.options = webroverlist['name']
                     if rover_indx == tempindx:
                         rovermenu.value = _tmpvar
                         set_roverstate(rover)
-                elif rover.wlist[0] == 'MYPOS':  # Position change
-                    webroverlist['x'][tempindx] = rover.wlist[1]
-                    webroverlist['y'][tempindx] = rover.wlist[2]
-                    webroverlist['angle'][tempindx] = rover.wlist[3]-90
-                    if len(webroverlist['xhist'][tempindx]) == 1:
-                        if [webroverlist['xhist'][tempindx][0],
-                            webroverlist['yhist'][tempindx][0]] == [0, 0]:
-                            webroverlist[
-                                'xhist'][tempindx][0] = rover.wlist[1]
-                            webroverlist[
-                                'yhist'][tempindx][0] = rover.wlist[2]
-                    if [webroverlist['xhist'][tempindx][-1],
-                        webroverlist['yhist'][tempindx][-1]] != [
-                            rover.wlist[1],
-                            rover.wlist[2]]:
-                        webroverlist['xhist'][tempindx].append(
-                            rover.wlist[1])
-                        webroverlist['yhist'][tempindx].append(
-                            rover.wlist[2])
-                        if len(webroverlist['xhist'][tempindx]) > 100:
-                            webroverlist['xhist'][tempindx].pop(0)
-                            webroverlist['yhist'][tempindx].pop(0)
+                elif wlist[0] == 'MYPOS':  # Position change
+                    webroverlist['x'][tempindx] = wlist[1]
+                    webroverlist['y'][tempindx] = wlist[2]
+                    webroverlist['angle'][tempindx] = wlist[3]-90
+                    for key in ['x', 'y', 'angle']:
+                        _patches.setdefault(key, []).append(
+                            (tempindx, webroverlist[key][tempindx]))
+                    _thread = webroverlist['threadname'][tempindx]
+                    _tip = trailtip[_thread]
+                    if _tip is not None and _tip != [wlist[1], wlist[2]]:
+                        _segments['x0'].append(_tip[0])
+                        _segments['y0'].append(_tip[1])
+                        _segments['x1'].append(wlist[1])
+                        _segments['y1'].append(wlist[2])
+                        _segments['threadname'].append(_thread)
+                    trailtip[_thread] = [wlist[1], wlist[2]]
                     if tempindx == rover_indx:
                         if not webroverlist['hflag']:
                             set_logbox(text="Position updated.", color="black")
                         set_roverstate(rover)
-                    updatecmd = 0
-                    doc.add_next_tick_callback(update_CDS)
-                elif rover.wlist[0] == 'ACK':  # State change
-                    webroverlist['state'][tempindx] = rover.wlist[1]
+                elif wlist[0] == 'ACK':  # State change
+                    webroverlist['state'][tempindx] = wlist[1]
+                    _patches.setdefault('state', []).append(
+                        (tempindx, wlist[1]))
                     if tempindx == rover_indx:
                         set_roverstate(rover)
-                elif rover.wlist[0] == 'HEART':  # Heartbeat signal sent
+                elif wlist[0] == 'HEART':  # Heartbeat signal sent
                     webroverlist['hflag'][tempindx] = True
-                    updatecmd = 0
-                    doc.add_next_tick_callback(update_CDS)
-                elif rover.wlist[0] == 'SILENT':  # Silent signal sent
+                    _patches.setdefault('hflag', []).append((tempindx, True))
+                elif wlist[0] == 'SILENT':  # Silent signal sent
                     webroverlist['hflag'][tempindx] = False
-                    updatecmd = 0
-                    doc.add_next_tick_callback(update_CDS)
-                elif rover.wlist[0] == 'DOBS':  # Obstacle distance
+                    _patches.setdefault('hflag', []).append(
+                        (tempindx, False))
+                elif wlist[0] == 'DOBS':  # Obstacle distance
                     pass  # To be implemented (add to map?)
-                elif rover.wlist[0] == 'COL':
+                elif wlist[0] == 'COL':
                     pass  # To be implemented (add to map?)
-            rover.lock.release()
+        # One patch and one stream for the whole batch of events
+        send_deltas(_patches, _segments)
 
     # When selection in rovermenu changes
     def rovermenu_handler(attr, old, new):
@@ -734,9 +922,8 @@ def webapp(doc):
         try:
             rover_indx = webroverlist['name'].index(new)
             HEARTbtn.active = 0 if webroverlist['hflag'][rover_indx] else 1
-            mainlock.acquire()
-            set_roverstate(list_of_rovers[rover_indx])
-            mainlock.release()
+            if rover_at(rover_indx) is not None:
+                set_roverstate(rover_at(rover_indx))
             seqdict['lines'] = webroverlist['seqlist'][rover_indx]
             seqfilein.value = webroverlist['seqfile'][rover_indx]
             updatecmd = 10
@@ -820,54 +1007,46 @@ def webapp(doc):
 
     def send_nofcmd(cmdstring='HALT'):
         global rover_indx
-        if rover_indx > -1 and rover_indx < len(list_of_rovers):
-            rover = list_of_rovers[rover_indx]
-            rover.lock.acquire()
-            rover.command = '<'+cmdstring+'>'
-            rover.cflag = True
-            rover.lock.release()
-            set_logbox(text='Sent &lt;%s&gt; to %s.' % (cmdstring,
-                                                        rover.name))
+        rover = rover_at(rover_indx)
+        if rover is not None:
+            if rover.put_command('<'+cmdstring+'>'):
+                set_logbox(text='Sent &lt;%s&gt; to %s.' % (cmdstring,
+                                                            rover.name))
+            else:
+                set_logbox(text='Command queue of %s full.' % rover.name,
+                           color='red')
 
     def send_fcmd(cmdstring='OBS', fields=['', '']):
         global rover_indx
-        if rover_indx > -1:
-            rover = list_of_rovers[rover_indx]
-            rover.lock.acquire()
-            rover.command = '<'+cmdstring
+        rover = rover_at(rover_indx)
+        if rover is not None:
+            _command = '<'+cmdstring
             for field in fields:
-                rover.command += ',' + field
-            rover.command += '>'
-            rover.cflag = True
-            rover.lock.release()
-            sentcmd = 'Sent &lt;%s&gt; to %s.' % (rover.command[1:-1],
+                _command += ',' + field
+            _command += '>'
+            if not rover.put_command(_command):
+                set_logbox(text='Command queue of %s full.' % rover.name,
+                           color='red')
+                return
+            sentcmd = 'Sent &lt;%s&gt; to %s.' % (_command[1:-1],
                                                   rover.name)
             set_logbox(text=sentcmd)
             if cmdstring == 'SETPOS':
-                webroverlist['xhist'][rover_indx] = [0]
-                webroverlist['yhist'][rover_indx] = [0]
+                clear_trail(webroverlist['threadname'][rover_indx])
 
     def btns_callback(mybtn):
         global updatecmd, seqdict, webroverlist
         if mybtn == HALTallbtn:
-            mainlock.acquire()
-            for rover in list_of_rovers:
-                if rover.alive:
-                    rover.lock.acquire()
-                    rover.command = '<HALT>'
-                    rover.cflag = True
-                    rover.lock.release()
-            set_logbox(text='Sent &lt;HALT&gt; to all rovers.')
-            mainlock.release()
+            # Straight to the sockets, past queues and locks
+            _dt = estop.halt(registry.view)
+            set_logbox(text='Sent &lt;HALT&gt; to all rovers (%.1f ms).' %
+                       (1e3*_dt))
         elif mybtn == HEARTallbtn:
             mainlock.acquire()
-            for rover in list_of_rovers:
-                if rover.alive:
-                    rover.lock.acquire()
-                    rover.command = '<HEART,>'
-                    rover.cflag = True
-                    rover.lock.release()
-            set_logbox(text='Sent &lt;HEART,&gt; to all rovers.')
+            # The main loop sends staggered HEARTs (see HeartScheduler)
+            heartsched.start(registry.view, time(), 0.5)
+            upwaker.wake()
+            set_logbox(text='Staggering &lt;HEART,&gt; over all rovers.')
             if rover_indx > -1:
                 webroverlist['hflag'] = [True]*len(webroverlist['hflag'])
                 updatecmd = 0
@@ -876,12 +1055,10 @@ def webapp(doc):
             mainlock.release()
         elif mybtn == SILENTallbtn:
             mainlock.acquire()
-            for rover in list_of_rovers:
+            heartsched.stop()
+            for rover in registry.view:
                 if rover.alive:
-                    rover.lock.acquire()
-                    rover.command = '<SILENT>'
-                    rover.cflag = True
-                    rover.lock.release()
+                    rover.put_command('<SILENT>')
             set_logbox(text='Sent &lt;SILENT&gt; to all rovers.')
             if rover_indx > -1:
                 webroverlist['hflag'] = [False]*len(webroverlist['hflag'])
@@ -890,55 +1067,35 @@ def webapp(doc):
                 HEARTbtn.active = 1
             mainlock.release()
         elif mybtn == PAUSEallbtn:
-            mainlock.acquire()
-            for rover in list_of_rovers:
+            for rover in registry.view:
                 if rover.alive:
-                    rover.lock.acquire()
-                    rover.pause = True
-                    rover.lock.release()
-            mainlock.release()
+                    rover.put_command(('PAUSE', True))
             set_logbox(text="Pause flags set for all live rovers.")
         elif mybtn == UNPAUSEallbtn:
-            mainlock.acquire()
-            for rover in list_of_rovers:
+            for rover in registry.view:
                 if rover.alive:
-                    rover.lock.acquire()
-                    rover.pause = False
-                    rover.lock.release()
-            mainlock.release()
+                    rover.put_command(('PAUSE', False))
             set_logbox(text="Pause flags unset for all live rovers.")
         elif mybtn == PAUSEbtn:
-            if rover_indx > -1:
-                mainlock.acquire()
-                rover = list_of_rovers[rover_indx]
-                rover.lock.acquire()
-                rover.pause = True
-                rover.lock.release()
-                mainlock.release()
+            rover = rover_at(rover_indx)
+            if rover is not None:
+                rover.put_command(('PAUSE', True))
                 set_logbox(text="Pause flag set on %s." %
                            webroverlist['name'][rover_indx])
         elif mybtn == PAUSEbtn:
-            if rover_indx > -1:
-                mainlock.acquire()
-                rover = list_of_rovers[rover_indx]
-                rover.lock.acquire()
-                rover.pause = True
-                rover.lock.release()
-                mainlock.release()
+            rover = rover_at(rover_indx)
+            if rover is not None:
+                rover.put_command(('PAUSE', True))
                 set_logbox(text="Pause flag set on %s." %
                            webroverlist['name'][rover_indx])
         elif mybtn == UNPAUSEbtn:
-            if rover_indx > -1:
-                mainlock.acquire()
-                rover = list_of_rovers[rover_indx]
-                rover.lock.acquire()
-                rover.pause = False
-                rover.lock.release()
-                mainlock.release()
+            rover = rover_at(rover_indx)
+            if rover is not None:
+                rover.put_command(('PAUSE', False))
                 set_logbox(text="Pause flag unset on %s." %
                            webroverlist['name'][rover_indx])
         elif mybtn == RUNseqbtn:
-            if rover_indx > -1 and len(webroverlist[
+            if rover_at(rover_indx) is not None and len(webroverlist[
                     'seqlist'][rover_indx]) > 2:
                 try:
                     _line1j = json.loads(webroverlist['seqlist'][
@@ -949,24 +1106,12 @@ def webapp(doc):
                     set_logbox(text="Bad json string in first row!",
                                color='red')
                 else:
-                    rover = list_of_rovers[rover_indx]
-                    rover.lock.acquire()
-                    rover.command = '<HALT>'
-                    rover.clean_send()
-                    rover.seqfile = 'sequences/'+webroverlist[
-                        'seqfile'][rover_indx]
-                    rover.seqlist = webroverlist['seqlist'][rover_indx][1:]
-                    rover.numseq = len(rover.seqlist)
-                    rover.loopflag = _line1j['loopflag']
-                    # if _line1j['start'] < rover.numseq:
-                    #     rover.superstate = _line1j['start']
-                    # else:
-                    #     rover.superstate = rover.numseq - 1
-                    rover.superstate = -2
-                    rover.ackflag = False
-                    rover.state = 0  # IDLE
-                    rover.pause = False
-                    rover.lock.release()
+                    # The rover loads seqfile itself (see Rover.apply_local)
+                    rover = rover_at(rover_indx)
+                    rover.put_command('<HALT>')
+                    rover.put_command(('SEQ', 'sequences/'+webroverlist[
+                        'seqfile'][rover_indx]))
+                    rover.put_command(('PAUSE', False))
                     set_logbox(text="Sent sequence to %s" %
                                webroverlist['name'][rover_indx])
         elif mybtn == READseqbtn:
@@ -1051,8 +1196,8 @@ def webapp(doc):
         else:
             send_nofcmd('SILENT')
             webroverlist['hflag'][rover_indx] = False
-        updatecmd = 0
-        doc.add_next_tick_callback(update_CDS)
+        send_deltas(dict(hflag=[(rover_indx, webroverlist['hflag'][
+            rover_indx])]), dict(threadname=[]))
 
     def oldstore_fcmd(old):
         global setposdict, fwddict, bwddict, cfwddict, cbwddict, turndict
@@ -1181,7 +1326,7 @@ def webapp(doc):
     mapp.on_event(DoubleTap, doubletaptoolcallback)
     fcmdsource.on_change('data', table_callback)
     dnorth.on_change('data', fcsl_callback)  # Compass angle change
-    doc.add_periodic_callback(update, 500)  # Periodic callback
+    doc.add_periodic_callback(update, webUI_period)  # Periodic callback
     rovermenu.on_change("value", rovermenu_handler)  # When selection changes
     showhide.on_change('active', showhide_callback)
     EDITmapbox.on_change('active', editmap_callback)
@@ -1204,56 +1349,84 @@ def webapp(doc):
 
 
 def webUIfunc():
-    # Start this in its own kill-able thread
+    # Start this in its own thread, and stop it with webUIstop()
+    global webUIserver
+    asyncio.set_event_loop(asyncio.new_event_loop())
     staticpath = 'web_templates'
-    webUIserver = Server({'/webapp': webapp}, num_procs=1,
-                         allow_websocket_origin=[
-                             webapp_addr, 'localhost:5006'],
-                         extra_patterns=[('/', IndexHandler),
-                                         ('/web_templates/(.*)',
-                                          StaticFileHandler,
-                                          {'path': staticpath})])
-    print('webUI: http://localhost:5006/')
-    webUIserver.start()
-    webUIserver.io_loop.instance().start()
-
-
-# I'll need this to "gracefully" exit bokeh/tornado webserver thread
-class thread_with_trace(threading.Thread):
-    def __init__(self, *args, **keywords):
-        threading.Thread.__init__(self, *args, **keywords)
-        self.killed = False
-
-    def start(self):
-        self.__run_backup = self.run
-        self.run = self.__run
-        threading.Thread.start(self)
-
-    def __run(self):
-        asyncio.set_event_loop(asyncio.new_event_loop())
-        sys.settrace(self.globaltrace)
-        self.__run_backup()
-        self.run = self.__run_backup
-
-    def globaltrace(self, frame, event, arg):
-        if event == 'call':
-            return self.localtrace
-        else:
-            return None
-
-    def localtrace(self, frame, event, arg):
-        if self.killed:
-            if event == 'line':
-                raise SystemExit()
-        return self.localtrace
-
-    def kill(self):
-        self.killed = True
-
-
-roverlistchanged = False
-roverchangetype = ''
-list_of_rovers = []
+    try:
+        webUIserver = Server({'/webapp': webapp}, num_procs=1,
+                             allow_websocket_origin=[
+                                 webapp_addr, 'localhost:5006'],
+                             extra_patterns=[('/', IndexHandler),
+                                             ('/metrics', MetricsHandler),
+                                             ('/web_templates/(.*)',
+                                              StaticFileHandler,
+                                              {'path': staticpath})])
+        print('webUI: http://localhost:5006/')
+        webUIserver.start()
+    finally:
+        webUIready.set()  # Also if the server failed to start
+    webUIserver.io_loop.start()
+    # Let open websocket handlers finish before the loop is closed
+    _loop = webUIserver.io_loop.asyncio_loop
+    _pending = asyncio.all_tasks(_loop)
+    for _task in _pending:
+        _task.cancel()
+    _loop.run_until_complete(asyncio.gather(*_pending,
+                                            return_exceptions=True))
+    webUIserver.io_loop.close()
+
+
+def webUIshutdown():
+    # Runs on the webUI IOLoop
+    webUIserver.stop()
+    webUIserver.io_loop.stop()
+
+
+def webUIstop():
+    '''Stop the Bokeh server and its IOLoop from another thread.
+    IOLoop.add_callback() is the only thread-safe way in.'''
+    webUIready.wait()
+    if webUIserver is not None:
+        webUIserver.io_loop.add_callback(webUIshutdown)
+
+
+def metricsfunc(port):
+    # Headless /metrics endpoint (without the webUI). Runs in its own
+    # thread, and is stopped with metricsstop()
+    global metricsloop
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    try:
+        _server = Application([('/metrics', MetricsHandler)]).listen(port)
+        metricsloop = IOLoop.current()
+        print('metrics: http://localhost:%d/metrics' % port)
+    finally:
+        metricsready.set()  # Also if the port was taken
+    metricsloop.start()
+    _server.stop()
+    metricsloop.close()
+
+
+def metricsstop():
+    metricsready.wait()
+    if metricsloop is not None:
+        metricsloop.add_callback(metricsloop.stop)
+
+
+webUIserver = None
+webUIready = threading.Event()  # Set once webUIserver is listening
+metricsloop = None
+metricsready = threading.Event()  # Set once metricsloop is listening
+# Main loop iterations, and time (s) spent in them outside select()
+loopstats = dict([('iterations', 0), ('busy', 0.0), ('max', 0.0)])
+datalog = None  # DatalogWriter, once the main loop starts
+heartsched = HeartScheduler()  # Fleet-wide heartbeat (HEARTBEAT ALL)
+estop = EmergencyStop()  # HALT ALL and console <HALT>
+pool = None  # ShardPool, when rovers are served by worker processes
+shardperiod = 0.1  # Seconds between fleet table updates (and reads)
+registry = RoverRegistry()  # Live rovers, by ID, name, thread, ...
+registry_mark = 0  # Last registry change the webUI has seen
+webrows = {}  # Rover ID -> row of webroverlist
 streamhandler = []
 filehandler = []
 numerical_level = logging.WARNING
@@ -1267,18 +1440,37 @@ if __name__ == '__main__':
     logconfig.basicConfig(level=logging.WARNING)
 
     webUIflag = False
+    metricsport = None
+    enginetype = 'threaded'  # One thread per rover, or 'asyncio'
+    shards = 0  # Worker processes serving rovers, 0 to serve them here
+    commitperiod = 1.0  # Seconds between datalog group commits
+    datalogformat = 'dat'  # Text datalogs, or 'pos' (binary)
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "daipw",
+        opts, args = getopt.getopt(sys.argv[1:], "dia:p:we:c:f:m:lb:s:q:",
                                    ["debug", "info",
-                                    "address", "port", "with-webUI"])
+                                    "address=", "port=", "with-webUI",
+                                    "engine=", "commit=", "format=",
+                                    "metrics=", "lockstats",
+                                    "heartbudget=", "shards=",
+                                    "sendqueue="])
     except getopt.GetoptError:
         print('usage: python ', sys.argv[0],
               '[-d|--debug|-i|--info] [-a|--address <IP_address>] '
-              '[-p|--port <port_number>] [-w|--with-webUI]')
+              '[-p|--port <port_number>] [-w|--with-webUI] '
+              '[-e|--engine <threaded|asyncio>] '
+              '[-c|--commit <datalog commit period (s)>] '
+              '[-f|--format <dat|pos>] [-m|--metrics <port>] '
+              '[-l|--lockstats] [-b|--heartbudget <MYPOS/s>] '
+              '[-s|--shards <worker processes>] '
+              '[-q|--sendqueue <bytes>[,<coalesce|drop|disconnect>]]')
         sys.exit(0)
     numerical_level = logging.WARNING
     logfmt = '%(name)s:%(levelname)s:\t%(message)s'
     logfmt = '%(asctime)s:'+logfmt
+    # Before -w, which starts the webUI thread that takes mainlock
+    if [opt for opt, arg in opts if opt in ["-l", "--lockstats"]]:
+        lockstats.enabled = True
+        mainlock = new_lock('mainlock')
     for opt, arg in opts:
         if opt in ["-i", "--info"]:
             numerical_level = logging.INFO
@@ -1290,9 +1482,40 @@ if __name__ == '__main__':
             Port = int(arg)
         elif opt in ["-w", "--with-webUI"]:
             # Start webUI stuff
-            webUIthread = thread_with_trace(target=webUIfunc)
+            webUIthread = threading.Thread(target=webUIfunc, name='webUI')
             webUIthread.start()
             webUIflag = True
+        elif opt in ["-e", "--engine"]:
+            if arg not in ['threaded', 'asyncio']:
+                print('Unknown engine: %s' % arg)
+                sys.exit(0)
+            enginetype = arg
+        elif opt in ["-c", "--commit"]:
+            commitperiod = float(arg)
+        elif opt in ["-f", "--format"]:
+            if arg not in ['dat', 'pos']:
+                print('Unknown datalog format: %s' % arg)
+                sys.exit(0)
+            datalogformat = arg
+        elif opt in ["-m", "--metrics"]:
+            metricsport = int(arg)  # Serve /metrics, also without webUI
+        elif opt in ["-b", "--heartbudget"]:
+            heartsched.budget = float(arg)  # 0 for no limit
+        elif opt in ["-s", "--shards"]:
+            shards = int(arg)
+            if shards > 0 and not hasattr(socket, 'SO_REUSEPORT'):
+                print('Sharding needs SO_REUSEPORT, not on this platform')
+                sys.exit(0)
+        elif opt in ["-q", "--sendqueue"]:
+            # High-water mark of each rover's send queue, and what to do
+            # past it
+            _fields = arg.split(',')
+            sendq_defaults['highwater'] = int(_fields[0])
+            if len(_fields) > 1:
+                if _fields[1] not in SendQueue.policies:
+                    print('Unknown send queue policy: %s' % _fields[1])
+                    sys.exit(0)
+                sendq_defaults['policy'] = _fields[1]
 
     # Remove old formatting from all handlers in root logger
     root_logger = logging.getLogger()
@@ -1323,74 +1546,89 @@ if __name__ == '__main__':
     # weblog.addHandler(filehandler)
     # weblog.addHandler(streamhandler)
 
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-    server.bind((IP_address, Port))
-    server.listen(10)
+    upwaker = Waker()  # Rovers wake the main loop when they set sflag
+    if shards > 0:
+        # Worker processes share Port and serve the rovers
+        server = None
+        pool = ShardPool(shards, IP_address, Port, upwaker, dict([
+            ('capacity', 4096), ('engine', enginetype),
+            ('loglevel', numerical_level),
+            ('logfile', logfilename[:-4]+'_w%d.log'),
+            ('commit', commitperiod), ('format', datalogformat),
+            ('period', shardperiod), ('report', 1.0),
+            ('sendq', dict(sendq_defaults))])).start()
+        soclist = [sys.stdin, upwaker]
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-    soclist = [server, sys.stdin]
+        server.bind((IP_address, Port))
+        server.listen(10)
+        soclist = [server, sys.stdin, upwaker]
     running = True
+    if enginetype == 'asyncio' and pool is None:
+        engine = AsyncEngine()
+        engine.start()
+    datalog = DatalogWriter(commitperiod, fmt=datalogformat)
+    datalog.start()
+    if metricsport is not None:
+        metricsthread = threading.Thread(target=metricsfunc,
+                                         args=(metricsport,), name='metrics')
+        metricsthread.start()
     inbuffer = ''
 
     print('Running')
     while running:
         # 1. Check for new connections
-        # 2. Kill dead rovers and remove from list_of_rovers
+        # 2. Kill dead rovers and remove them from the registry
         # 3. Respond to field-rover messages that were passed upstream
         # 4. Handle user stdin input
 
-        inlist, outlist, exlist = select.select(soclist, [], [], 0.1)
+        inlist, outlist, exlist = select.select(
+            soclist, [], [], heartsched.timeout(
+                time(), 1.0 if pool is None else shardperiod))
+        looptime = time()
+        if upwaker in inlist:
+            upwaker.drain()
+        if pool is not None:  # Rovers (dis)connected to worker processes
+            for newrover in pool.poll():
+                registry.add(newrover)
+                mainlog.info('<'+newrover.addr[0]+'>'+" connected")
         # 1. Handle new rovers joining
         if server in inlist:
             conn, addr = server.accept()
             newrover = Rover(conn, addr,
-                             streamhandler, filehandler, numerical_level)
-            mainlock.acquire()
-            list_of_rovers.append(newrover)
-            roverlistchanged = True
-            roverchangetype = 'NEW'
-            mainlock.release()
+                             streamhandler, filehandler, numerical_level,
+                             threaded=(enginetype == 'threaded'),
+                             datalog=datalog, upwaker=upwaker)
+            if not newrover.threaded:
+                engine.add_rover(newrover)
+            registry.add(newrover)
             mainlog.info('<'+addr[0]+'>'+" connected")
 
-        # 2. Prune list_of_rovers[] for dead connections
-        for rover in list_of_rovers:
+        # 2. Prune the registry of dead connections
+        for rover in registry.view:
             if not rover.alive:
-                rover.thread.join()
+                if rover.threaded:
+                    rover.thread.join()
                 mainlog.debug('removed dead rover <'+rover.addr[0]+'>')
-                mainlock.acquire()
-                roverindex = list_of_rovers.index(rover)
-                list_of_rovers.remove(rover)
-                roverlistchanged = True
-                roverchangetype = 'DIE:%d' % roverindex
-                mainlock.release()
+                registry.remove(rover)
 
         # 3. Respond to flagged field-rover messages passed upstream
         mainlock.acquire()
-        for rover in list_of_rovers:
-            rover.lock.acquire()
+        heartsched.tick(registry.view, looptime)
+        for rover in registry.view:
+            # No rover.lock: the rover adds to smsg_buffer before it sets
+            # sflag, so clearing sflag first never strands a message
             if rover.alive and rover.sflag:
-                if rover.smsg_buffer:
+                rover.sflag = False
+                while rover.smsg_buffer:
                     upmsg = rover.smsg_buffer.pop(0)
                     if upmsg[0:5] == '<MYID':
                         mainlog.debug("ID change detected.")
-                    elif upmsg[0:5] == '<SYN,':
-                        # Broadcast string to all other rovers
-                        mainlog.info(
-                            "Broadcasting SYN string '%s' from %s." %
-                            (upmsg[5:-1], rover.name))
-                        b_str = upmsg[5:-1]
-                        for rover2 in list_of_rovers:
-                            if rover2 != rover:
-                                rover2.lock.acquire()
-                                rover2.syn_str.append(b_str)
-                                rover2.lock.release()
                     else:
                         temptxt = "Code for %s from %s pending."
-                        mainlog.debug(temptxt % (upmsg, rover.name))
-                if len(rover.smsg_buffer) == 0:
-                    rover.sflag = False
-            rover.lock.release()
+                        mainlog.debug(temptxt % (upmsg, rover.snapshot.name))
         mainlock.release()
 
         # 4. Handle user stdin input
@@ -1401,60 +1639,132 @@ if __name__ == '__main__':
             if userinput == 'quit':
                 running = False
                 if webUIflag:
-                    webUIthread.kill()
+                    webUIstop()
                     webUIthread.join()
-                for rover in list_of_rovers:
+                if metricsport is not None:
+                    metricsstop()
+                    metricsthread.join()
+                if enginetype == 'asyncio' and pool is None:
+                    engine.stop()
+                for rover in registry.view:
                     rover.die()
-                    rover.thread.join()
+                    if rover.threaded:
+                        rover.thread.join()
+                if pool is not None:
+                    pool.stop()
+                datalog.stop()
+                if lockstats.enabled:
+                    print(lockstats.report())
             elif userinput == 'names':
-                mainlock.acquire()
-                for rover in list_of_rovers:
+                for rover in registry.view:
                     if rover.alive:
-                        print([rover.name, rover.version,
-                               rover.thread.getName()])
+                        _snap = rover.snapshot
+                        print([_snap.name, _snap.version, _snap.thread])
+            elif userinput == 'topics':
+                for topic, counts in sorted(default_synbus.stats().items()):
+                    print('%s: %d SYN, %d delivered, %d listening' % (
+                        (topic,)+counts))
+            elif userinput == 'loop':
+                print('Main loop: %d iterations, %.3f ms mean, %.3f ms max' %
+                      (loopstats['iterations'], 1e3*loopstats['busy'] /
+                       max(1, loopstats['iterations']), 1e3*loopstats['max']))
+            elif userinput == 'locks':
+                print(lockstats.report())
+            elif userinput == 'estop':
+                _stats = estop.stats()
+                print('%d emergency HALTs, %d failed writes' % (
+                    _stats['halts'], _stats['failed']))
+                if _stats['halts']:
+                    print('Dispatch: last %.3f ms, max %.3f ms' % (
+                        1e3*_stats['dispatch_last'],
+                        1e3*_stats['dispatch_max']))
+                if _stats['acks']:
+                    print('HALT to ACK (%d): p50 %.1f ms, p99 %.1f ms, max '
+                          '%.1f ms' % (_stats['acks'], 1e3*_stats['ack_p50'],
+                                       1e3*_stats['ack_p99'],
+                                       1e3*_stats['ack_max']))
+            elif userinput == 'sendq':
+                for rover in registry.view:
+                    _m = rover.metrics() if rover.alive else None
+                    if _m is None:  # Dead, or in a worker process
+                        continue
+                    print('%s (%s): ' % (_m['name'], _m['thread']) +
+                          '%(depth)d bytes waiting (max %(maxdepth)d), '
+                          '%(coalesced)d coalesced, %(dropped)d dropped, '
+                          '%(overflows)d past high-water, %(stalls)d stalls'
+                          % _m['sendq'])
+            elif userinput == 'heart':
+                mainlock.acquire()
+                _stats = heartsched.stats()
                 mainlock.release()
+                print('Fleet heartbeat %s: %d rovers, period %.3f s '
+                      '(%.3f s asked, budget %g MYPOS/s), %d HEART sent, '
+                      '%d pending, %d plans' % (
+                          'on' if _stats['active'] else 'off',
+                          _stats['rovers'], _stats['period'],
+                          _stats['requested'], _stats['budget'],
+                          _stats['sent'], _stats['pending'],
+                          _stats['replans']))
+            elif userinput == 'shards':
+                if pool is None:
+                    print('Not sharded (see -s|--shards)')
+                else:
+                    print('%(ready)d/%(workers)d workers ready, %(rovers)d '
+                          'rovers, %(relayed)d SYNs relayed' % pool.stats())
+            elif userinput == 'datalog':
+                print('Datalog writer: %(depth)d queued, lag %(lag).3f s, '
+                      '%(written)d written in %(commits)d commits, '
+                      '%(failed)d lost to write errors, '
+                      '%(open)d/%(files)d files open' % datalog.stats())
             elif userinput[0:4] == 'CMD:':
                 fields = userinput.split(':')
                 if len(fields) == 4:
-                    for rover in list_of_rovers:
-                        if [fields[1], fields[2]] == [
-                                rover.name, rover.thread.getName()]:
-                            rover.lock.acquire()
-                            rover.command = fields[3]
-                            rover.cflag = True
-                            rover.lock.release()
-                            break
+                    for rover in registry.find(name=fields[1],
+                                               thread=fields[2]).values():
+                        rover.put_command(fields[3])
                 else:
                     print("Malformed input: %s" % userinput)
             elif userinput[0:4] == 'SEQ:':
                 fields = userinput.split(':')
                 if len(fields) == 4:
-                    for rover in list_of_rovers:
-                        if [fields[1], fields[2]] == [
-                                rover.name, rover.thread.getName()]:
-                            rover.lock.acquire()
-                            rover.seqfile = fields[3]
-                            rover.superstate = -2
-                            rover.lock.release()
-                            break
+                    for rover in registry.find(name=fields[1],
+                                               thread=fields[2]).values():
+                        rover.put_command(('SEQ', fields[3]))
                 else:
                     print("Malformed input: %s" % userinput)
+            elif userinput[0] == '<' and \
+                    protoparse(instr=userinput)[:2] == (0, 'HEART'):
+                # Staggered by the scheduler instead of all at once
+                _values = protoparse(instr=userinput)[2]
+                mainlock.acquire()
+                heartsched.start(registry.view, time(), 0.5 if
+                                 _values[0] is None else 1e-3*_values[0])
+                mainlock.release()
+            elif userinput == '<HALT>':
+                estop.halt(registry.view)  # Emergency-stop lane
             elif userinput[0] == '<':
+                if userinput == '<SILENT>':
+                    mainlock.acquire()
+                    heartsched.stop()
+                    mainlock.release()
                 # broadcast to all live rovers
-                for rover in list_of_rovers:
+                for rover in registry.view:
                     if rover.alive:
-                        rover.lock.acquire()
-                        rover.command = userinput
-                        rover.cflag = True
-                        rover.lock.release()
+                        rover.put_command(userinput)
             else:
                 print("Unrecognized input: %s" % userinput)
 
+        looptime = time() - looptime
+        loopstats['iterations'] += 1
+        loopstats['busy'] += looptime
+        loopstats['max'] = max(loopstats['max'], looptime)
+
     try:
         conn.close()
     except NameError:
         pass
-    server.close()
+    if server is not None:
+        server.close()
     # Close logging handlers
     for handler in mainlog.handlers:
         handler.close()
@@ -0,0 +1,39 @@
+import sys
+import os
+import socket
+import logging
+import datetime
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from daimyo_utils import Rover  # noqa: E402
+from daimyo_datalog import DatalogWriter  # noqa: E402
+
+
+@pytest.fixture
+def rover_pair(tmp_path, monkeypatch):
+    '''make(**kwargs) -> (Rover not driven by any thread unless given
+    threaded=True, its field-rover end of the socket pair). Rovers log to
+    a writer of their own, unless given a 'datalog'.'''
+    monkeypatch.chdir(tmp_path)  # Rover writes datalogs/ relative to here
+    os.makedirs('datalogs/'+datetime.datetime.now().strftime('%Y_%m_%d'))
+    writer = DatalogWriter()
+    writer.start()
+    handler = logging.NullHandler()
+    made = []
+
+    def make(**kwargs):
+        kwargs.setdefault('datalog', writer)
+        kwargs.setdefault('threaded', False)
+        sock1, sock2 = socket.socketpair()
+        rover = Rover(sock1, ('test', len(made)), handler, handler,
+                      logging.WARNING, **kwargs)
+        made.append((rover, sock2))
+        return rover, sock2
+
+    yield make
+    for rover, peer in made:
+        rover.die()
+        if rover.threaded:
+            rover.thread.join()
+        peer.close()
+    writer.stop()
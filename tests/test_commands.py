@@ -0,0 +1,108 @@
+import os
+from daimyo_utils import CommandQueue, EmergencyStop
+
+
+def drain(cmdq):
+    _commands = []
+    _command = cmdq.get()
+    while _command is not None:
+        _commands.append(_command)
+        _command = cmdq.get()
+    return _commands
+
+
+def test_latest_motion_command_replaces_the_waiting_one():
+    cmdq = CommandQueue()
+    for _command in ['<GOTO,1,1,,,>', '<HEART,500>', '<FWD,1,,>', '<POS>',
+                     '<HALT>']:
+        assert cmdq.put(_command)
+    assert drain(cmdq) == ['<HEART,500>', '<POS>', '<HALT>']
+    assert cmdq.stats()['coalesced'] == 2
+
+
+def test_other_commands_keep_their_order():
+    cmdq = CommandQueue()
+    for _command in ['<HEART,500>', '<ID>', '<SILENT>', '<POS>',
+                     '<HEART,200>']:
+        cmdq.put(_command)
+    assert drain(cmdq) == ['<HEART,500>', '<ID>', '<SILENT>', '<POS>',
+                           '<HEART,200>']
+
+
+def test_full_queue_refuses_but_still_takes_a_newer_motion():
+    cmdq = CommandQueue(maxlen=3)
+    assert cmdq.put('<GOTO,1,1,,,>')
+    assert cmdq.put('<POS>')
+    assert cmdq.put('<ID>')
+    assert not cmdq.put('<POS>')
+    assert cmdq.put('<HALT>')  # Takes the GOTO's place
+    assert cmdq.stats() == dict([('depth', 3), ('put', 4), ('coalesced', 1),
+                                 ('refused', 1)])
+    assert drain(cmdq) == ['<POS>', '<ID>', '<HALT>']
+
+
+def test_full_queue_never_refuses_halt():
+    cmdq = CommandQueue(maxlen=3)
+    for _command in ['<HEART,500>', '<POS>', '<SILENT>']:
+        assert cmdq.put(_command)
+    assert not cmdq.put('<ID>')
+    assert cmdq.put('<HALT>')  # Takes the oldest command's place
+    assert cmdq.stats()['refused'] == 2
+    assert drain(cmdq) == ['<POS>', '<SILENT>', '<HALT>']
+
+
+def test_local_commands_queue_in_order_with_the_rest():
+    cmdq = CommandQueue()
+    for _command in ['<GOTO,1,1,,,>', ('PAUSE', True), '<HALT>',
+                     ('SEQ', 'sequences/test.seq')]:
+        assert cmdq.put(_command)
+    assert drain(cmdq) == [('PAUSE', True), '<HALT>',
+                           ('SEQ', 'sequences/test.seq')]
+
+
+def test_local_commands_are_not_sent(rover_pair):
+    rover, peer = rover_pair()
+    peer.setblocking(False)
+    rover.put_command(('PAUSE', True))
+    rover.put_command('<POS>')
+    rover.chug()
+    assert rover.pause
+    assert peer.recv(100) == b'<POS>'
+
+
+def test_seq_command_loads_the_sequence(rover_pair):
+    rover, peer = rover_pair()
+    rover.put_command(('SEQ', os.path.join(os.path.dirname(__file__), '..',
+                                           'sequences', 'test_wedge.seq')))
+    rover.chug()
+    assert rover.numseq == 3
+    assert rover.superstate > -1
+    assert peer.recv(100).startswith(b'<HALT>')
+
+
+def test_drop_forgets_the_given_types():
+    cmdq = CommandQueue()
+    for _command in ['<HEART,500>', '<GOTO,1,1,,,>']:
+        cmdq.put(_command)
+    cmdq.drop(CommandQueue.motion)
+    assert drain(cmdq) == ['<HEART,500>']
+
+
+def test_emergency_halt_goes_ahead_of_queued_motion(rover_pair):
+    rover, peer = rover_pair()
+    other, other_peer = rover_pair()
+    lane = EmergencyStop()
+    rover.put_command('<GOTO,1,1,,,>')
+    rover.put_command('<HEART,500>')
+    lane.halt([rover, other])
+    assert peer.recv(100) == b'<HALT>'
+    assert other_peer.recv(100) == b'<HALT>'
+    assert rover.put_command('<FWD,1,,>')  # Queued, but held until...
+    rover.chug()  # ...this pass, which drops the sequence and the hold
+    assert rover.superstate == -1
+    assert peer.recv(100) == b'<HEART,500><FWD,1,,>'
+    rover.receive(b'<ACK,0>')
+    rover.chug()
+    _stats = lane.stats()
+    assert (_stats['halts'], _stats['failed'], _stats['acks']) == (1, 0, 1)
+    assert rover.halt_latency is not None
@@ -0,0 +1,97 @@
+import os
+import logging
+from daimyo_datalog import DatalogWriter, posheader, read_poslog, poshead
+from daimyo_datalog import dat_to_poslog
+
+
+def test_written_counts_records_on_disk_only(tmp_path):
+    writer = DatalogWriter()  # Not started: commit() by hand
+    good = writer.open(str(tmp_path/'Ronin1.dat'), '# header\n')
+    bad = writer.open(str(tmp_path/'missing'/'Ronin2.dat'), '# header\n')
+    for _record in [(1.0, 0.0, 0.0, 0.0), (2.0, 0.1, 0.0, 0.0)]:
+        writer.write(good, _record)
+        writer.write(bad, _record)
+    writer.commit()
+    _stats = writer.stats()
+    assert _stats['written'] == 2
+    assert _stats['failed'] == 2
+    assert (tmp_path/'Ronin1.dat').read_text().count('\n') == 3
+
+
+def test_version_only_myid_keeps_the_file(rover_pair):
+    writer = DatalogWriter()
+    rover, peer = rover_pair(datalog=writer)
+    for _myid in [b'<MYID,Ronin1,0>', b'<MYID,Ronin1,0_RFID>']:
+        rover.receive(_myid)
+        rover.chug()
+        writer.commit()
+    assert rover.version == '0_RFID'
+    assert os.listdir(os.path.dirname(rover.datafile)) == [
+        os.path.basename(rover.datafile)]
+    with open(rover.datafile) as _fid:
+        assert _fid.read().count('# ID: ') == 2
+
+
+def test_datafile_is_the_name_the_writer_used(rover_pair):
+    writer = DatalogWriter()
+    rover1, peer1 = rover_pair(datalog=writer)
+    rover2, peer2 = rover_pair(datalog=writer)
+    writer.commit()
+    for _rover in [rover1, rover2]:
+        _rover.receive(b'<MYID,Ronin1,0>')  # Both onto one name
+        _rover.chug()
+        writer.commit()
+    assert rover1.datafile.endswith('_Ronin1.dat')
+    assert rover2.datafile.endswith('_Ronin1_1.dat')
+    for _rover in [rover1, rover2]:
+        with open(_rover.datafile) as _fid:
+            assert _fid.read().count('-> (Ronin1, v0)') == 1
+
+
+def test_posheader_cuts_multibyte_names_whole(tmp_path):
+    # A first line too long for the header block, ending in 3-byte chars
+    _line = '# ID: (%s, v0)\n' % ('火'*(poshead//3))
+    for _pad in range(3):  # Each place the cut can fall in a character
+        _header = posheader(['#'*_pad + _line])
+        assert len(_header) == poshead
+        _name = str(tmp_path/('Ronin%d.pos' % _pad))
+        with open(_name, 'wb') as _fid:
+            _fid.write(_header)
+        _lines, _records = read_poslog(_name)
+        assert _lines[0].startswith('#'*_pad + '# ID: (火')
+        assert len(_records) == 0
+
+
+def test_pos_format_round_trip(tmp_path):
+    writer = DatalogWriter(fmt='pos')
+    _key = writer.open(str(tmp_path/'Ronin1.pos'), '# ID: (Ronin1, 0)\n')
+    _written = [(1.0, 0.5, -0.25, 90.0), (2.5, 0.75, 0.0, 359.5)]
+    for _record in _written:
+        writer.write(_key, _record)
+    writer.commit()
+    writer.rename(_key, str(tmp_path/'Ronin1.pos'), '# ID: (Ronin1, 1)\n')
+    writer.write(_key, (3.0, 1.0, 1.0, 0.0))
+    writer.commit()
+    writer._close(_key)
+    _lines, _records = read_poslog(str(tmp_path/'Ronin1.pos'))
+    assert _lines == ['# ID: (Ronin1, 0)\n', '# ID: (Ronin1, 1)\n']
+    assert [tuple(_row) for _row in _records] == _written+[
+        (3.0, 1.0, 1.0, 0.0)]
+
+
+def test_dat_to_poslog_skips_malformed_lines(tmp_path, caplog):
+    _dat = tmp_path/'Ronin1.dat'
+    _dat.write_text('# ID: (Ronin1, 0)\n'
+                    '1.0\t0.500\t-0.250\t90.000\n'
+                    '\n'
+                    '2.0\tnan\t0.000\tx\n'
+                    '2.5\t0.750\t0.000\t359.500\n'
+                    '12.3 1.0')  # Cut short by a crash mid-write
+    with caplog.at_level(logging.WARNING):
+        _pos = dat_to_poslog(str(_dat))
+    assert _pos == str(tmp_path/'Ronin1.pos')
+    assert 'Skipped 2 malformed' in caplog.text
+    _lines, _records = read_poslog(_pos)
+    assert _lines == ['# ID: (Ronin1, 0)\n']
+    assert [tuple(_row) for _row in _records] == [
+        (1.0, 0.5, -0.25, 90.0), (2.5, 0.75, 0.0, 359.5)]
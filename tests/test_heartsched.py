@@ -0,0 +1,73 @@
+import pytest
+from daimyo_utils import HeartScheduler
+
+
+class Beater:
+    '''Rover stand-in that beats from its HEART until its SILENT'''
+
+    def __init__(self):
+        self.alive = True
+        self.heartbeat = False
+        self.heartperiod = 0.5
+        self.sent = []
+
+    def put_command(self, cmd):
+        self.sent.append(cmd)
+        if cmd.startswith('<HEART'):
+            self.heartbeat = True
+            self.heartperiod = 1e-3*int(cmd[7:-1])
+        elif cmd == '<SILENT>':
+            self.heartbeat = False
+        return True
+
+
+def run(sched, rovers, t0, t1, step=0.01):
+    _t = t0
+    while _t < t1:
+        sched.tick(rovers, _t)
+        _t += step
+    return _t
+
+
+def test_heart_slots_spread_over_the_period():
+    sched = HeartScheduler(period=0.5, budget=0)
+    rovers = [Beater() for ii in range(5)]
+    sched.start(rovers, 0.0)
+    run(sched, rovers, 0.0, 0.6)
+    assert all([rover.sent == ['<HEART,500>'] for rover in rovers])
+    assert sorted(sched.phases.values()) == [0.0, 0.1, 0.2, 0.3, 0.4]
+
+
+def test_new_rover_fills_the_widest_gap():
+    sched = HeartScheduler(period=0.5, budget=0)
+    rovers = [Beater() for ii in range(4)]
+    sched.start(rovers, 0.0)
+    run(sched, rovers, 0.0, 0.6)
+    rovers.append(Beater())
+    run(sched, rovers, 0.6, 1.2)
+    assert sched.replans == 1
+    assert sched.phases[rovers[-1]] == 0.4375
+    assert rovers[-1].sent == ['<HEART,500>']
+
+
+def test_replan_keeps_beating_rovers_beating():
+    sched = HeartScheduler(period=0.5, budget=10.0)  # 5 rovers in 0.5 s
+    rovers = [Beater() for ii in range(5)]
+    sched.start(rovers, 0.0)
+    run(sched, rovers, 0.0, 0.6)
+    assert all([rover.heartbeat for rover in rovers])
+    newcomer = Beater()
+    newcomer.put_command('<HEART,200>')  # Beating on its own
+    rovers += [newcomer] + [Beater() for ii in range(4)]  # 10 need 1 s
+    _t = 0.6
+    while _t < 2.0:
+        sched.tick(rovers, _t)
+        assert all([rover.heartbeat for rover in rovers[:5]])
+        _t += 0.01
+    assert sched.replans == 2
+    assert sched.planned == 1.0
+    for rover in rovers[:5]:
+        assert rover.sent == ['<HEART,500>', '<HEART,1000>']
+    assert newcomer.sent == ['<HEART,200>', '<SILENT>', '<HEART,1000>']
+    assert sorted(sched.phases.values()) == pytest.approx(
+        [0.1*ii for ii in range(10)])
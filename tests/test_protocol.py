@@ -0,0 +1,85 @@
+import pytest
+from daimyo_utils import TCPframer, binpack, binsizes, protoparse
+
+
+def feed_all(framer, packets):
+    frames = []
+    for packet in packets:
+        frames += framer.feed(packet)
+    return frames
+
+
+def test_framer_returns_every_frame_of_a_packet():
+    framer = TCPframer()
+    assert framer.feed(b'<ACK,1><MYPOS,1.0,2.0,90.0><ACK,>') == [
+        '<ACK,1>', '<MYPOS,1.0,2.0,90.0>', '<ACK,>']
+    assert len(framer) == 0
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7])
+def test_framer_joins_frames_split_over_packets(size):
+    stream = b'<MYPOS,1.000,2.000,3.000><ACK,0><MYID,Ronin1,0>'
+    packets = [stream[ii:ii+size] for ii in range(0, len(stream), size)]
+    assert feed_all(TCPframer(), packets) == [
+        '<MYPOS,1.000,2.000,3.000>', '<ACK,0>', '<MYID,Ronin1,0>']
+
+
+def test_framer_drops_noise_and_restarts_on_a_new_start():
+    framer = TCPframer()
+    assert framer.feed(b'~#~<MYPO<ACK,1>noise<FAIL') == ['<ACK,1>']
+    assert framer.feed(b'>') == ['<FAIL>']
+    assert framer.junk == 0
+
+
+def test_framer_overflow_on_a_rogue_stream():
+    framer = TCPframer(maxlen=64)
+    framer.feed(b'x'*60)  # Noise, within the limit
+    assert not framer.overflow
+    framer.feed(b'<'+b'y'*10)  # A start forgives the noise
+    assert not framer.overflow
+    framer.feed(b'y'*60)  # A frame that never ends
+    assert framer.overflow
+    framer.reset()
+    assert not framer.overflow and len(framer) == 0
+
+
+def test_framer_bad_delimiters():
+    with pytest.raises(ValueError):
+        TCPframer(start=b'|', end=b'|')
+
+
+def test_binary_frames_between_ascii_frames():
+    frame = binpack('MYPOS', 1.5, -2.25, 90.0)
+    stream = b'<ACK,1>' + frame + b'<ACK,0>' + frame
+    framer = TCPframer(binary=binsizes())
+    assert feed_all(framer, [stream[:9], stream[9:20], stream[20:]]) == [
+        '<ACK,1>', frame, '<ACK,0>', frame]
+
+
+def test_binary_marker_without_binend_is_skipped():
+    frame = binpack('MYPOS', 1.0, 2.0, 3.0)
+    bad = frame[:-1] + b'\x00'
+    framer = TCPframer(binary=binsizes())
+    assert framer.feed(bad + b'<ACK,1>' + frame) == ['<ACK,1>', frame]
+
+
+def test_0_bin_mypos_round_trip():
+    values = [1.5, -2.25, 359.5]  # Exact in single precision
+    frame = binpack('MYPOS', *values)
+    assert len(frame) == binsizes()[frame[:1]]
+    assert TCPframer(binary=binsizes()).feed(frame) == [frame]
+    assert protoparse('0_BIN', 'msg', frame) == (0, 'MYPOS', values)
+
+
+def test_0_bin_is_refused_by_ascii_versions():
+    frame = binpack('MYPOS', 1.0, 2.0, 3.0)
+    assert protoparse('0', 'msg', frame)[0] != 0
+    assert protoparse('0_BIN', 'msg', frame[:-3])[0] != 0  # Truncated
+
+
+def test_0_bin_mypos_moves_the_rover(rover_pair):
+    rover, peer = rover_pair()
+    rover.version = '0_BIN'
+    rover.receive(binpack('MYPOS', 1.5, -2.25, 90.0))
+    rover.chug()
+    assert [rover.x, rover.y, rover.angle] == [1.5, -2.25, 90.0]
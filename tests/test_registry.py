@@ -0,0 +1,90 @@
+import threading
+from daimyo_registry import RoverRegistry
+
+
+class Stub:
+    def __init__(self, name, thread, addr='10.0.0.1'):
+        self.name = name
+        self.version = '0'
+        self.thread = threading.Thread(name=thread)
+        self.addr = (addr, 1234)
+        self.registry = None
+
+
+def test_ids_are_stable_and_never_reused():
+    registry = RoverRegistry()
+    one, two = Stub('a', 'Thread-1'), Stub('b', 'Thread-2')
+    assert [registry.add(one), registry.add(two)] == [1, 2]
+    assert registry.remove(one) == 1
+    assert registry.remove(one) is None
+    three = Stub('a', 'Thread-3')
+    assert registry.add(three) == 3
+    assert registry.get(1) is None
+    assert registry.get(2) is two and registry.id_of(three) == 3
+    assert registry.view == (two, three)
+    assert len(registry) == 2 and one not in registry
+
+
+def test_find_by_any_keys():
+    registry = RoverRegistry()
+    rovers = [Stub('a', 'Thread-1'), Stub('a', 'Thread-2', '10.0.0.2'),
+              Stub('b', 'Thread-3', '10.0.0.2')]
+    for rover in rovers:
+        registry.add(rover)
+    assert registry.find(name='a') == {1: rovers[0], 2: rovers[1]}
+    assert registry.find(name='a', thread='Thread-2') == {2: rovers[1]}
+    assert registry.find(addr='10.0.0.2', version='0') == {2: rovers[1],
+                                                           3: rovers[2]}
+    assert registry.find(name='a', thread='Thread-3') == {}
+    assert registry.find(name='c') == {}
+    assert len(registry.find()) == 3
+
+
+def test_reindex_follows_myid():
+    registry = RoverRegistry()
+    rover = Stub('Rover-0', 'Thread-1')
+    registry.add(rover)
+    assert rover.registry is registry
+    rover.name, rover.version = 'Ronin7', '0_RFID'
+    registry.reindex(rover)
+    assert registry.find(name='Rover-0') == {}
+    assert registry.find(name='Ronin7', version='0_RFID') == {1: rover}
+    registry.remove(rover)
+    assert registry.by_name == {} and registry.by_version == {}
+
+
+def test_changes_since_a_mark():
+    registry = RoverRegistry()
+    one, two = Stub('a', 'Thread-1'), Stub('b', 'Thread-2')
+    events, mark = registry.changes(0)
+    assert (events, mark) == ([], 0)
+    registry.add(one)
+    registry.add(two)
+    events, mark = registry.changes(mark)
+    assert events == [('NEW', 1), ('NEW', 2)]
+    registry.remove(one)
+    assert registry.changes(mark) == ([('DIE', 1)], 3)
+    assert registry.changes(3) == ([], 3)
+    assert registry.changes(0)[0] == [('NEW', 1), ('NEW', 2), ('DIE', 1)]
+
+
+def test_changes_forgotten_since_the_mark():
+    registry = RoverRegistry(keep=4)
+    rovers = [Stub('r%d' % ii, 'Thread-%d' % ii) for ii in range(6)]
+    for rover in rovers:
+        registry.add(rover)
+    assert registry.changes(0) == (None, 6)  # Compare with view instead
+    assert registry.changes(2) == ([('NEW', 3), ('NEW', 4), ('NEW', 5),
+                                    ('NEW', 6)], 6)
+
+
+def test_pruning_while_iterating_the_view():
+    registry = RoverRegistry()
+    rovers = [Stub('r%d' % ii, 'Thread-%d' % ii) for ii in range(5)]
+    for rover in rovers:
+        registry.add(rover)
+    for rover in registry.view:  # As the server main loop prunes
+        if rovers.index(rover) % 2 == 0:
+            registry.remove(rover)
+    assert registry.view == (rovers[1], rovers[3])
+    assert registry.changes(5)[0] == [('DIE', 1), ('DIE', 3), ('DIE', 5)]
@@ -0,0 +1,150 @@
+from time import time
+import pytest
+from daimyo_utils import TimerHeap
+
+
+def send(rover, command):
+    rover.lock.acquire()
+    rover.command = command
+    _sent = rover.clean_send()
+    rover.lock.release()
+    return _sent
+
+
+@pytest.mark.parametrize('command', ['<FWD,1.0,0.2,10000>', '<TURN,90,10000>',
+                                     '<GOTO,1,2,,,10000>'])
+def test_timeout_field_is_milliseconds(rover_pair, command):
+    rover, peer = rover_pair()
+    t0 = time()
+    assert send(rover, command)
+    assert 10.0 < rover.deadline - t0 < 10.0 + rover._deadline_grace + 0.1
+
+
+@pytest.mark.parametrize('command', ['<FWD,1.0,0.2,0>', '<FWD,1.0,0.2,>',
+                                     '<CFWD,0.2,0>', '<OBS,,0>'])
+def test_zero_or_no_timeout_sets_no_deadline(rover_pair, command):
+    rover, peer = rover_pair()
+    rover.deadline = time() + 5.0  # Left over from an earlier command
+    assert send(rover, command)
+    assert rover.deadline is None
+
+
+def read_until(peer, text, limit=2.0):
+    '''Bytes the field rover end got up to and including 'text', and the
+    time() it arrived'''
+    peer.settimeout(limit)
+    _data = b''
+    while text not in _data:
+        _data += peer.recv(4096)
+    return _data, time()
+
+
+def threaded_rover(rover_pair):
+    '''A rover served by its own run_loop, that only wakes up by itself
+    after far longer than these tests take'''
+    rover, peer = rover_pair(threaded=True, timers=TimerHeap())
+    rover._idle_timeout = 30.0
+    rover._deadline_grace = 0.05
+    return rover, peer
+
+
+def test_timer_wakes_rover_to_halt_a_timed_out_command(rover_pair):
+    rover, peer = threaded_rover(rover_pair)
+    t0 = time()
+    assert rover.put_command('<FWD,1.0,0.2,50>')
+    _data, t1 = read_until(peer, b'<HALT>')
+    assert _data.startswith(b'<FWD,1.0,0.2,50>')
+    assert 0.1 <= t1 - t0 < 1.0
+    rover.lock.acquire()  # Held while it sends HALT and handles TIMEOUT
+    assert rover.smsg_buffer == ['<TIMEOUT>']
+    assert rover.deadline is None
+    rover.lock.release()
+    assert rover.timers.stats()['fired'] >= 1
+
+
+def test_sequence_wait_ends_on_its_timer(rover_pair, tmp_path):
+    rover, peer = threaded_rover(rover_pair)
+    seqfile = tmp_path/'wait.seq'
+    seqfile.write_text('{"loopflag":false,"start":0}\n'
+                       '<WAIT,0.05>\n<FWD,0.1,0.2,0>\n')
+    assert rover.put_command(('SEQ', str(seqfile)))
+    _data, t0 = read_until(peer, b'<HALT>')  # Sequence loaded
+    _data, t1 = read_until(peer, b'<FWD,0.1,0.2,0>')
+    assert 0.04 <= t1 - t0 < 0.5
+    assert rover.timers.stats()['fired'] >= 1
+
+
+def test_message_passed_up_is_in_buffer_once_flagged(rover_pair):
+    rover, peer = rover_pair()
+    serial = rover.snapshot.serial
+    assert not rover.sflag
+    rover.receive(b'<TIMEOUT>')
+    rover.chug()
+    assert rover.sflag
+    assert rover.smsg_buffer == ['<TIMEOUT>']
+    assert rover.snapshot.serial == serial  # No new snapshot for it
+
+
+def test_die_twice_closes_once(rover_pair):
+    class Upwaker:
+        wakes = 0
+
+        def wake(self):
+            self.wakes += 1
+    rover, peer = rover_pair(upwaker=Upwaker())
+    rover.die()
+    rover.die()
+    assert not rover.alive
+    assert rover.upwaker.wakes == 1
+
+
+def mypos(rover, x, y, angle):
+    '''Feed one MYPOS and return whether it was passed on to the webUI'''
+    rover.wevents.drain()
+    rover.receive(('<MYPOS,%s,%s,%s>' % (x, y, angle)).encode())
+    rover.chug()
+    return ['MYPOS', x, y, angle] in rover.wevents.drain()
+
+
+def test_jitter_inside_deadband_is_suppressed(rover_pair):
+    rover, peer = rover_pair()
+    assert mypos(rover, 1.0, 1.0, 90.0)  # First one is always passed on
+    writes = rover.datalog_writes
+    assert not mypos(rover, 1.005, 0.996, 90.5)
+    assert not mypos(rover, 0.998, 1.004, 89.2)
+    assert rover.pos_suppressed == 2
+    assert rover.datalog_writes == writes
+    assert (rover.x, rover.y, rover.angle) == (0.998, 1.004, 89.2)
+
+
+def test_move_of_dxy_is_logged_and_shown(rover_pair):
+    rover, peer = rover_pair()
+    assert mypos(rover, 1.0, 1.0, 90.0)
+    writes = rover.datalog_writes
+    assert mypos(rover, 1.0, 1.0+rover.Dxy, 90.0)
+    assert mypos(rover, 1.0, 1.0+rover.Dxy, 90.0+rover.Dangle)
+    assert rover.datalog_writes == writes + 2
+    assert rover.pos_suppressed == 0
+
+
+def test_deadband_angle_wraps_around(rover_pair):
+    rover, peer = rover_pair()
+    assert mypos(rover, 0.0, 0.0, 359.5)
+    assert not mypos(rover, 0.0, 0.0, 0.2)  # 0.7 degrees across 0
+    assert mypos(rover, 0.0, 0.0, 1.0)  # 1.5 degrees across 0
+    assert rover.pos_suppressed == 1
+
+
+def test_first_mypos_after_state_change_is_passed_on(rover_pair):
+    rover, peer = rover_pair()
+    assert mypos(rover, 1.0, 1.0, 90.0)
+    rover.receive(b'<ACK,1>')
+    rover.chug()
+    assert mypos(rover, 1.001, 1.0, 90.0)  # Inside the dead-band
+    assert not mypos(rover, 1.002, 1.0, 90.0)
+    rover.receive(b'<ACK,1>')  # Same state: no change
+    rover.chug()
+    assert not mypos(rover, 1.003, 1.0, 90.0)
+    rover.receive(b'<ACK,0>')
+    rover.chug()
+    assert mypos(rover, 1.004, 1.0, 90.0)
@@ -0,0 +1,118 @@
+import pytest
+from daimyo_utils import SendQueue
+
+
+class Link:
+    '''Socket stand-in that takes 'room' more bytes, then would block'''
+
+    def __init__(self, room=0):
+        self.room = room
+        self.data = b''
+
+    def send(self, data):
+        if not self.room:
+            raise BlockingIOError
+        _sent = min(self.room, len(data))
+        self.room -= _sent
+        self.data += data[:_sent]
+        return _sent
+
+
+def queued(sendq):
+    return [_item[1] for _item in sendq.items]
+
+
+def test_send_goes_straight_out_when_nothing_waits():
+    sendq = SendQueue()
+    link = Link(100)
+    assert sendq.send(link, 'HALT', b'<HALT>') == 0
+    assert link.data == b'<HALT>'
+    assert len(sendq) == 0
+
+
+def test_stalled_link_keeps_the_rest_in_order():
+    sendq = SendQueue()
+    link = Link(3)
+    assert sendq.send(link, 'HALT', b'<HALT>') == 0
+    assert sendq.send(link, 'POS', b'<POS>') == 0
+    assert link.data == b'<HA'
+    assert sendq.depth == 3 + 5
+    link.room = 100
+    assert sendq.flush(link)
+    assert link.data == b'<HALT><POS>'
+    assert sendq.depth == 0
+
+
+def test_coalesce_replaces_waiting_commands_of_the_same_type():
+    sendq = SendQueue(highwater=20, policy='coalesce')
+    link = Link()
+    for _type, _cmd in [('GOTO', b'<GOTO,1,1,,,>'), ('HEART', b'<HEART,500>'),
+                        ('GOTO', b'<GOTO,2,2,,,>')]:
+        assert sendq.send(link, _type, _cmd) == 0
+    assert queued(sendq) == [b'<HEART,500>', b'<GOTO,2,2,,,>']
+    assert sendq.coalesced == 1
+
+
+def test_coalesce_keeps_a_partly_sent_command():
+    sendq = SendQueue(highwater=10, policy='coalesce')
+    link = Link(2)
+    sendq.send(link, 'GOTO', b'<GOTO,1,1,,,>')
+    sendq.send(link, 'GOTO', b'<GOTO,2,2,,,>')
+    assert queued(sendq) == [b'<GOTO,1,1,,,>', b'<GOTO,2,2,,,>']
+    link.room = 100
+    sendq.flush(link)
+    assert link.data == b'<GOTO,1,1,,,><GOTO,2,2,,,>'
+
+
+def test_drop_policy_drops_heartbeat_commands_only():
+    sendq = SendQueue(highwater=10, policy='drop')
+    link = Link()
+    assert sendq.send(link, 'GOTO', b'<GOTO,1,1,,,>') == 0
+    assert sendq.send(link, 'HEART', b'<HEART,500>') == 1
+    assert sendq.send(link, 'POS', b'<POS>') == 1
+    assert sendq.send(link, 'HALT', b'<HALT>') == 0
+    assert queued(sendq) == [b'<GOTO,1,1,,,>', b'<HALT>']
+    assert sendq.dropped == 2
+
+
+def test_disconnect_policy_past_highwater():
+    sendq = SendQueue(highwater=10, policy='disconnect')
+    link = Link()
+    assert sendq.send(link, 'HALT', b'<HALT>') == 0
+    assert sendq.send(link, 'GOTO', b'<GOTO,1,1,,,>') == 2
+
+
+@pytest.mark.parametrize('policy', SendQueue.policies)
+def test_hardlimit_closes_under_any_policy(policy):
+    sendq = SendQueue(highwater=4, policy=policy, hardlimit=16)
+    link = Link()
+    assert sendq.send(link, 'ID', b'<ID>') == 0
+    assert sendq.send(link, 'SETPOS', b'<SETPOS,1,2,90>') == 2
+
+
+def test_socket_error():
+    class Broken(Link):
+        def send(self, data):
+            raise ConnectionResetError
+    assert SendQueue().send(Broken(), 'HALT', b'<HALT>') == 3
+
+
+def test_bad_policy():
+    with pytest.raises(ValueError):
+        SendQueue(policy='lossy')
+
+
+def test_urgent_jumps_the_queue_and_holds_types_until_release():
+    sendq = SendQueue()
+    link = Link(2)
+    sendq.send(link, 'GOTO', b'<GOTO,1,1,,,>')
+    sendq.send(link, 'HEART', b'<HEART,500>')
+    sendq.send(link, 'FWD', b'<FWD,1,,>')
+    link.room = 100
+    assert sendq.urgent(link, 'HALT', b'<HALT>', hold=('GOTO', 'FWD'))
+    # The GOTO partly sent is finished first, the FWD waiting is dropped
+    assert link.data == b'<GOTO,1,1,,,><HALT><HEART,500>'
+    assert sendq.send(link, 'FWD', b'<FWD,2,,>') == 1
+    sendq.release()
+    assert sendq.send(link, 'FWD', b'<FWD,2,,>') == 0
+    assert link.data.endswith(b'<FWD,2,,>')
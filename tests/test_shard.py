@@ -0,0 +1,147 @@
+import multiprocessing
+from time import time
+import numpy as np
+from daimyo_utils import Waker, EmergencyStop
+from daimyo_shard import FleetTable, ShardRover, ShardPool, table_dtype
+
+
+def row(nn):
+    '''A row whose fields all say 'nn', so a torn one is easy to spot'''
+    return (nn, 1, 0, 0, b'r%d' % nn, b'v%d' % nn, b'Thread-%d' % nn,
+            b'10.0.0.%d' % (nn % 256), float(nn), float(nn), float(nn),
+            float(nn), float(nn), float(nn), nn, nn, float(nn))
+
+
+def torn(_row):
+    _nn = int(_row['gen'])
+    return (_row['name'], _row['version'], _row['thread']) != (
+        b'r%d' % _nn, b'v%d' % _nn, b'Thread-%d' % _nn) or \
+        not (_row['x'] == _row['y'] == _row['angle'] == _row['sx'] ==
+             _row['sy'] == _row['sangle'] == _row['heartperiod'] ==
+             _row['state'] == _row['superstate'] == _nn)
+
+
+def writer(name, slots, stop):
+    table = FleetTable(len(slots), name)
+    nn = 1
+    while not stop.is_set():
+        for slot in slots:
+            table.write(slot, row(nn))
+        nn += 1
+    table.close()
+
+
+def test_snapshot_marks_written_rows_valid():
+    table = FleetTable(8)
+    try:
+        table.write(3, row(7))
+        rows, valid = table.snapshot()
+        assert valid[3]
+        assert rows['seq'][3] == 2
+        assert not torn(rows[3])
+    finally:
+        table.close()
+
+
+def test_snapshot_skips_row_being_written():
+    table = FleetTable(8)
+    try:
+        table.write(3, row(7))
+        table.rows['seq'][3] += 1  # A writer in the middle of the row
+        rows, valid = table.snapshot()
+        assert not valid[3]
+    finally:
+        table.close()
+
+
+def test_no_torn_row_marked_valid():
+    '''One writer process rewriting rows as fast as it can, the reader
+    copying the table: every row it keeps has to be whole'''
+    table = FleetTable(16)
+    stop = multiprocessing.Event()
+    proc = multiprocessing.Process(target=writer,
+                                   args=(table.name, range(16), stop))
+    proc.start()
+    try:
+        kept = 0
+        t_end = time() + 2.0
+        while time() < t_end:
+            rows, valid = table.snapshot()
+            for slot in np.flatnonzero(valid & (rows['gen'] > 0)):
+                assert not torn(rows[slot]), rows[slot]
+                kept += 1
+        assert kept > 0
+    finally:
+        stop.set()
+        proc.join()
+        table.close()
+
+
+def test_shard_rover_shows_positions_outside_deadband_only():
+    _row = np.zeros(1, dtype=table_dtype)[0]
+    _row['gen'] = 1
+    _row['alive'] = 1
+    _row['thread'] = b'Thread-1'
+    rover = ShardRover(None, 0, 0, _row)
+    _row['x'] = 0.004  # Inside the dead-band: the worker shows nothing new
+    rover.update(_row)
+    assert rover.x == 0.004
+    assert rover.wevents.drain() == []
+    _row['x'] = _row['sx'] = 0.02
+    _row['sangle'] = 5.0
+    rover.update(_row)
+    assert rover.wevents.drain() == [['MYPOS', 0.02, 0.0, 5.0]]
+
+
+def test_rover_killed_here_does_not_come_back():
+    pool = ShardPool(1, '127.0.0.1', 0, Waker(), dict([('capacity', 8)]))
+    try:
+        pool.table.write(2, row(1))
+        [rover] = pool.poll()
+        rover.die()
+        assert pool.commands[0].get(timeout=1.0) == ('DIE', 2, 1)
+        assert pool.poll() == []  # The worker has not seen the DIE yet
+        assert pool.rovers == {}
+        pool.table.write(2, (1, 0) + row(1)[2:])
+        assert pool.poll() == []
+        pool.table.write(2, row(2))  # Slot taken by a new rover
+        [rover] = pool.poll()
+        assert rover.gen == 2
+    finally:
+        pool.table.close()
+
+
+def test_shard_rover_metrics_from_worker_report():
+    pool = ShardPool(1, '127.0.0.1', 0, Waker(), dict([('capacity', 8)]))
+    try:
+        pool.table.write(2, row(1))
+        [rover] = pool.poll()
+        assert rover.metrics() is None
+        pool.received.append(('MET', 2, 1, dict([
+            ('name', 'r1'), ('thread', 'Thread-1'),
+            ('msgs_in', dict([('MYPOS', 5)])), ('cmds_out', dict()),
+            ('mypos_age', 0.5), ('smsg_buffer', 0)])))
+        pool.poll()
+        _m = rover.metrics()
+        assert _m['msgs_in'] == dict([('MYPOS', 5)])
+        assert _m['thread'] == 'Thread-1'
+        assert _m['mypos_age'] >= 0.5
+    finally:
+        pool.table.close()
+
+
+def test_shard_rover_halt_acked_in_worker_reaches_the_lane():
+    pool = ShardPool(1, '127.0.0.1', 0, Waker(), dict([('capacity', 8)]))
+    try:
+        pool.table.write(2, row(1))
+        [rover] = pool.poll()
+        lane = EmergencyStop()
+        lane.halt([rover])
+        assert pool.commands[0].get(timeout=1.0) == ('HALT', 2, 1)
+        pool.received.append(('ACKED', 2, 1, 0.004))
+        pool.poll()
+        assert rover.halt_latency == 0.004
+        assert lane.stats()['acks'] == 1
+        assert rover.estops == 1
+    finally:
+        pool.table.close()